@@ -20,18 +20,20 @@ if __name__ == '__main__':
     languages = ['spa', 'eng', 'por', 'fra', 'msa', 'deu', 'ara', 'tha', 'hbs', 'kor', 'pol', 'slk', 'nld', 'ron', 'ell', 'ces', 'bul', 'hun', 'hin', 'mya']
     
     config_path = './configs/e5-config.yaml'
+
+    with open(config_path, 'r') as file:
+        config = yaml.safe_load(file)
+
+    # One pipeline over all the fact-checks, languages are selected by filtering the shared index
+    pipeline = Pipeline(rag_config=config)
+    retriever = pipeline.modules[0]
     
     for language in languages:
-        with open(config_path, 'r') as file:
-            config = yaml.safe_load(file)
-
         temp_languages = languages.copy()
         temp_languages.remove(language)
         
         # Monolingual pairs
-        config['steps'][0]['retriever']['knowledge_base']['language'] = language
-
-        pipeline = Pipeline(rag_config=config)
+        retriever.set_language_filter(language)
         dataset = dataset_factory('multiclaim', language=language).load()
         
         os.makedirs(f'./results/annotations-monolingual/', exist_ok=True)
@@ -40,7 +42,9 @@ if __name__ == '__main__':
         df = pd.DataFrame(columns=['post_id', 'fact_check_ids', 'post_text', 'fact_check_claims'])
         id_to_post = dataset.id_to_post
         
-        for post_id, post in tqdm(list(id_to_post.items())[:10]):
+        posts = list(id_to_post.items())[:10]
+        pipeline.prefetch([post for _, post in posts])
+        for post_id, post in tqdm(posts):
             original_output, documents, _, _ = pipeline(query=post)
             
             df = pd.concat([df, pd.DataFrame(
@@ -50,22 +54,14 @@ if __name__ == '__main__':
         df.to_csv(csv_path, index=False)
         
         # Cross-lingual pairs
-        with open(config_path, 'r') as file:
-            config = yaml.safe_load(file)
-
-        temp_languages = languages.copy()
-        temp_languages.remove(language)
-            
-        config['steps'][0]['retriever']['knowledge_base']['fact_check_language'] = temp_languages
-        config['steps'][0]['retriever']['knowledge_base']['post_language'] = language
-        
-        pipeline = Pipeline(rag_config=config)
+        retriever.set_language_filter(temp_languages)
         
         os.makedirs(f'./results/annotations-crosslingual/', exist_ok=True)
         csv_path = f'./results/annotations-crosslingual/{language}.csv'
         
         df = pd.DataFrame(columns=['post_id', 'fact_check_ids', 'post_text', 'fact_check_claims'])
         
+        pipeline.prefetch(list(id_to_post.values()))
         for post_id, post in tqdm(id_to_post.items()):
             original_output, documents, _, _ = pipeline(query=post)
             
@@ -74,4 +70,3 @@ if __name__ == '__main__':
                 columns=['post_id', 'fact_check_ids', 'post_text', 'fact_check_claims'])])
             
         df.to_csv(csv_path, index=False)    
-    
\ No newline at end of file
@@ -0,0 +1,63 @@
+import argparse
+import logging
+import random
+import time
+
+import numpy as np
+
+from src.datasets import dataset_factory
+from src.retrievers import retriever_factory
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Compare the native BM25 retriever with the PyTerrier one')
+    parser.add_argument('--language', type=str, default=None, help='Language of the knowledge base and posts')
+    parser.add_argument('--num_posts', type=int, default=1000, help='Number of sampled posts')
+    parser.add_argument('--top_k', type=int, default=100, help='Number of retrieved documents')
+    return parser.parse_args()
+
+
+def run(retriever, posts: list) -> tuple:
+    # Index creation or loading is not measured
+    retriever.retrieve_scored(posts[:1])
+
+    start = time.perf_counter()
+    results = retriever.retrieve_scored(posts)
+    return results, (time.perf_counter() - start) / len(posts)
+
+
+if __name__ == '__main__':
+    args = get_args()
+
+    dataset = dataset_factory('multiclaim', language=args.language, split='test').load()
+    posts = list(dataset.id_to_post.values())
+    posts = random.Random(1).sample(posts, min(args.num_posts, len(posts)))
+
+    start = time.perf_counter()
+    terrier = retriever_factory('bm25', top_k=args.top_k, knowledge_base=dataset)
+    terrier_results, terrier_latency = run(terrier, posts)
+    terrier_startup = time.perf_counter() - start
+
+    start = time.perf_counter()
+    native = retriever_factory('bm25_native', top_k=args.top_k, knowledge_base=dataset)
+    native_results, native_latency = run(native, posts)
+    native_startup = time.perf_counter() - start
+
+    overlaps, correlations = [], []
+    for (terrier_ids, terrier_scores), (native_ids, native_scores) in zip(terrier_results, native_results):
+        k = min(10, len(terrier_ids))
+        if k:
+            overlaps.append(len(set(terrier_ids[:k]) & set(native_ids[:k])) / k)
+
+        native_by_id = dict(zip(native_ids, native_scores))
+        shared = [(score, native_by_id[doc_id]) for doc_id, score in zip(terrier_ids, terrier_scores) if doc_id in native_by_id]
+        if len(shared) > 2:
+            correlations.append(np.corrcoef(np.array(shared).T)[0, 1])
+
+    print(f'Posts: {len(posts)}, documents: {len(dataset.id_to_documents)}')
+    print(f'PyTerrier: {terrier_latency * 1000:.2f} ms/post, {terrier_startup:.1f}s including startup')
+    print(f'Native: {native_latency * 1000:.2f} ms/post, {native_startup:.1f}s including startup')
+    print(f'Overlap@10: {np.mean(overlaps):.4f}, score correlation: {np.nanmean(correlations):.4f}')
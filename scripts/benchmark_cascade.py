@@ -0,0 +1,85 @@
+import argparse
+import logging
+import random
+import time
+from collections import defaultdict
+
+from src.datasets import dataset_factory
+from src.evaluation.retrieval_metrics import overlap, recall
+from src.retrievers import retriever_factory
+from src.retrievers.vectorizers.sentence_transformer_vectorizer import SentenceTransformerVectorizer
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Compare the two-tier embedding cascade with the single-tier embedding retriever on MultiClaim')
+    parser.add_argument('--model_name', type=str, default='intfloat/multilingual-e5-large', help='Large model')
+    parser.add_argument('--cache', type=str, default='./cache/multilingual-e5-large', help='Vectorizer cache of the large model')
+    parser.add_argument('--candidate_model_name', type=str, default='intfloat/multilingual-e5-small', help='Small model')
+    parser.add_argument('--candidate_cache', type=str, default='./cache/multilingual-e5-small', help='Vectorizer cache of the small model')
+    parser.add_argument('--candidate_top_k', type=int, nargs='+', default=[50, 100, 200], help='Evaluated numbers of candidates')
+    parser.add_argument('--language', type=str, default=None, help='Language of the knowledge base and posts')
+    parser.add_argument('--top_k', type=int, default=10, help='Recall cutoff')
+    parser.add_argument('--num_posts', type=int, default=200, help='Number of posts retrieved one by one to measure the latency')
+    return parser.parse_args()
+
+
+def uncached_queries(retriever, model_name: str):
+    # Query vectors would be found in the vectorizer cache on repeated runs, so the queries are always encoded
+    retriever.vectorizer_query = SentenceTransformerVectorizer(dir_path=None, model_handle=model_name)
+
+
+def latency(retriever, posts: list) -> float:
+    # Warm-up, so that loading the document matrix is not measured
+    retriever.retrieve('warm-up')
+
+    start = time.perf_counter()
+    for post in posts:
+        retriever.retrieve(post)
+    return (time.perf_counter() - start) / len(posts)
+
+
+if __name__ == '__main__':
+    args = get_args()
+
+    dataset = dataset_factory('multiclaim', language=args.language, split='test').load()
+    desired = defaultdict(list)
+    for fact_check_id, post_id in dataset.fact_check_post_mapping:
+        desired[post_id].append(fact_check_id)
+    post_ids = list(desired.keys())
+    posts = [dataset.id_to_post[post_id] for post_id in post_ids]
+    sample = random.Random(1).sample(posts, min(args.num_posts, len(posts)))
+
+    single = retriever_factory('embedding', model_name=args.model_name, cache=args.cache, top_k=args.top_k, knowledge_base=dataset)
+    uncached_queries(single, args.model_name)
+    single_latency = latency(single, sample)
+    reference = [ids for ids, _ in single.retrieve_scored(posts)]
+    single.close()
+    del single
+
+    rows = [('single-tier', recall(reference, post_ids, desired), 1.0, single_latency)]
+    for candidate_top_k in args.candidate_top_k:
+        cascade = retriever_factory(
+            'embedding_cascade',
+            model_name=args.model_name,
+            cache=args.cache,
+            candidate_model_name=args.candidate_model_name,
+            candidate_cache=args.candidate_cache,
+            candidate_top_k=candidate_top_k,
+            top_k=args.top_k,
+            knowledge_base=dataset
+        )
+        uncached_queries(cascade, args.model_name)
+        uncached_queries(cascade.candidate, args.candidate_model_name)
+        cascade_latency = latency(cascade, sample)
+        predicted = [ids for ids, _ in cascade.retrieve_scored(posts)]
+        rows.append((f'cascade@{candidate_top_k}', recall(predicted, post_ids, desired), overlap(predicted, reference), cascade_latency))
+        cascade.close()
+        del cascade
+
+    print(f'Posts: {len(posts)}, documents: {len(dataset.id_to_documents)}, latency measured on {len(sample)} posts one by one')
+    print(f'{"retriever":>14} {"recall@" + str(args.top_k):>10} {"overlap":>8} {"ms/post":>8}')
+    for name, post_recall, post_overlap, post_latency in rows:
+        print(f'{name:>14} {post_recall:>10.4f} {post_overlap:>8.4f} {post_latency * 1000:>8.2f}')
@@ -0,0 +1,72 @@
+import argparse
+import logging
+import random
+import time
+
+import torch
+
+from src.datasets import dataset_factory
+from src.retrievers.vectorizers.sentence_transformer_vectorizer import SentenceTransformerVectorizer
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Compare the CPU fast path of the vectorizer with the float32 eager path')
+    parser.add_argument('--model_name', type=str, default='intfloat/multilingual-e5-large', help='Model name')
+    parser.add_argument('--cpu_optimization', type=str, default='int8', help='int8 or bf16')
+    parser.add_argument('--num_threads', type=int, default=None, help='Number of torch threads')
+    parser.add_argument('--compile_graph', action='store_true', help='Compile the encoder')
+    parser.add_argument('--max_tokens', type=int, default=None, help='Token budget of a batch')
+    parser.add_argument('--num_posts', type=int, default=1000, help='Number of sampled posts')
+    parser.add_argument('--batch_size', type=int, default=32, help='Encoding batch size')
+    return parser.parse_args()
+
+
+def encode(vectorizer: SentenceTransformerVectorizer, texts: list) -> tuple:
+    # Warm-up, so that lazy initialization and compilation are not measured
+    vectorizer.vectorize(texts[:vectorizer.batch_size], normalize=True)
+
+    start = time.perf_counter()
+    vectors = vectorizer.vectorize(texts, normalize=True)
+    return vectors, len(texts) / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    args = get_args()
+
+    dataset = dataset_factory('multiclaim', split='test').load()
+    posts = list(dataset.id_to_post.values())
+    posts = random.Random(1).sample(posts, min(args.num_posts, len(posts)))
+
+    # No `dir_path`, so that every vector is calculated by the model
+    baseline = SentenceTransformerVectorizer(
+        dir_path=None,
+        model_handle=args.model_name,
+        batch_size=args.batch_size,
+        max_tokens=args.max_tokens,
+        num_threads=args.num_threads
+    )
+    baseline.model = baseline.model.cpu()
+    baseline_vectors, baseline_speed = encode(baseline, posts)
+    del baseline
+
+    optimized = SentenceTransformerVectorizer(
+        dir_path=None,
+        model_handle=args.model_name,
+        batch_size=args.batch_size,
+        max_tokens=args.max_tokens,
+        cpu_optimization=args.cpu_optimization,
+        num_threads=args.num_threads,
+        compile_graph=args.compile_graph
+    )
+    optimized.model = optimized.model.cpu()
+    optimized_vectors, optimized_speed = encode(optimized, posts)
+
+    drift = 1 - torch.sum(baseline_vectors.float() * optimized_vectors.float(), dim=1)
+    print(f'Posts: {len(posts)}, threads: {torch.get_num_threads()}')
+    print(f'float32: {baseline_speed:.1f} posts/s')
+    print(f'{args.cpu_optimization}{" + compile" if args.compile_graph else ""}: {optimized_speed:.1f} posts/s '
+          f'({optimized_speed / baseline_speed:.2f}x)')
+    print(f'Cosine drift: mean {drift.mean().item():.6f}, max {drift.max().item():.6f}')
@@ -0,0 +1,69 @@
+import argparse
+import logging
+import time
+from collections import defaultdict
+
+from src.datasets import dataset_factory
+from src.evaluation.retrieval_metrics import overlap, recall
+from src.retrievers import retriever_factory
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Report recall of the embedding retriever for reduced dimensions on MultiClaim')
+    parser.add_argument('--model_name', type=str, default='intfloat/multilingual-e5-large', help='Model name')
+    parser.add_argument('--cache', type=str, default='./cache/multilingual-e5-large', help='Vectorizer cache directory')
+    parser.add_argument('--language', type=str, default=None, help='Language of the knowledge base and posts')
+    parser.add_argument('--projection', type=str, default='pca', help='pca or truncate')
+    parser.add_argument('--dims', type=int, nargs='+', default=[64, 128, 256, 512], help='Evaluated dimensions')
+    parser.add_argument('--top_k', type=int, default=10, help='Recall cutoff')
+    parser.add_argument('--rescore_factor', type=int, default=4, help='Number of rescored candidates per retrieved document')
+    return parser.parse_args()
+
+
+def run(retriever, posts: list) -> tuple:
+    start = time.perf_counter()
+    results = retriever.retrieve_scored(posts)
+    return [ids for ids, _ in results], (time.perf_counter() - start) / len(posts)
+
+
+if __name__ == '__main__':
+    args = get_args()
+
+    dataset = dataset_factory('multiclaim', language=args.language, split='test').load()
+    desired = defaultdict(list)
+    for fact_check_id, post_id in dataset.fact_check_post_mapping:
+        desired[post_id].append(fact_check_id)
+    post_ids = list(desired.keys())
+    posts = [dataset.id_to_post[post_id] for post_id in post_ids]
+
+    options = dict(model_name=args.model_name, cache=args.cache, top_k=args.top_k, knowledge_base=dataset)
+    full = retriever_factory('embedding', **options)
+    reference, latency = run(full, posts)
+    full_dim = full.document_embeddings.shape[0]
+    full.close()
+    del full
+
+    rows = [(full_dim, '-', recall(reference, post_ids, desired), 1.0, latency)]
+    for dim in args.dims:
+        for rescore in (False, True):
+            retriever = retriever_factory(
+                'embedding',
+                **options,
+                projection=args.projection,
+                projection_dim=dim,
+                rescore=rescore,
+                rescore_factor=args.rescore_factor
+            )
+            predicted, latency = run(retriever, posts)
+            rows.append((dim, 'yes' if rescore else 'no', recall(predicted, post_ids, desired), overlap(predicted, reference), latency))
+            retriever.close()
+            del retriever
+
+    print(f'Posts: {len(posts)}, documents: {len(dataset.id_to_documents)}, projection: {args.projection}')
+    print(f'{"dim":>6} {"rescore":>8} {"recall@" + str(args.top_k):>10} {"overlap":>8} {"ms/post":>8} {"matrix MB":>10}')
+    for dim, rescore, post_recall, post_overlap, latency in rows:
+        size = len(dataset.id_to_documents) * dim * 4 / 2**20
+        print(f'{dim:>6} {rescore:>8} {post_recall:>10.4f} {post_overlap:>8.4f} {latency * 1000:>8.2f} {size:>10.1f}')
@@ -0,0 +1,44 @@
+import argparse
+import logging
+
+from src.datasets import dataset_factory
+from src.retrievers.vectorizers.sentence_transformer_vectorizer import SentenceTransformerVectorizer
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Encode the MultiClaim posts and fact-checks into the vectorizer cache')
+    parser.add_argument('--model_name', type=str, default='intfloat/multilingual-e5-large', help='Model name')
+    parser.add_argument('--cache', type=str, default='./cache/multilingual-e5-large', help='Vectorizer cache directory')
+    parser.add_argument('--version', type=str, default='original', help='Language version of the dataset')
+    parser.add_argument('--chunk_size', type=int, default=10000, help='Number of texts saved together')
+    parser.add_argument('--num_workers', type=int, default=1, help='Number of worker processes')
+    parser.add_argument('--threads_per_worker', type=int, default=None, help='Number of torch threads per worker')
+    parser.add_argument('--batch_size', type=int, default=32, help='Encoding batch size')
+    parser.add_argument('--max_tokens', type=int, default=None, help='Token budget of a batch, texts are batched by their length')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+
+    dataset = dataset_factory('multiclaim', version=args.version).load()
+    texts = list(dataset.id_to_documents.values()) + list(dataset.id_to_post.values())
+
+    vectorizer = SentenceTransformerVectorizer(
+        dir_path=args.cache,
+        model_handle=args.model_name,
+        batch_size=args.batch_size,
+        max_tokens=args.max_tokens
+    )
+    encoded = vectorizer.encode_corpus(
+        texts,
+        chunk_size=args.chunk_size,
+        num_workers=args.num_workers,
+        threads_per_worker=args.threads_per_worker
+    )
+    logger.info(f'{encoded} new vectors stored, {len(vectorizer)} vectors in the cache')
+    if args.num_workers <= 1:
+        logger.info(f'Batching: {vectorizer.get_batching_stats()}')
@@ -33,8 +33,8 @@ class Dataset:
     language: language of the knowledge base
     post_language: language of the postprocessing, specific for MultiClaim dataset
     split: which split of the dataset to use (train, dev, test)
-    doc_sent_count: number of sentences that should be in one document
-    overlap: number of sentences that should overlap between documents
+    doc_sent_count: number of sentences that should be in one passage, used by retrievers with passages
+    overlap: number of sentences that should overlap between passages
     document_path: path to the document or directory with documents
     version: version of the dataset (original, english), specific for MultiClaim dataset
     """
@@ -60,13 +60,71 @@ class Retriever:
     use_unidecode: whether to use unidecode for the query, specific for bm25 retriever
     knowledge_base: knowledge base to be used for the retrieval
     cache: path to the cache
+    index: type of the document index ('exact', 'ivf' or 'sharded'), specific for embedding retriever
+    index_nlist: number of clusters of the ivf index, None means square root of the knowledge base size
+    index_nprobe: number of clusters of the ivf index probed for each query
+    index_shard_size: number of documents in one memory-mapped shard of the sharded index
+    index_block_size: number of documents scored at once by one thread of the sharded index, bounds the peak memory
+    index_threads: number of shards of the sharded index scored in parallel
+    quantization: storage of the document matrix ('int8', 'fp16', 'bf16'), specific for embedding retriever
+    rescore: whether to rescore the candidates of the quantized matrix or the projected space in full precision
+    rescore_factor: number of rescored candidates per retrieved document
+    projection: scoring in a reduced space ('pca' or 'truncate'), specific for embedding retriever
+    projection_dim: number of dimensions after the projection
+    deduplicate: whether to score documents with identical texts only once, specific for embedding retriever
+    passages: whether to index passages of the documents (see doc_sent_count and overlap of the knowledge base), specific for embedding retriever
+    passage_pooling: pooling of the passage similarities into document scores ('max' or 'mean')
+    shared_index_dir: directory where the document matrix is published for other processes on the host, e.g. in /dev/shm
+    window_days_before: retrieve only fact-checks published at most this many days before the post, specific for embedding retriever
+    window_days_after: retrieve only fact-checks published at most this many days after the post (0 excludes later fact-checks)
+    max_tokens: token budget of the vectorizer batches, texts are batched by their length instead of a fixed batch size
+    cpu_optimization: CPU fast path of the encoder ('int8' or 'bf16'), specific for embedding retriever
+    num_threads: number of torch threads used by the encoder
+    fusion: fusion of the hybrid retriever, 'rrf' (reciprocal rank fusion) or 'score' (normalized scores)
+    sparse_top_k: number of documents retrieved by the bm25 branch of the hybrid retriever
+    dense_top_k: number of documents retrieved by the embedding branch of the hybrid retriever
+    sparse_weight: weight of the bm25 branch in the fusion
+    dense_weight: weight of the embedding branch in the fusion
+    rrf_k: constant of the reciprocal rank fusion
+    candidate_model_name: small model generating the candidates of the embedding_cascade retriever, e.g. 'intfloat/multilingual-e5-small'
+    candidate_cache: path to the vectorizer cache of the small model, defaults to a directory named after it next to cache (none without cache)
+    candidate_top_k: number of candidates rescored with the large model (model_name) by the embedding_cascade retriever
     """
     name: str = None
     model_name: str = None
     top_k: int = 5
-    use_unidecode: bool = False
+    use_unidecode: bool = True
     knowledge_base: Dataset = field(default_factory=Dataset)
     cache: str = None
+    index: str = None
+    index_nlist: int = None
+    index_nprobe: int = None
+    index_shard_size: int = None
+    index_block_size: int = None
+    index_threads: int = None
+    quantization: str = None
+    rescore: bool = None
+    rescore_factor: int = None
+    projection: str = None
+    projection_dim: int = None
+    deduplicate: bool = None
+    passages: bool = None
+    passage_pooling: str = None
+    shared_index_dir: str = None
+    window_days_before: float = None
+    window_days_after: float = None
+    max_tokens: int = None
+    cpu_optimization: str = None
+    num_threads: int = None
+    fusion: str = None
+    sparse_top_k: int = None
+    dense_top_k: int = None
+    sparse_weight: float = None
+    dense_weight: float = None
+    rrf_k: int = None
+    candidate_model_name: str = None
+    candidate_cache: str = None
+    candidate_top_k: int = None
 
 
 @dataclass
@@ -43,3 +43,16 @@ def combine_distributions(texts: Iterable[TranslatedText]) -> LanguageDistributi
         for language, percentage in text_distribution:
             distribution[language] += percentage * len(original_text) / total_length
     return list(distribution.items())
+
+
+def earliest_timestamp(instances: Iterable[Instance]) -> Optional[float]:
+    """
+    Return the earliest publication time of the `instances` as a Unix timestamp, `None` if none of them is dated. The csvs store
+    the times as timestamps, `datetime` objects are converted.
+    """
+    timestamps = [
+        when.timestamp() if isinstance(when, datetime) else float(when)
+        for when, _ in instances or []
+        if when is not None and when != ''
+    ]
+    return min(timestamps) if timestamps else None
@@ -1,5 +1,6 @@
-from typing import Any, List
+from typing import Any, Dict, Iterable, List, Tuple
 import src.datasets.cleaning as cleaning
+from src.datasets.utils import chunk_text
 
 class Dataset:
     """Dataset
@@ -16,6 +17,8 @@ class Dataset:
         clean_twitter: bool = True  
         remove_elongation: bool = False  Should occurrence of a string of consecutive identical non-space 
     characters (at least three in a row) with just one instance of that character?
+        doc_sent_count: int = 1  Number of sentences in one passage, see `split_passages`.
+        overlap: int = 0  Number of sentences shared by two consecutive passages.
 
         After `load` is called, following attributes are accesible:
                 fact_check_post_mapping: list[tuple[int, int]]  List of Factcheck-Post id pairs.
@@ -37,6 +40,8 @@ class Dataset:
         replace_whitespaces: bool = True,
         clean_twitter: bool = True,
         remove_elongation: bool = False,
+        doc_sent_count: int = 1,
+        overlap: int = 0,
         **kwargs: Any
     ):
         self.clean_ocr = clean_ocr
@@ -45,6 +50,9 @@ class Dataset:
         self.replace_whitespaces = replace_whitespaces
         self.clean_twitter = clean_twitter
         self.remove_elongation = remove_elongation
+        assert 0 <= overlap < doc_sent_count
+        self.doc_sent_count = doc_sent_count
+        self.overlap = overlap
         
     def __len__(self):
         return len(self.fact_check_post_mapping)
@@ -65,6 +73,50 @@ class Dataset:
     def get_documents_ids(self) -> List[str]:
         return list(map(str, self.id_to_documents.keys()))
     
+    def get_unique_documents(self) -> Tuple[List[str], List[int]]:
+        """
+        Deduplicate the document texts. Several fact-checks often debunk the same claim, so their cleaned texts are identical.
+        Return the unique texts in the order of their first occurrence and, for each document in the knowledge base order, the
+        row of its text among the unique texts.
+        """
+        text_to_row = {}
+        rows = [text_to_row.setdefault(text, len(text_to_row)) for text in self.id_to_documents.values()]
+        return list(text_to_row.keys()), rows
+
+    def split_passages(self, texts: List[str]) -> Tuple[List[str], List[int]]:
+        """
+        Split `texts` into passages of `doc_sent_count` sentences, consecutive passages share `overlap` sentences. Return the
+        passages and, for each of them, the index of its text. Texts without any sentence are kept as one passage.
+        """
+        passages, segments = [], []
+        for i, text in enumerate(texts):
+            chunks = chunk_text(text, self.doc_sent_count, self.overlap) or [text]
+            passages.extend(chunks)
+            segments.extend([i] * len(chunks))
+        return passages, segments
+
+    def add_documents(self, documents: Dict[int, str], **metadata: Any) -> None:
+        """
+        Add new documents (id -> text) to the knowledge base, or replace the texts of existing ids. The texts should be
+        prepared the same way as the loaded documents. New ids are appended after the existing ones. Subclasses may accept
+        `metadata` of the documents, e.g. their languages or dates, the base class ignores it.
+        """
+        self.id_to_documents.update(documents)
+
+    def remove_documents(self, ids: Iterable[int]) -> None:
+        """
+        Remove documents with `ids` from the knowledge base. Unknown ids are ignored.
+        """
+        for doc_id in ids:
+            self.id_to_documents.pop(doc_id, None)
+
+    def get_documents_ids_by_language(self, languages: List[str]) -> List[int]:
+        """
+        Return ids of the documents written in one of the `languages`. To be implemented by the subclasses that know
+        the languages of their documents.
+        """
+        raise NotImplementedError
+
     def map_topK(self, topK: List[int]) -> List[int]:
         """
         Maps the topK to the new ids
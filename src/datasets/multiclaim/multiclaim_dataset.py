@@ -3,11 +3,11 @@ import logging
 import os
 import random
 from os.path import join as join_path
-from typing import Iterable, Optional
+from typing import Dict, Iterable, List, Optional
 
 import pandas as pd
 
-from src.datasets.custom_types import Language, is_in_distribution, combine_distributions
+from src.datasets.custom_types import Language, LanguageDistribution, is_in_distribution, combine_distributions, earliest_timestamp
 from src.datasets.dataset import Dataset
 
 
@@ -35,10 +35,16 @@ class MultiClaimDataset(Dataset):
             fact_check_post_mapping: list[tuple[int, int]]  List of Factcheck-Post id pairs.
             id_to_documents: dict[int, str]  Factcheck id -> Factcheck text
             id_to_post: dict[int, str]  Post id -> Post text
+            id_to_language_distribution: dict[int, LanguageDistribution]  Factcheck id -> Language distribution of the claim
+            id_to_date: dict[int, Optional[float]]  Factcheck id -> Earliest publication time of the fact-check (Unix timestamp)
+            post_id_to_date: dict[int, Optional[float]]  Post id -> Earliest publication time of the post (Unix timestamp)
 
 
     Methods:
         load: Loads the data from the csv files. Populates `id_to_documents`, `id_to_post` and `fact_check_post_mapping` attributes.
+        add_documents, remove_documents: Incremental updates of the fact-checks, see `Dataset`.
+        get_documents_ids_by_language: Ids of fact-checks in given languages. Can be used to filter a knowledge base loaded without
+            language filters, e.g. by `Embedding.set_language_filter`.
     """
 
     our_dataset_path = join_path('.','datasets', 'multiclaim')
@@ -225,6 +231,20 @@ class MultiClaimDataset(Dataset):
             for fact_check_id, claim in zip(df_fact_checks.index, df_fact_checks['claim'])
         }
 
+        self.id_to_language_distribution = {
+            fact_check_id: claim[2]
+            for fact_check_id, claim in zip(df_fact_checks.index, df_fact_checks['claim'])
+        }
+
+        self.id_to_date = {
+            fact_check_id: earliest_timestamp(instances)
+            for fact_check_id, instances in zip(df_fact_checks.index, df_fact_checks['instances'])
+        }
+        self.post_id_to_date = {
+            post_id: earliest_timestamp(instances)
+            for post_id, instances in zip(df_posts.index, df_posts['instances'])
+        }
+
         self.id_to_post = dict()
         for post_id, post_text, ocr in zip(df_posts.index, df_posts['text'], df_posts['ocr']):
             texts = list()
@@ -237,6 +257,41 @@ class MultiClaimDataset(Dataset):
 
         return self
 
+    def add_documents(
+        self,
+        documents: Dict[int, str],
+        language_distributions: Dict[int, LanguageDistribution] = None,
+        dates: Dict[int, float] = None
+    ) -> None:
+        """
+        Add new fact-checks (id -> text), optionally with the language distributions of their claims, so that they can be
+        selected by `get_documents_ids_by_language`, and with their publication times. Fact-checks without a date pass every
+        temporal filter.
+        """
+        super().add_documents(documents)
+        if language_distributions:
+            self.id_to_language_distribution.update(language_distributions)
+        if dates:
+            self.id_to_date.update(dates)
+
+    def remove_documents(self, ids: Iterable[int]) -> None:
+        ids = list(ids)
+        super().remove_documents(ids)
+        for fact_check_id in ids:
+            self.id_to_language_distribution.pop(fact_check_id, None)
+            self.id_to_date.pop(fact_check_id, None)
+
+    def get_documents_ids_by_language(self, languages: List[Language]) -> List[int]:
+        """
+        Return ids of the fact-checks whose claim is in one of the `languages`. The same criterion is used as by the
+        `language` and `fact_check_language` filters in `load`.
+        """
+        return [
+            fact_check_id
+            for fact_check_id, distribution in self.id_to_language_distribution.items()
+            if any(is_in_distribution(language, distribution) for language in languages)
+        ]
+
     @staticmethod
     def split_post_ids(split):
         rnd = random.Random(1)
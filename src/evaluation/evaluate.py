@@ -140,13 +140,24 @@ def advanced_metrics(relevant_docs, previously_predicted_docs, predicted_docs):
     }
 
 
-def evaluate_multiclaim(dataset, pipeline, csv_path=None, language=None):
+def evaluate_multiclaim(dataset, pipeline, csv_path=None, language=None, batch_size=1024):
+    """
+    Run the `pipeline` for all the posts in the `dataset`. The first retriever of the pipeline processes the posts in batches
+    of `batch_size` via `Pipeline.prefetch`. Publication times of the posts are passed along, so that retrievers with a time
+    window can use them.
+    """
     df = pd.DataFrame(columns=['post_id', 'fact_check_ids', 'generated_output', 'yes_prob', 'no_prob'])
     id_to_post = dataset.id_to_post
+    posts = list(id_to_post.values())
+    post_id_to_date = getattr(dataset, 'post_id_to_date', {})
+    dates = [post_id_to_date.get(post_id) for post_id in id_to_post.keys()]
+
+    for i, (post_id, post) in enumerate(tqdm(id_to_post.items())):
 
-    for post_id, post in tqdm(id_to_post.items()):
+        if batch_size and i % batch_size == 0:
+            pipeline.prefetch(posts[i:i+batch_size], query_dates=dates[i:i+batch_size])
 
-        original_output, documents, yes_probs, no_probs = pipeline(query=post)
+        original_output, documents, yes_probs, no_probs = pipeline(query=post, query_date=dates[i])
         if len(documents) == 0 or isinstance(documents[0], int):
             fact_check_ids = documents
         else:
@@ -0,0 +1,25 @@
+"""
+Metrics comparing retrieved document ids instead of ranks, used to compare retrievers in the benchmark scripts. The results
+are lists of retrieved ids for individual queries (posts).
+"""
+from typing import Dict, List
+
+import numpy as np
+
+
+def recall(predicted: List[List[int]], post_ids: List[int], desired: Dict[int, List[int]]) -> float:
+    """
+    Recall - Mean fraction of the desired fact-checks of each post that were retrieved.
+    """
+    hits = [
+        len(set(ids) & set(desired[post_id])) / len(desired[post_id])
+        for ids, post_id in zip(predicted, post_ids)
+    ]
+    return float(np.mean(hits))
+
+
+def overlap(predicted: List[List[int]], reference: List[List[int]]) -> float:
+    """
+    Overlap - Mean fraction of the ids retrieved by a reference retriever that were retrieved for the same post.
+    """
+    return float(np.mean([len(set(ids) & set(expected)) / max(len(expected), 1) for ids, expected in zip(predicted, reference)]))
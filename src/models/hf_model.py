@@ -1,4 +1,4 @@
-from typing import List, Union
+from typing import List, Tuple, Union
 from src.models.model import Model
 import torch
 import torch.nn.functional as F
@@ -151,9 +151,76 @@ class HFModel(Model):
         
         return yes_prob, no_prob
 
+    def _generate(self, p: str) -> Tuple[str, float, float]:
+        """
+        Generate the answer for one prompt. Return the answer and the probabilities of the Yes and No tokens.
+        """
+        if self._is_chat():
+            if self.system_prompt and self._get_system_role() == 'system':
+                messages = [
+                    {"role": "system", "content": self.system_prompt},
+                    {"role": "user", "content": p}
+                ]
+            elif self.system_prompt:
+                messages = [
+                    {"role": "user", "content": f'{self.system_prompt}\n\n{p}'}
+                ]
+            else:
+                messages = [
+                    {"role": "user", "content": p}
+                ]
+            
+            inputs = self.tokenizer.apply_chat_template(
+                messages, 
+                add_generation_prompt=True,
+                return_tensors='pt'
+            ).to(self.device)
+
+        else:
+            if 'falcon-40b' in self.model_name:
+                if self.system_prompt is not None:
+                    p = f'{self.system_prompt}\nUser: {p}\nFalcon:'
+                else:
+                    p = f'User: {p}\nFalcon:'
+                
+            elif self.system_prompt is not None:
+                p = f'{self.system_prompt}\n\n{p}'
+
+            inputs = self.tokenizer(
+                p, 
+                return_tensors='pt'
+            ).to(self.device)['input_ids']
+        
+        generated_output = self.model.generate(
+            input_ids=inputs,
+            max_new_tokens=self.max_new_tokens,
+            eos_token_id=self._terminators(),
+            return_dict_in_generate=True,
+            output_logits=True,
+            do_sample=self.do_sample,
+        )
+        generated_ids = generated_output.sequences
+        logits = generated_output.logits
+        
+        yes_prob, no_prob = self._get_answer_probs(logits)
+        
+        decoded_input = self.tokenizer.batch_decode(
+            inputs, 
+            skip_special_tokens=True
+        )[0]
+        
+        decoded = self.tokenizer.batch_decode(
+            generated_ids, 
+            skip_special_tokens=True
+        )[0]
+        
+        decoded = decoded[len(decoded_input):]
+        return decoded.strip(), yes_prob, no_prob
+
     def infere(self, prompt: Union[str, List[str]]) -> str:
         """
-        Generate text based on the prompt.
+        Generate text based on the prompt. Without sampling, identical prompts, e.g. for fact-checks with the same claim text,
+        are generated only once and their results are copied.
         
         Args:
             prompt (Union[str, List[str]]): The prompt to generate text from.
@@ -163,73 +230,18 @@ class HFModel(Model):
         """
         if isinstance(prompt, str):
             prompt = [prompt]
-        
-        answers = []
-        yes_probs = []
-        no_probs = []
-        for p in prompt:
-            if self._is_chat():
-                if self.system_prompt and self._get_system_role() == 'system':
-                    messages = [
-                        {"role": "system", "content": self.system_prompt},
-                        {"role": "user", "content": p}
-                    ]
-                elif self.system_prompt:
-                    messages = [
-                        {"role": "user", "content": f'{self.system_prompt}\n\n{p}'}
-                    ]
-                else:
-                    messages = [
-                        {"role": "user", "content": p}
-                    ]
-                
-                inputs = self.tokenizer.apply_chat_template(
-                    messages, 
-                    add_generation_prompt=True,
-                    return_tensors='pt'
-                ).to(self.device)
 
-            else:
-                if 'falcon-40b' in self.model_name:
-                    if self.system_prompt is not None:
-                        p = f'{self.system_prompt}\nUser: {p}\nFalcon:'
-                    else:
-                        p = f'User: {p}\nFalcon:'
-                    
-                elif self.system_prompt is not None:
-                    p = f'{self.system_prompt}\n\n{p}'
+        if self.do_sample:
+            # Sampled answers of identical prompts may differ
+            outputs = [self._generate(p) for p in prompt]
+        else:
+            unique_prompts = list(dict.fromkeys(prompt))
+            if len(unique_prompts) < len(prompt):
+                logger.info(f'{len(prompt)} prompts deduplicated to {len(unique_prompts)} model calls')
+            unique_outputs = {p: self._generate(p) for p in unique_prompts}
+            outputs = [unique_outputs[p] for p in prompt]
 
-                inputs = self.tokenizer(
-                    p, 
-                    return_tensors='pt'
-                ).to(self.device)['input_ids']
-            
-            generated_output = self.model.generate(
-                input_ids=inputs,
-                max_new_tokens=self.max_new_tokens,
-                eos_token_id=self._terminators(),
-                return_dict_in_generate=True,
-                output_logits=True,
-                do_sample=self.do_sample,
-            )
-            generated_ids = generated_output.sequences
-            logits = generated_output.logits
-            
-            yes_prob, no_prob = self._get_answer_probs(logits)
-            yes_probs.append(yes_prob)
-            no_probs.append(no_prob)
-            
-            decoded_input = self.tokenizer.batch_decode(
-                inputs, 
-                skip_special_tokens=True
-            )[0]
-            
-            decoded = self.tokenizer.batch_decode(
-                generated_ids, 
-                skip_special_tokens=True
-            )[0]
-            
-            decoded = decoded[len(decoded_input):]
-            answers.append(decoded.strip())
-        
+        answers = [answer for answer, _, _ in outputs]
+        yes_probs = [yes_prob for _, yes_prob, _ in outputs]
+        no_probs = [no_prob for _, _, no_prob in outputs]
         return '##### '.join(answers), yes_probs, no_probs
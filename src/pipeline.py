@@ -8,7 +8,6 @@ from src.prompts import prompt_factory
 from src.postprocess import postprocessor_factory
 from src.datasets import dataset_factory
 from src.datasets.dataset import Dataset
-from src.datasets.retrieved_documents import RetrievedDocuments
 from src.config import Retriever, Prompt, LLM, Postprocessor
 from src.retrievers.retriever import Retriever as RetrieverModule
 
@@ -54,7 +53,12 @@ class Pipeline(Module):
         if isinstance(module, Retriever):
             cache = module.cache
             knowledge_base = self.get_knowledge_base(module.knowledge_base)
-            return retriever_factory(module.name, model_name=module.model_name, top_k=module.top_k, knowledge_base=knowledge_base, cache=cache)
+            # Optional settings are passed only when set, so that the retrievers can use their own defaults
+            rest = {
+                k: v for k, v in module.__dict__.items()
+                if k not in ['name', 'model_name', 'top_k', 'knowledge_base', 'cache'] and v is not None
+            }
+            return retriever_factory(module.name, model_name=module.model_name, top_k=module.top_k, knowledge_base=knowledge_base, cache=cache, **rest)
         elif isinstance(module, Prompt):
             name = module.type
             rest = {
@@ -82,20 +86,32 @@ class Pipeline(Module):
 
         return kwargs
 
+    def prefetch(self, queries: List[str], query_dates: List[float] = None) -> None:
+        """
+        Run the first retriever of the pipeline for all the `queries` at once, see `Retriever.prefetch`.
+        
+        Args:
+            queries: queries that will be passed to the pipeline next
+            query_dates: publication times of the queries, used by retrievers with a time window
+        """
+        if self.modules and isinstance(self.modules[0], RetrieverModule):
+            self.modules[0].prefetch(queries, query_dates=query_dates)
+
     def __call__(self, **kwargs) -> Any:
+        # The publication time of the query is used only by the first retriever, the later ones work with its candidates
+        query_date = kwargs.pop('query_date', None)
+        if query_date is not None and self.modules and isinstance(self.modules[0], RetrieverModule):
+            kwargs['query_date'] = query_date
+
         for idx, module in enumerate(self.modules):
             if isinstance(module, RetrieverModule) and isinstance(self.modules[idx - 1], RetrieverModule):
                 if len(kwargs['documents']) == 0:
                     continue
-                knowledge_base = RetrievedDocuments(
-                    name='retrieved_documents',
-                    documents=kwargs['documents'],
-                    ids=kwargs['top_k']
-                )
+                documents, ids = kwargs['documents'], kwargs['top_k']
                 kwargs = {
                     "query": kwargs['query']
                 }
-                module.set_knowledge_base(knowledge_base)
+                module.set_candidates(documents, ids, parent=self.modules[idx - 1].knowledge_base)
 
             kwargs = module(**kwargs)
             kwargs = self._convert_kwargs(module, kwargs)
@@ -12,8 +12,9 @@ class RetrieverPostprocessor(Postprocessor):
         Returns:
             tuple: The postprocessed output and the documents.
         """
+        # Retrievers return texts that are fetched lazily, the output is written into CSVs, so it has to be a plain list
         return (
-            kwargs['documents'],
+            list(kwargs['documents']),
             kwargs['top_k'],
             None,
             None
@@ -82,23 +82,23 @@ class CosineSimilarity:
         self.retriever = retriever_factory('embedding', model_name='intfloat/multilingual-e5-large', cache='./cache/multilingual-e5-large', top_k=None)
         
     def load(self):
-        pass
+        self.fact_checks = FewShotDataset(path=self.path, english=self.english, type='fact_check')
+        self.posts = FewShotDataset(path=self.path, english=self.english, type='post')
+        self.df = self.fact_checks.return_df()
     
     def sample(self, post: str, fact_check: str):
-        fact_checks = FewShotDataset(path=self.path, english=self.english, type='fact_check')
-        posts = FewShotDataset(path=self.path, english=self.english, type='post')
-        self.df = fact_checks.return_df()
+        if self.df is None:
+            self.load()
         post_text = 'PostText_en' if self.english else 'PostText'
         fact_check_text = 'FactCheckText_en' if self.english else 'FactCheckText'
         
-        self.retriever.set_knowledge_base(posts)
-        post_sims = self.retriever.retrieve_sims(post)
+        # Only the similarity arrays are needed, no document texts are fetched
+        self.retriever.set_knowledge_base(self.posts)
+        post_sims = self.retriever.search([post], ranked=False)[0].scores
         
-        self.retriever.set_knowledge_base(fact_checks)
-        fact_check_sims = self.retriever.retrieve_sims(fact_check)
+        self.retriever.set_knowledge_base(self.fact_checks)
+        fact_check_sims = self.retriever.search([fact_check], ranked=False)[0].scores
 
-        post_sims = np.array(post_sims)
-        fact_check_sims = np.array(fact_check_sims)
         final_sims = post_sims * fact_check_sims
         
         sorted_indexes = np.argsort(final_sims, axis=0)
@@ -110,8 +110,9 @@ class FewShotPointwisePrompt(Prompt):
         fact_check_text = 'factcheck_text_en' if self.english else 'factcheck_text'
         
         if self.df is not None:
-            prompts = []
-            for document in documents:
+            # Documents with the same text share the prompt, the examples are looked up once per unique text
+            prompts = {}
+            for document in dict.fromkeys(documents):
                 examples = self.df[(self.df[post_text] == query) & (self.df[fact_check_text] == document)]['random_examples'].values[0]
                 examples = examples[:self.num_examples]
                 examples = [
@@ -120,10 +121,10 @@ class FewShotPointwisePrompt(Prompt):
                 ]
                 
                 text = '\n\n'.join(examples)
-                prompts.append(f'{text}\n\n' + self.template.format(document=document, query=query).replace("\\n", "\n"))
+                prompts[document] = f'{text}\n\n' + self.template.format(document=document, query=query).replace("\\n", "\n")
             
             return {
-                'prompt': prompts
+                'prompt': [prompts[document] for document in documents]
             }
         else:
             # use template to create examples for few-shot learning
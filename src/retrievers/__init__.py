@@ -1,15 +1,52 @@
+import os
 import torch
 from typing import Any
 
 from src.retrievers.vectorizers.sentence_transformer_vectorizer import SentenceTransformerVectorizer
 from src.retrievers.retriever import Retriever
 from src.retrievers.bm25 import BM25
+from src.retrievers.bm25_native import BM25Native
 from src.retrievers.embedding import Embedding
+from src.retrievers.embedding_cascade import EmbeddingCascade
+from src.retrievers.hybrid import Hybrid
 
 
 def retriever_factory(name, **kwargs: Any) -> Retriever:
-    if name == 'embedding':
-        vct = SentenceTransformerVectorizer(dir_path=kwargs['cache'], model_handle=kwargs['model_name'])
+    if name == 'hybrid':
+        # Both branches share the knowledge base, the dense branch gets all the embedding options
+        sparse_top_k = kwargs.pop('sparse_top_k', None) or 100
+        dense_top_k = kwargs.pop('dense_top_k', None) or 100
+        kwargs['dense'] = retriever_factory('embedding', **{**kwargs, 'top_k': dense_top_k})
+        kwargs['sparse'] = retriever_factory(
+            'bm25',
+            top_k=sparse_top_k,
+            knowledge_base=kwargs.get('knowledge_base'),
+            use_unidecode=kwargs.get('use_unidecode', True)
+        )
+
+    if name == 'embedding_cascade':
+        # The small model gets all the embedding options and its own cache, the large model only rescores its candidates
+        candidate_model_name = kwargs.pop('candidate_model_name', None) or 'intfloat/multilingual-e5-small'
+        candidate_cache = kwargs.pop('candidate_cache', None)
+        if candidate_cache is None and kwargs.get('cache'):
+            candidate_cache = os.path.join(os.path.dirname(os.path.normpath(kwargs['cache'])), candidate_model_name.split('/')[-1])
+        candidate_top_k = kwargs.pop('candidate_top_k', None) or 100
+        kwargs['candidate'] = retriever_factory('embedding', **{
+            **kwargs,
+            'model_name': candidate_model_name,
+            'cache': candidate_cache,
+            'top_k': candidate_top_k
+        })
+
+    if name in ('embedding', 'embedding_cascade'):
+        vct = SentenceTransformerVectorizer(
+            dir_path=kwargs.get('cache'),
+            model_handle=kwargs['model_name'],
+            max_tokens=kwargs.pop('max_tokens', None),
+            cpu_optimization=kwargs.pop('cpu_optimization', None),
+            num_threads=kwargs.pop('num_threads', None),
+            write_behind=True
+        )
         kwargs['vectorizer_document'] = vct
         kwargs['vectorizer_query'] = vct
         kwargs['device'] = 'cuda' if torch.cuda.is_available() else 'cpu'
@@ -17,6 +54,9 @@ def retriever_factory(name, **kwargs: Any) -> Retriever:
 
     retriever = {
         'bm25': BM25,
+        'bm25_native': BM25Native,
         'embedding': Embedding,
+        'embedding_cascade': EmbeddingCascade,
+        'hybrid': Hybrid,
     }[name]
     return retriever(**kwargs)
@@ -1,19 +1,20 @@
+import fcntl
 import logging
 import os
 import pandas as pd
 import pyterrier as pt
 import shutil
-import string
 import numpy as np
-from typing import Any
+from typing import Any, Dict, Iterable, List
 from unidecode import unidecode
 
+from src.retrievers.retrieval_result import LazyDocuments
 from src.retrievers.retriever import Retriever
+from src.retrievers.utils import fingerprint, normalize_query
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-
 class BM25(Retriever):
     """
     A class to represent a BM25 retriever.
@@ -23,38 +24,177 @@ class BM25(Retriever):
         top_k (int): The number of top documents to return.
         use_unidecode (bool): Whether to use unidecode.
         knowledge_base (Any): The knowledge base.
+        index_dir (str): Directory with the PyTerrier indexes. Every index is stored in a subdirectory named by the fingerprint
+            of the knowledge base and `use_unidecode`, and reused by all the runs with the same fingerprint.
+        rebuild_fraction (float): Documents added or removed after the index is created are handled by a small in-memory delta
+            index and by filtering the results. When the changes exceed this fraction of the indexed documents, the whole
+            index is recreated. Scores of the delta documents use the collection statistics of the delta index.
         
     """
-    def __init__(self, name: str = 'bm25', top_k: int = 25, use_unidecode: bool = True, knowledge_base=None, **kwargs: Any):
+    def __init__(
+            self,
+            name: str = 'bm25',
+            top_k: int = 25,
+            use_unidecode: bool = True,
+            knowledge_base=None,
+            index_dir: str = os.path.join('.', 'cache', 'pyterrier_index'),
+            rebuild_fraction: float = 0.1,
+            **kwargs: Any
+    ):
         super().__init__(name, top_k, knowledge_base=knowledge_base)
         self.use_unidecode = use_unidecode
+        self.index_dir = index_dir
+        self.rebuild_fraction = rebuild_fraction
+        self._reset_index()
+
+    def _reset_index(self):
+        self.index = None
+        self.num_indexed = 0
+        self.removed = set()
+        self.delta_documents = {}
+        self.delta_model = None
+
+    def set_knowledge_base(self, knowledge_base: Any):
+        super().set_knowledge_base(knowledge_base)
+        self._reset_index()
+
+    def _index_path(self, documents: List[tuple]) -> str:
+        key = fingerprint((f'{docno}\t{text}' for docno, text in documents), self.use_unidecode)
+        return os.path.join(self.index_dir, key)
+
+    def _documents_frame(self, documents: List[tuple]) -> pd.DataFrame:
+        docs = pd.DataFrame(documents, columns=['docno', 'text'])
+        docs['docno'] = docs['docno'].astype(str)
+
+        if self.use_unidecode:
+            docs['text'] = docs['text'].apply(unidecode)
+        return docs
+
+    def _build_index(self, documents: List[tuple], path: str) -> None:
+        """
+        Index the `documents` into a temporary directory and atomically move it to `path`, so that readers never see
+        a partially written index.
+        """
+        self.docs = self._documents_frame(documents)
+
+        tmp_path = f'{path}.tmp-{os.getpid()}'
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path)
+
+        logger.info('Creating PyTerrier index.')
+        df_indexer = pt.DFIndexer(tmp_path, verbose=True)
+        _ = df_indexer.index(self.docs['text'], self.docs['docno'])
+        os.rename(tmp_path, path)
+        logger.info(f'Index created in {path}.')
 
     def create_index(self) -> None:
         """
-        Create the PyTerrier index for the BM25 retriever.
+        Load the PyTerrier index for the knowledge base, or create it if it does not exist yet. Creation is guarded by a
+        file lock, so concurrent runs with the same knowledge base index it only once and then share it read-only.
         """
         if not pt.started():
             pt.init()
 
-        pt_index_path = os.path.join('.', 'cache', 'pyterrier_index')
-        if os.path.isdir(pt_index_path):
-            shutil.rmtree(pt_index_path)
+        documents = list(self.knowledge_base.get_documents())
+        path = self._index_path(documents)
+        properties_path = os.path.join(path, 'data.properties')
 
-        self.docs = pd.DataFrame.from_dict(
-            self.knowledge_base.get_documents())
-        self.docs.columns = ['docno', 'text']
-        self.docs['docno'] = self.docs['docno'].astype(str)
-
-        if self.use_unidecode:
-            self.docs['text'] = self.docs['text'].apply(unidecode)
+        if not os.path.isfile(properties_path):
+            os.makedirs(self.index_dir, exist_ok=True)
+            with open(f'{path}.lock', 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    # Another process might have created the index while we were waiting for the lock
+                    if not os.path.isfile(properties_path):
+                        self._build_index(documents, path)
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+        else:
+            logger.info(f'Reusing PyTerrier index {path}.')
 
-        logger.info('Creating PyTerrier index.')
-        df_indexer = pt.DFIndexer(pt_index_path, verbose=True)
-        _ = df_indexer.index(self.docs['text'], self.docs['docno'])
-        self.index = pt.IndexFactory.of(
-            os.path.join(pt_index_path, 'data.properties'))
+        self.index = pt.IndexFactory.of(properties_path)
         self.model = pt.BatchRetrieve(self.index, wmodel='BM25')
-        logger.info('Index created.')
+        self.num_indexed = len(documents)
+
+    def _update_delta(self) -> None:
+        """
+        Re-index the delta documents into an in-memory index, or drop the main index if there are too many changes, so that
+        it is recreated for the current knowledge base by the next query.
+        """
+        if len(self.delta_documents) + len(self.removed) > self.rebuild_fraction * self.num_indexed:
+            logger.info('Too many changes of the knowledge base, the PyTerrier index will be recreated.')
+            self._reset_index()
+            return
+
+        if not self.delta_documents:
+            self.delta_model = None
+            return
+
+        docs = self._documents_frame(list(self.delta_documents.items()))
+        delta_index = pt.DFIndexer('', type=pt.index.IndexingType.MEMORY).index(docs['text'], docs['docno'])
+        self.delta_model = pt.BatchRetrieve(delta_index, wmodel='BM25')
+
+    def add_documents(self, documents: Dict[int, str], **metadata: Any):
+        """
+        Add new documents to the knowledge base. Only the delta documents are re-indexed, the main index is kept.
+        """
+        if self.index is not None:
+            # Older versions of replaced documents are filtered out of the main index results
+            self.removed.update(doc_id for doc_id in documents if doc_id in self.knowledge_base.id_to_documents)
+        self.knowledge_base.add_documents(documents, **metadata)
+        if self.index is None:
+            return
+
+        self.delta_documents.update(documents)
+        self._update_delta()
+        self.prefetched = {}
+
+    def remove_documents(self, ids: Iterable[int]):
+        """
+        Remove documents from the knowledge base. Their results are filtered out of the main index.
+        """
+        ids = list(ids)
+        self.knowledge_base.remove_documents(ids)
+        if self.index is None:
+            return
+
+        self.removed.update(ids)
+        for doc_id in ids:
+            self.delta_documents.pop(doc_id, None)
+        self._update_delta()
+        self.prefetched = {}
+
+    def preprocess_query(self, query: str) -> str:
+        """
+        Prepare the query for the Terrier parser.
+        
+        Args:
+            query (str): The raw query.
+            
+        Returns:
+            str: The normalized query.
+        """
+        return normalize_query(query, self.use_unidecode)
+
+    def preprocess_queries(self, queries: List[str]) -> List[str]:
+        """
+        Prepare multiple queries for the Terrier parser. Duplicate queries are normalized only once.
+        
+        Args:
+            queries (List[str]): The raw queries.
+            
+        Returns:
+            List[str]: The normalized queries.
+        """
+        normalized = {query: self.preprocess_query(query) for query in dict.fromkeys(queries)}
+        return [normalized[query] for query in queries]
+
+    def _to_output(self, docnos: List[int]) -> tuple:
+        if self.top_k is not None:
+            docnos = docnos[:self.top_k]
+
+        # Texts are fetched only if they are read, e.g. not when an embedding retriever re-ranks the candidates by their ids
+        return LazyDocuments(self.knowledge_base, docnos), docnos
 
     def retrieve(self, query: str) -> tuple:
         """
@@ -66,32 +206,63 @@ class BM25(Retriever):
         Returns:
             tuple: The top-k texts and their ids.
         """
-        if not hasattr(self, 'index'):
-            self.create_index()
+        docnos, _ = self._transform_batch([query])[0]
+        return self._to_output(docnos)
 
-        # Transform non-ascii characters into ascii
-        if self.use_unidecode:
-            query = unidecode(query)
-
-        # Remove punctuation because of Terrier parser
-        query = ''.join(
-            ch for ch in query if ch not in string.punctuation).strip()
-
-        # Hand empty text cases
-        if not query:
-            query = 'unk'
+    def _transform_batch(self, queries: List[str]) -> List[tuple]:
+        """
+        Run a single PyTerrier transform for all the `queries`. Return the ranked document ids and BM25 scores for each query.
+        """
+        if self.index is None:
+            self.create_index()
 
-        query = pd.DataFrame({'qid': [0], 'query': [query]})
+        query = pd.DataFrame({
+            'qid': [str(qid) for qid in range(len(queries))],
+            'query': self.preprocess_queries(queries),
+        })
         result = self.model.transform(query)
+        if self.removed:
+            result = result[~result['docno'].astype(int).isin(self.removed)]
+        if self.delta_model is not None:
+            result = pd.concat([result, self.delta_model.transform(query)])
+        result = result.sort_values(['qid', 'score'], ascending=[True, False], kind='stable')
 
-        if self.top_k is None:
-            top_k = list(result['docno'].astype(int))
-        else:
-            top_k = list(result['docno'].astype(int))[:self.top_k]
+        groups = {
+            qid: (list(group['docno'].astype(int)), group['score'].to_numpy())
+            for qid, group in result.groupby('qid', sort=False)
+        }
 
-        top_k_texts = [
-            self.knowledge_base.get_document(fc_id)
-            for fc_id in top_k
+        return [
+            groups.get(str(qid), ([], np.zeros(0)))
+            for qid in range(len(queries))
         ]
 
-        return top_k_texts, top_k
+    def retrieve_batch(self, queries: List[str]) -> List[tuple]:
+        """
+        Retrieve documents for multiple queries with a single PyTerrier transform.
+        
+        Args:
+            queries (List[str]): The queries to retrieve documents.
+            
+        Returns:
+            List[tuple]: The top-k texts and their ids for each query.
+        """
+        return [
+            self._to_output(docnos)
+            for docnos, _ in self._transform_batch(queries)
+        ]
+
+    def retrieve_scored(self, queries: List[str]) -> List[tuple]:
+        """
+        Retrieve the top-k document ids together with their BM25 scores for multiple queries.
+        
+        Args:
+            queries (List[str]): The queries to retrieve documents.
+            
+        Returns:
+            List[tuple]: The top-k ids and their scores for each query.
+        """
+        return [
+            (docnos[:self.top_k], scores[:self.top_k]) if self.top_k is not None else (docnos, scores)
+            for docnos, scores in self._transform_batch(queries)
+        ]
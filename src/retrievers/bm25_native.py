@@ -0,0 +1,314 @@
+import json
+import logging
+import os
+import re
+from functools import lru_cache
+from typing import Any, Dict, Iterable, List, Tuple
+
+import nltk
+from nltk.corpus import stopwords
+from nltk.stem import PorterStemmer
+import numpy as np
+import scipy.sparse as sp
+from unidecode import unidecode
+
+from src.retrievers.retrieval_result import LazyDocuments
+from src.retrievers.retriever import Retriever
+from src.retrievers.utils import fingerprint, normalize_query, publish_directory
+
+nltk.download('stopwords', quiet=True)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+TOKEN_PATTERN = re.compile(r'[a-z0-9]+')
+STEMMER = PorterStemmer()
+STOPWORDS = frozenset(stopwords.words('english'))
+
+
+@lru_cache(maxsize=1000000)
+def stem(token: str) -> str:
+    return STEMMER.stem(token)
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Split a normalized text into lowercased, stemmed terms without stopwords, similarly to the default Terrier pipeline.
+    """
+    return [
+        stem(token)
+        for token in TOKEN_PATTERN.findall(text.lower())
+        if token not in STOPWORDS
+    ]
+
+
+class BM25Native(Retriever):
+    """
+    In-process BM25 retriever over a sparse term-document matrix. It does not need PyTerrier or a JVM and it uses the same
+    text normalization as `BM25`, so the two can be used interchangeably.
+
+    The index is a CSR matrix (`N x V`) with precomputed BM25 weights of every term in every document, following the Terrier
+    formula. Queries are converted into sparse term weight vectors and scored with one sparse matrix multiplication per batch,
+    only the documents sharing a term with the query are ranked. The index is stored in `index_dir` under the fingerprint of
+    the knowledge base and the settings, and reused by all the runs with the same fingerprint.
+
+    Attributes:
+        name (str): The name of the retriever.
+        top_k (int): The number of top documents to return.
+        use_unidecode (bool): Whether to use unidecode.
+        knowledge_base (Any): The knowledge base.
+        k1 (float): Term frequency saturation.
+        b (float): Document length normalization.
+        k3 (float): Query term frequency saturation.
+        index_dir (str): Directory with the persisted indexes.
+        query_batch_size (int): Number of queries scored together.
+        rebuild_fraction (float): Documents added after the index is created are appended as new rows weighted with the
+            collection statistics of the index, removed ones are masked. When the changes exceed this fraction of the indexed
+            documents, the index is rebuilt.
+    """
+    def __init__(
+            self,
+            name: str = 'bm25_native',
+            top_k: int = 25,
+            use_unidecode: bool = True,
+            knowledge_base: Any = None,
+            k1: float = 1.2,
+            b: float = 0.75,
+            k3: float = 8.0,
+            index_dir: str = os.path.join('.', 'cache', 'bm25_native_index'),
+            query_batch_size: int = 1024,
+            rebuild_fraction: float = 0.1,
+            **kwargs: Any
+    ):
+        super().__init__(name, top_k, knowledge_base=knowledge_base)
+        self.use_unidecode = use_unidecode
+        self.k1 = k1
+        self.b = b
+        self.k3 = k3
+        self.index_dir = index_dir
+        self.query_batch_size = query_batch_size
+        self.rebuild_fraction = rebuild_fraction
+
+        self.weights = None
+        self.term_weights = None
+        self.vocabulary = None
+        self.docnos = None
+        self.idf = None
+        self.average_length = None
+        self.num_indexed = 0
+        self.num_changes = 0
+        self.removed = None
+
+    def set_knowledge_base(self, knowledge_base: Any):
+        super().set_knowledge_base(knowledge_base)
+        self.weights = None
+
+    def _term_frequencies(self, documents: List[Tuple[int, str]]) -> Tuple[sp.csr_matrix, np.ndarray]:
+        """
+        Count the terms of the `documents` into a sparse matrix (`N x V`), new terms are added to the vocabulary. Return the
+        matrix and the lengths of the documents.
+        """
+        rows, cols, counts = [], [], []
+        lengths = np.zeros(len(documents), dtype=np.float64)
+
+        for row, (_, text) in enumerate(documents):
+            # Documents are tokenized as they are, queries without punctuation, the same way as in `BM25`
+            terms = tokenize(unidecode(text) if self.use_unidecode else text)
+            lengths[row] = len(terms)
+            term_counts = {}
+            for term in terms:
+                col = self.vocabulary.setdefault(term, len(self.vocabulary))
+                term_counts[col] = term_counts.get(col, 0) + 1
+            rows.extend([row] * len(term_counts))
+            cols.extend(term_counts.keys())
+            counts.extend(term_counts.values())
+
+        tf = sp.csr_matrix(
+            (np.array(counts, dtype=np.float64), (np.array(rows, dtype=np.int64), np.array(cols, dtype=np.int64))),
+            shape=(len(documents), len(self.vocabulary))
+        )
+        return tf, lengths
+
+    def _idf(self, document_frequency: np.ndarray, num_documents: int) -> np.ndarray:
+        return np.log2((num_documents - document_frequency + 0.5) / (document_frequency + 0.5))
+
+    def _bm25_weights(self, tf: sp.csr_matrix, lengths: np.ndarray) -> sp.csr_matrix:
+        norm = self.k1 * ((1 - self.b) + self.b * lengths / max(self.average_length, 1e-9))
+        # Per non-zero entry: (k1 + 1) * tf / (K_d + tf) * idf_t
+        row_norm = np.repeat(norm, np.diff(tf.indptr))
+        tf.data = (self.k1 + 1) * tf.data / (row_norm + tf.data) * self.idf[tf.indices]
+        return tf.astype(np.float32)
+
+    def build_index(self, documents: List[Tuple[int, str]]):
+        """
+        Calculate the BM25 weight matrix for the `documents` (id, text pairs).
+        """
+        self.vocabulary = {}
+        tf, lengths = self._term_frequencies(documents)
+
+        self.idf = self._idf(np.bincount(tf.indices, minlength=len(self.vocabulary)), len(documents))
+        self.average_length = float(lengths.mean()) if len(documents) else 0.0
+        self._set_weights(self._bm25_weights(tf, lengths))
+        self.docnos = np.array([doc_id for doc_id, _ in documents])
+        self._reset_changes()
+
+    def _reset_changes(self):
+        self.num_indexed = len(self.docnos)
+        self.num_changes = 0
+        self.removed = np.zeros(len(self.docnos), dtype=bool)
+
+    def _set_weights(self, weights: sp.csr_matrix):
+        self.weights = weights
+        # Term-major copy (`V x N`), so that query batches are multiplied without converting the matrix every time
+        self.term_weights = weights.T.tocsr()
+
+    def _index_path(self, documents: List[Tuple[int, str]]) -> str:
+        key = fingerprint((f'{docno}\t{text}' for docno, text in documents), self.use_unidecode, self.k1, self.b, 'statistics')
+        return os.path.join(self.index_dir, key)
+
+    def save(self, path: str):
+        """
+        Store the index in `path`. The files are written into a temporary directory which is then renamed, so readers never
+        see a partially written index.
+        """
+        tmp_path = f'{path}.tmp-{os.getpid()}'
+        os.makedirs(tmp_path, exist_ok=True)
+        sp.save_npz(os.path.join(tmp_path, 'weights.npz'), self.weights)
+        np.save(os.path.join(tmp_path, 'docnos.npy'), self.docnos)
+        np.save(os.path.join(tmp_path, 'idf.npy'), self.idf)
+        with open(os.path.join(tmp_path, 'vocabulary.json'), 'w', encoding='utf8') as f:
+            json.dump({'vocabulary': self.vocabulary, 'average_length': self.average_length}, f)
+        publish_directory(tmp_path, path)
+
+    def load(self, path: str):
+        self._set_weights(sp.load_npz(os.path.join(path, 'weights.npz')).tocsr())
+        self.docnos = np.load(os.path.join(path, 'docnos.npy'))
+        self.idf = np.load(os.path.join(path, 'idf.npy'))
+        with open(os.path.join(path, 'vocabulary.json'), 'r', encoding='utf8') as f:
+            statistics = json.load(f)
+        self.vocabulary = statistics['vocabulary']
+        self.average_length = statistics['average_length']
+        self._reset_changes()
+
+    def create_index(self):
+        """
+        Load the index for the knowledge base, or build and store it if it does not exist yet.
+        """
+        documents = list(self.knowledge_base.get_documents())
+        path = self._index_path(documents)
+
+        if os.path.isdir(path):
+            self.load(path)
+            logger.info(f'Reusing BM25 index {path}.')
+            return
+
+        logger.info('Creating BM25 index.')
+        self.build_index(documents)
+        os.makedirs(self.index_dir, exist_ok=True)
+        self.save(path)
+        logger.info(f'Index with {self.weights.shape[0]} documents and {self.weights.shape[1]} terms created in {path}.')
+
+    def _count_changes(self, num_changes: int) -> bool:
+        """
+        Count the changes of the index. Drop the index if there are too many of them, so that it is rebuilt for the current
+        knowledge base by the next query, and return whether it was dropped.
+        """
+        self.num_changes += num_changes
+        if self.num_changes > self.rebuild_fraction * self.num_indexed:
+            logger.info('Too many changes of the knowledge base, the BM25 index will be rebuilt.')
+            self.weights = None
+            self.term_weights = None
+            return True
+        return False
+
+    def _remove_rows(self, ids: List[int]):
+        self.removed |= np.isin(self.docnos, ids)
+
+    def add_documents(self, documents: Dict[int, str], **metadata: Any):
+        """
+        Add new documents to the knowledge base. They are weighted with the idf and the average length of the indexed
+        collection, terms unknown to the index get the idf of a term occurring in the new documents only.
+        """
+        self.knowledge_base.add_documents(documents, **metadata)
+        if self.weights is None or self._count_changes(len(documents)):
+            return
+
+        # Older versions of replaced documents are masked
+        self._remove_rows(list(documents.keys()))
+        num_terms = len(self.vocabulary)
+        tf, lengths = self._term_frequencies(list(documents.items()))
+
+        new_frequency = np.bincount(tf.indices, minlength=len(self.vocabulary))[num_terms:]
+        self.idf = np.concatenate([self.idf, self._idf(new_frequency, self.num_indexed)])
+        weights = self.weights
+        weights = sp.csr_matrix((weights.data, weights.indices, weights.indptr), shape=(weights.shape[0], len(self.vocabulary)))
+
+        self._set_weights(sp.vstack([weights, self._bm25_weights(tf, lengths)], format='csr'))
+        self.docnos = np.concatenate([self.docnos, np.array(list(documents.keys()))])
+        self.removed = np.concatenate([self.removed, np.zeros(len(documents), dtype=bool)])
+
+    def remove_documents(self, ids: Iterable[int]):
+        """
+        Remove documents from the knowledge base. Their rows are masked in the results.
+        """
+        ids = list(ids)
+        self.knowledge_base.remove_documents(ids)
+        if self.weights is None or self._count_changes(len(ids)):
+            return
+        self._remove_rows(ids)
+
+    def _query_matrix(self, queries: List[str]) -> sp.csr_matrix:
+        """
+        Convert the `queries` into a sparse matrix (`Q x V`) of query term weights. Terms unknown to the index are dropped.
+        """
+        rows, cols, counts = [], [], []
+        for row, query in enumerate(queries):
+            term_counts: Dict[int, int] = {}
+            for term in tokenize(normalize_query(query, self.use_unidecode)):
+                col = self.vocabulary.get(term)
+                if col is not None:
+                    term_counts[col] = term_counts.get(col, 0) + 1
+            rows.extend([row] * len(term_counts))
+            cols.extend(term_counts.keys())
+            counts.extend(term_counts.values())
+
+        counts = np.array(counts, dtype=np.float32)
+        return sp.csr_matrix(
+            ((self.k3 + 1) * counts / (self.k3 + counts), (np.array(rows, dtype=np.int64), np.array(cols, dtype=np.int64))),
+            shape=(len(queries), len(self.vocabulary))
+        )
+
+    def retrieve_scored(self, queries: List[str]) -> List[Tuple[List[int], np.ndarray]]:
+        """
+        Score all the `queries` with sparse matrix multiplications and select the `top_k` documents of each of them.
+        """
+        if self.weights is None:
+            self.create_index()
+
+        results = []
+        for start in range(0, len(queries), self.query_batch_size):
+            scores = (self._query_matrix(queries[start:start + self.query_batch_size]) @ self.term_weights).tocsr()
+            for row in range(scores.shape[0]):
+                row_scores = scores.data[scores.indptr[row]:scores.indptr[row + 1]]
+                row_documents = scores.indices[scores.indptr[row]:scores.indptr[row + 1]]
+                if self.num_changes:
+                    keep = ~self.removed[row_documents]
+                    row_scores, row_documents = row_scores[keep], row_documents[keep]
+
+                if self.top_k is not None and len(row_scores) > self.top_k:
+                    selected = np.argpartition(-row_scores, self.top_k - 1)[:self.top_k]
+                    row_scores, row_documents = row_scores[selected], row_documents[selected]
+
+                order = np.argsort(-row_scores, kind='stable')
+                results.append((self.docnos[row_documents[order]].tolist(), row_scores[order]))
+
+        return results
+
+    def retrieve_batch(self, queries: List[str]) -> List[Any]:
+        return [
+            (LazyDocuments(self.knowledge_base, ids), ids)
+            for ids, _ in self.retrieve_scored(queries)
+        ]
+
+    def retrieve(self, query: str) -> Any:
+        return self.retrieve_batch([query])[0]
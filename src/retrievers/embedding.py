@@ -1,75 +1,76 @@
+import json
 import logging
-from typing import Any, List, Generator, Tuple
-from nltk.tokenize import sent_tokenize
+import os
+import time
+from typing import Any, Dict, Iterable, List, Tuple, Union
+import numpy as np
 import torch
-from torch_scatter import scatter
-import nltk
 
-from src.datasets.cleaning import replace_stops, replace_whitespaces
+from src.retrievers.indexes.date_index import DateIndex
+from src.retrievers.indexes.ivf_index import IVFIndex
+from src.retrievers.indexes.projection import Projection
+from src.retrievers.indexes.quantized_matrix import QuantizedMatrix
+from src.retrievers.indexes.shared_arrays import SharedArrays
+from src.retrievers.indexes.sharded_matrix import ShardedMatrix
+from src.retrievers.retrieval_result import RetrievalResult
 from src.retrievers.retriever import Retriever
+from src.retrievers.sliding_window import gen_sliding_window_delimiters, pool_windows, split_windows
+from src.retrievers.utils import append_rows, fingerprint
 from src.retrievers.vectorizers.vectorizer import Vectorizer
 
-nltk.download('punkt')
-
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-def slice_text(text, window_type, window_size, window_stride=None) -> List[str]:
+class Embedding(Retriever):
     """
-    Split a `text` into parts using a sliding window. The windows slides either across characters or sentences, based on the value of `window_tyoe`.
+    A class to represent a dense retriever based on embeddings of the queries and documents.
 
     Attributes:
-        text: str  Text that is to be splitted into windows.
-        window_type: str  Either `sentence` or `character`. The basic unit of the windows.
-        window_size: int  How many units are in a window.
-        window_stride: int  How many units are skipped each time the window moves.
-    """
-
-    text = replace_whitespaces(text)
-
-    if window_stride is None:
-        window_stride = window_size
-
-    if window_size < window_stride:
-        logger.warning(
-            f'Window size ({window_size}) is smaller than stride length ({window_stride}). This will result in missing chunks of text.')
+        index (str): Type of the document index. `exact` scores all documents, `ivf` uses an approximate `IVFIndex`, `sharded`
+            scores all documents stored on disk in memory-mapped shards next to the vectorizer cache, see `ShardedMatrix`.
+        index_nlist (int): Number of IVF clusters. `None` means square root of the knowledge base size.
+        index_nprobe (int): Number of IVF clusters probed for each query.
+        index_recall_sample (int): Number of documents used as queries to estimate the recall of the index after it is built. The
+            estimate is skipped when the index is loaded from the cache.
+        index_shard_size (int): Number of documents in one shard of the `sharded` index.
+        index_block_size (int): Number of documents scored at once by one thread of the `sharded` index. Bounds the peak memory.
+        index_threads (int): Number of shards of the `sharded` index scored in parallel.
+        query_split_size (int): Maximum number of sliding windows scored together. Windows of one query are never split.
+        query_batch_size (int): Number of queries scored together in `retrieve_batch`. Limits the size of the similarity matrix.
+        quantization (str): Store the document matrix as `int8`, `fp16` or `bf16`, see `QuantizedMatrix`. `None` keeps it in `dtype`.
+        projection (str): Score documents and queries in a reduced space, `pca` or `truncate`, see `Projection`. `None` keeps the
+            full dimension of the vectorizer.
+        projection_dim (int): Number of dimensions after the projection.
+        rescore (bool): Rescore the best candidates of the quantized matrix or the projected space with the full precision vectors
+            from the vectorizer cache, also with the `ivf` index.
+        rescore_factor (int): Number of candidates rescored for each of the `top_k` documents.
+        deduplicate (bool): Store one row of the document matrix for each unique document text. Documents with the same text
+            share the row and get the same similarity, so the results are the same as without deduplication.
+        position_rows (torch.tensor): Row of the document matrix for each position in the knowledge base, if `deduplicate` is set.
+        passages (bool): Index passages of the documents instead of whole documents. Documents are split by the knowledge base
+            (`doc_sent_count` sentences with `overlap`, see `Dataset.split_passages`), every passage is a row of the document
+            matrix and the similarities of the passages are pooled into one score per document.
+        passage_pooling (str): Pooling of the passage similarities, `max` or `mean`.
+        passage_segments (torch.tensor): Position of the document of each passage, if `passages` is set.
+        shared_index_dir (str): Directory where the built document matrix is published for other processes, see `SharedArrays`.
+            Processes with the same knowledge base and settings attach to the published matrix instead of building their own copy.
+            Use a directory in `/dev/shm` to keep the matrix in RAM.
+        window_days_before (float): Retrieve only documents published at most this many days before the query date. `None`
+            means no limit. The query date is passed to `retrieve` as `query_date`, see `DateIndex`.
+        window_days_after (float): Retrieve only documents published at most this many days after the query date, e.g. `0`
+            excludes claims debunked after the post appeared. `None` means no limit.
+        document_mask (torch.tensor): Boolean mask over the knowledge base. Only documents with `True` are retrieved. See
+            `set_document_filter` and `set_language_filter`.
+        candidate_positions (torch.tensor): Positions of the documents selected by a previous retriever in a chain. Only these
+            rows of the document matrix are scored. See `set_candidates`.
+        removed (torch.tensor): Boolean mask of the positions removed by `remove_documents` or replaced by `add_documents`.
+            Removed rows stay in the document matrix and are never retrieved.
 
-    if window_type == 'sentence':
-        text = replace_stops(text)
-        sentences = sent_tokenize(text)
-        return [
-            ' '.join(sentences[i:i+window_size])
-            for i in range(0, len(sentences), window_stride)
-        ]
-
-    elif window_type == 'character':
-        return [
-            text[i:i+window_size]
-            for i in range(0, len(text), window_stride)
-        ]
-
-
-def gen_sliding_window_delimiters(post_lengths: List[int], max_size: int) -> Generator[Tuple[int, int], None, None]:
-    """
-    Calculate where to split the sequence of `post_lenghts` so that the individual batches do not exceed `max_size`
+        See `__init__` for the remaining attributes.
     """
-    range_length = start = cur_sum = 0
-
-    for post_length in post_lengths:
-        if (range_length + post_length) > max_size:  # exceeds memory
-            yield (start, start + range_length)
-            start = cur_sum
-            range_length = post_length
-        else:  # memory still avail in current split
-            range_length += post_length
-        cur_sum += post_length
-
-    if range_length > 0:
-        yield (start, start + range_length)
+    supports_dates = True
 
-
-class Embedding(Retriever):
     def __init__(
             self,
             name: str = 'embedding',
@@ -81,11 +82,30 @@ class Embedding(Retriever):
             sliding_window_size: int = None,
             sliding_window_stride: int = None,
             sliding_window_type: str = None,
-            query_split_size: int = 1,
+            query_split_size: int = 256,
             dtype: torch.dtype = torch.float32,
             device: str = 'cpu',
             save_if_missing: bool = False,
             knowledge_base: Any = None,
+            index: str = 'exact',
+            index_nlist: int = None,
+            index_nprobe: int = 8,
+            index_recall_sample: int = 1000,
+            index_shard_size: int = 1000000,
+            index_block_size: int = 65536,
+            index_threads: int = 4,
+            query_batch_size: int = 256,
+            quantization: str = None,
+            rescore: bool = True,
+            rescore_factor: int = 4,
+            projection: str = None,
+            projection_dim: int = 256,
+            deduplicate: bool = False,
+            passages: bool = False,
+            passage_pooling: str = 'max',
+            shared_index_dir: str = None,
+            window_days_before: float = None,
+            window_days_after: float = None,
             **kwargs: Any
     ):
         super().__init__(name, top_k, knowledge_base=knowledge_base)
@@ -102,158 +122,920 @@ class Embedding(Retriever):
         self.save_if_missing = save_if_missing
         self.document_embeddings = None
 
+        assert index in ('exact', 'ivf', 'sharded')
+        self.index = index
+        self.index_nlist = index_nlist
+        self.index_nprobe = index_nprobe
+        self.index_recall_sample = index_recall_sample
+        self.index_shard_size = index_shard_size
+        self.index_block_size = index_block_size
+        self.index_threads = index_threads
+        self.ann_index = None
+        self.sharded = None
+        self.query_batch_size = query_batch_size
+
+        assert quantization in (None, *QuantizedMatrix.dtypes)
+        assert quantization is None or index == 'exact', 'Quantization is supported only with the exact index.'
+        self.quantization = quantization
+        self.rescore = rescore
+        self.rescore_factor = rescore_factor
+        self.quantized = None
+
+        assert projection in (None, *Projection.modes)
+        self.projection = projection
+        self.projection_dim = projection_dim
+        self.projector = None
+
+        assert not deduplicate or index == 'exact', 'Deduplication is supported only with the exact index.'
+        self.deduplicate = deduplicate
+        self.position_rows = None
+        self.text_to_row = None
+        self.num_rows = 0
+
+        assert not passages or (index == 'exact' and not deduplicate), 'Passages are supported only with the exact index.'
+        self.passages = passages
+        self.passage_pooling = passage_pooling
+        self.passage_segments = None
+        self.passage_offsets = None
+
+        assert shared_index_dir is None or (index == 'exact' and quantization is None and dtype in (torch.float32, torch.float16)), \
+            'Shared index is supported only for the exact index with float32 or float16 document matrix.'
+        self.shared_index_dir = shared_index_dir
+
+        self.window_days_before = window_days_before
+        self.window_days_after = window_days_after
+        self.date_index = None
+
+        self.document_texts = None
+        self.document_ids = None
+        self.id_to_position = None
+        self.document_rows = None
+        self.num_documents = 0
+
+        self.document_mask = None
+        self.candidate_positions = None
+        self.removed = None
+        self.language_masks = {}
+
+    def _index_path(self, texts: List[str]) -> str:
+        """
+        Path of the persisted index. Indexes are stored next to the vectorizer cache and keyed by the knowledge base contents.
+        """
+        if not self.vectorizer_document.dir_path:
+            return None
+
+        params = [self.index, self.index_nlist]
+        if self.projection:
+            params += [self.projection, self.projection_dim]
+        key = fingerprint(texts, *params)
+        return os.path.join(self.vectorizer_document.dir_path, 'indexes', f'{self.index}-{key}.pt')
+
+    def fit_projection(self, texts: List[str], document_embeddings: torch.tensor = None):
+        """
+        Fit or load the projection for the `document_embeddings` (`N x D`). PCA components are stored next to the vectorizer cache
+        and keyed by the knowledge base contents. Without `document_embeddings`, the projection is fitted on a sample of the `texts`.
+        """
+        self.projector = Projection(self.projection, self.projection_dim)
+        path = None
+        if self.projection == 'pca' and self.vectorizer_document.dir_path:
+            key = fingerprint(texts, self.projection_dim)
+            path = os.path.join(self.vectorizer_document.dir_path, 'projections', f'pca-{key}.pt')
+
+        if path and os.path.isfile(path):
+            self.projector.load(path)
+            logger.info(f'Projection loaded from {path}')
+            return
+
+        if document_embeddings is None:
+            if self.projection == 'truncate':
+                # Nothing to fit
+                return
+            generator = torch.Generator().manual_seed(1)
+            sample = torch.randperm(len(texts), generator=generator)[:self.projector.max_train_points].tolist()
+            document_embeddings = self.vectorizer_document.vectorize(
+                [texts[i] for i in sample],
+                save_if_missing=self.save_if_missing,
+                normalize=True
+            )
+        self.projector.fit(document_embeddings)
+        if path:
+            self.projector.save(path)
+            logger.info(f'Projection saved to {path}')
+
+    def load_passages(self, texts: List[str]) -> Tuple[List[str], List[int]]:
+        """
+        Split the document `texts` into passages with `Dataset.split_passages`. Passage tables are stored next to the vectorizer
+        cache and keyed by the knowledge base contents and the chunking settings, so each setting is chunked only once. The
+        vectors of the passages are cached by the vectorizer as any other texts.
+        """
+        path = None
+        if self.vectorizer_document.dir_path:
+            key = fingerprint(texts, self.knowledge_base.doc_sent_count, self.knowledge_base.overlap)
+            path = os.path.join(self.vectorizer_document.dir_path, 'passages', f'{key}.json')
+
+        if path and os.path.isfile(path):
+            with open(path, 'r', encoding='utf8') as f:
+                table = json.load(f)
+            logger.info(f'Passages loaded from {path}')
+            return table['passages'], table['segments']
+
+        passages, segments = self.knowledge_base.split_passages(texts)
+        logger.info(f'{len(texts)} documents split into {len(passages)} passages')
+        if path:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + '.tmp', 'w', encoding='utf8') as f:
+                json.dump({'passages': passages, 'segments': segments}, f)
+            os.replace(path + '.tmp', path)
+        return passages, segments
+
+    def _set_passage_segments(self, segments: torch.tensor):
+        self.passage_segments = segments
+        self.passage_offsets = torch.zeros(self.num_documents + 1, dtype=torch.long)
+        self.passage_offsets[1:] = torch.cumsum(torch.bincount(segments, minlength=self.num_documents), dim=0)
+
+    def _passage_rows(self, positions: torch.tensor) -> Tuple[torch.tensor, torch.tensor]:
+        """
+        Rows of the passages of the documents at `positions` and the index of their document within `positions`.
+        """
+        starts = self.passage_offsets[positions]
+        counts = self.passage_offsets[positions + 1] - starts
+        segments = torch.repeat_interleave(torch.arange(len(positions)), counts)
+        first = torch.repeat_interleave(torch.cumsum(counts, dim=0) - counts, counts)
+        rows = torch.repeat_interleave(starts, counts) + torch.arange(len(segments)) - first
+        return rows, segments
+
+    def build_sharded(self, texts: List[str]):
+        """
+        Load the sharded document matrix, or write it shard by shard, so that at most `index_shard_size` vectors are in memory
+        at once. The matrix is stored next to the vectorizer cache and keyed by the knowledge base contents.
+        """
+        assert self.vectorizer_document.dir_path, 'Sharded index needs the vectorizer cache directory.'
+        params = [self.projection, self.projection_dim] if self.projection else []
+        path = os.path.join(self.vectorizer_document.dir_path, 'shards', fingerprint(texts, *params))
+        self.sharded = ShardedMatrix(path, block_size=self.index_block_size, num_threads=self.index_threads)
+
+        if self.projection:
+            self.fit_projection(texts)
+
+        if self.sharded.open():
+            logger.info(f'Sharded document matrix loaded from {path}')
+            return
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.sharded.build(
+            self._project(self.vectorizer_document.vectorize(
+                texts[start:start + self.index_shard_size],
+                save_if_missing=self.save_if_missing,
+                normalize=True
+            ))
+            for start in range(0, len(texts), self.index_shard_size)
+        )
+        logger.info(f'Sharded document matrix with {len(self.sharded.shards)} shards ({self.sharded.nbytes / 2**20:.1f} MB) saved to {path}')
+
+    def _has_embeddings(self) -> bool:
+        return self.document_embeddings is not None or self.quantized is not None or self.sharded is not None
+
+    def _get_rows(self, positions: torch.tensor) -> torch.tensor:
+        """
+        Float vectors of the documents at `positions` from the document matrix. Used by the approximate index.
+        """
+        return self.document_rows.index_select(0, positions.to(self.document_rows.device)).float().cpu()
+
+    def _uses_rescore(self) -> bool:
+        """
+        Whether the best candidates are rescored with the full precision vectors. Rescoring uses the vectors of whole documents,
+        so it is not used with passages.
+        """
+        return (self.quantized is not None or self.projector is not None) and self.rescore and self.passage_segments is None
+
+    def _project(self, embeddings: torch.tensor) -> torch.tensor:
+        """
+        Project document or query `embeddings` into the reduced space, if the projection is enabled.
+        """
+        if self.projector is None:
+            return embeddings
+        return self.projector.transform(embeddings)
+
+    def build_index(self, texts: List[str], document_embeddings: torch.tensor):
+        """
+        Build or load the approximate nearest-neighbour index for the `document_embeddings` (`N x D`) and estimate its recall.
+        """
+        self.ann_index = IVFIndex(self._get_rows, nlist=self.index_nlist, nprobe=self.index_nprobe)
+        path = self._index_path(texts)
+
+        if path and os.path.isfile(path):
+            self.ann_index.load(path, document_embeddings)
+            logger.info(f'Index loaded from {path}')
+            return
+
+        self.ann_index.build(document_embeddings)
+        if path:
+            self.ann_index.save(path)
+            logger.info(f'Index saved to {path}')
+
+        # Estimated only after a build, a loaded index has been checked when it was built
+        if self.index_recall_sample:
+            generator = torch.Generator().manual_seed(1)
+            sample = torch.randperm(len(document_embeddings), generator=generator)[:self.index_recall_sample]
+            top_k = self.top_k or 10
+            recall = self.ann_index.recall(document_embeddings[sample].float(), document_embeddings, top_k)
+            logger.info(f'Index recall@{top_k} on {len(sample)} sampled documents: {recall:.4f}')
+
+    def evaluate_index(self, queries: List[str], top_k: int = None) -> Dict[str, float]:
+        """
+        Compare the approximate index with the exact search for real `queries`. Return recall@`top_k` of the index and
+        the average per-query latency of both search paths in seconds.
+        """
+        self._maybe_calculate_embeddings()
+        assert self.ann_index is not None, 'Approximate index is not enabled for this retriever.'
+
+        top_k = top_k or self.top_k or 10
+        query_embeddings = self._project(self.vectorizer_query.vectorize(
+            queries,
+            save_if_missing=self.save_if_missing,
+            normalize=True
+        )).float()
+        document_embeddings = self.document_embeddings.float().cpu()
+
+        start = time.perf_counter()
+        for query in query_embeddings:
+            torch.topk(torch.mm(query.unsqueeze(0), document_embeddings), k=top_k, dim=1)
+        exact_latency = (time.perf_counter() - start) / len(queries)
+
+        start = time.perf_counter()
+        self.ann_index.search(query_embeddings, top_k)
+        index_latency = (time.perf_counter() - start) / len(queries)
+
+        results = {
+            'recall': self.ann_index.recall(query_embeddings, document_embeddings.transpose(0, 1), top_k),
+            'exact_latency': exact_latency,
+            'index_latency': index_latency,
+        }
+        logger.info(f'Index evaluation on {len(queries)} queries: {results}')
+        return results
+
     def calculate_embeddings(self):
         # logger.info('Calculating embeddings for fact checks')
+        texts = self.knowledge_base.get_documents_texts()
+        self.document_texts = texts
+        # Positions of the documents are fixed from now on, `add_documents` and `remove_documents` keep them stable
+        id_to_documents = getattr(self.knowledge_base, 'id_to_documents', None)
+        self.document_ids = np.array(list(id_to_documents.keys())) if id_to_documents is not None else None
+        self.id_to_position = None
+        self.num_documents = len(texts)
+        self.document_mask = None
+        self.candidate_positions = None
+        self.removed = None
+        self.language_masks = {}
+        self.sharded = None
+        self.position_rows = None
+        self.passage_segments = None
+        self.date_index = None
+        self.num_rows = len(texts)
+
+        if self.shared_index_dir and self._attach_shared(texts):
+            return
+
+        if self.index == 'sharded':
+            # The whole matrix is never loaded, the vectors are streamed into the shards
+            self.document_embeddings = None
+            self.document_rows = None
+            self.build_sharded(texts)
+            return
+
+        matrix_texts = texts
+        if self.deduplicate:
+            matrix_texts, rows = self.knowledge_base.get_unique_documents()
+            self.position_rows = torch.tensor(rows, dtype=torch.long)
+            self.text_to_row = {text: row for row, text in enumerate(matrix_texts)}
+            self.num_rows = len(matrix_texts)
+            logger.info(f'Knowledge base deduplicated: {len(texts)} documents -> {len(matrix_texts)} unique texts '
+                        f'({1 - len(matrix_texts) / max(len(texts), 1):.1%} fewer rows)')
+        elif self.passages:
+            matrix_texts, segments = self.load_passages(texts)
+            self._set_passage_segments(torch.tensor(segments, dtype=torch.long))
+            self.num_rows = len(matrix_texts)
+
         document_embeddings = self.vectorizer_document.vectorize(
-            self.knowledge_base.get_documents_texts(),
+            matrix_texts,
             save_if_missing=self.save_if_missing,
             normalize=True
         )
 
-        document_embeddings = document_embeddings.transpose(
-            0, 1)  # Rotate for matmul
+        if self.projection:
+            self.fit_projection(matrix_texts, document_embeddings)
+            logger.info(f'Documents projected with {self.projection} from {document_embeddings.shape[1]} to {self.projection_dim} dimensions')
+            document_embeddings = self._project(document_embeddings)
 
-        self.document_embeddings = document_embeddings.to(
-            device=self.device, dtype=self.dtype)
+        if self.quantization:
+            self.quantized = QuantizedMatrix(document_embeddings, self.quantization).to(self.device)
+            self.document_embeddings = None
+            logger.info(
+                f'Document matrix stored as {self.quantization}: '
+                f'{self.quantized.full_nbytes / 2**20:.1f} MB -> {self.quantized.nbytes / 2**20:.1f} MB')
+            return
 
-    def set_knowledge_base(self, knowledge_base: Any):
-        self.knowledge_base = knowledge_base
-        self.calculate_embeddings()
-        
-    def retrieve_sims(self, query: str) -> Any:
-        if self.document_embeddings is None:
+        # Rows are kept in a growable `N x D` storage, the matrix used for matmul is its rotated view
+        self.document_rows = document_embeddings.to(device=self.device, dtype=self.dtype).contiguous()
+        self.document_embeddings = self.document_rows[:self.num_rows].transpose(0, 1)
+        if self.index == 'ivf':
+            # Built after the document matrix, the index gathers the vectors of the probed lists from it
+            self.build_index(texts, document_embeddings)
+        if self.shared_index_dir:
+            self._publish_shared(texts)
+
+    def _shared_arrays(self, texts: List[str]) -> SharedArrays:
+        """
+        Shared arrays of the document matrix, keyed by the knowledge base contents and all the settings that change the matrix.
+        """
+        params = [self.vectorizer_document.dir_path, str(self.dtype), self.deduplicate, self.passages, self.projection]
+        if self.passages:
+            params += [self.knowledge_base.doc_sent_count, self.knowledge_base.overlap]
+        if self.projection:
+            params += [self.projection_dim]
+        return SharedArrays(os.path.join(self.shared_index_dir, fingerprint(texts, *params)))
+
+    def _publish_shared(self, texts: List[str]):
+        arrays = {'document_rows': self.document_rows[:self.num_rows].cpu().numpy()}
+        if self.document_ids is not None:
+            arrays['document_ids'] = self.document_ids
+        if self.passage_segments is not None:
+            arrays['passage_segments'] = self.passage_segments.numpy()
+        if self.projector is not None and self.projector.components is not None:
+            arrays['projection_mean'] = self.projector.mean.cpu().numpy()
+            arrays['projection_components'] = self.projector.components.cpu().numpy()
+
+        shared = self._shared_arrays(texts)
+        shared.publish(arrays)
+        logger.info(f'Document matrix published to {shared.dir_path}')
+
+    def _attach_shared(self, texts: List[str]) -> bool:
+        """
+        Attach to the document matrix published by another process. Return `False` if it has not been published yet.
+        """
+        shared = self._shared_arrays(texts)
+        arrays = shared.attach()
+        if arrays is None:
+            return False
+
+        # On CPU, the tensors share the pages of the mapped files, other devices get their own copy
+        self.document_rows = torch.from_numpy(arrays['document_rows']).to(self.device)
+        self.num_rows = len(self.document_rows)
+        self.document_embeddings = self.document_rows.transpose(0, 1)
+        if 'document_ids' in arrays:
+            self.document_ids = arrays['document_ids']
+        if 'passage_segments' in arrays:
+            self._set_passage_segments(torch.from_numpy(arrays['passage_segments']))
+        if self.deduplicate:
+            unique_texts, rows = self.knowledge_base.get_unique_documents()
+            self.position_rows = torch.tensor(rows, dtype=torch.long)
+            self.text_to_row = {text: row for row, text in enumerate(unique_texts)}
+        if self.projection:
+            self.projector = Projection(self.projection, self.projection_dim)
+            if 'projection_components' in arrays:
+                self.projector.mean = torch.from_numpy(arrays['projection_mean'])
+                self.projector.components = torch.from_numpy(arrays['projection_components'])
+
+        logger.info(f'Attached to the document matrix in {shared.dir_path}')
+        return True
+
+    def _maybe_calculate_embeddings(self):
+        if not self._has_embeddings():
             self.calculate_embeddings()
-            
-        if self.sliding_window:
-            # logger.info('Splitting query into windows.')
-            window = slice_text(
-                query,
-                self.sliding_window_type,
-                self.sliding_window_size,
-                self.sliding_window_stride
-            )
 
-            # logger.info('Calculating embeddings for the windows')
-            query_embeddings = self.vectorizer_query.vectorize(
-                list(window),
-                save_if_missing=self.save_if_missing,
-                normalize=True
-            )
+    def set_document_filter(self, ids: Iterable[int] = None):
+        """
+        Restrict the retrieval to the documents with `ids` without rebuilding the document matrix. Documents outside of the
+        filter are masked out during scoring. `None` removes the filter.
+        """
+        self._maybe_calculate_embeddings()
+        self.prefetched = {}
+
+        if ids is None:
+            self.document_mask = None
+            return
 
-            query_lengths = [len(post) for post in list(window)]
-            segment_array = torch.tensor([
-                i
-                for i, num_windows in enumerate(query_lengths)
-                for _ in range(num_windows)
-            ])
+        self.document_mask = torch.from_numpy(np.isin(self.document_ids, np.array(list(set(ids)))))
 
-            delimiters = list(gen_sliding_window_delimiters(
-                query_lengths, self.query_split_size))
+    def set_language_filter(self, languages: Union[str, List[str]] = None):
+        """
+        Restrict the retrieval to the documents in one of the `languages`, as detected in the knowledge base. Membership masks
+        are calculated once per language combination and reused. `None` removes the filter.
+        """
+        if languages is None:
+            self.set_document_filter(None)
+            return
+
+        key = (languages, ) if isinstance(languages, str) else tuple(sorted(languages))
+        if key not in self.language_masks:
+            self.set_document_filter(self.knowledge_base.get_documents_ids_by_language(list(key)))
+            self.language_masks[key] = self.document_mask
+            logger.info(f'Language filter {key}: {int(self.document_mask.sum())} documents.')
         else:
-            # logger.info('Calculating embeddings for query')
-            query_embeddings = self.vectorizer_query.vectorize(
-                [query],
-                save_if_missing=self.save_if_missing,
-                normalize=True
-            )
-            delimiters = [(0, 1)]
+            self.document_mask = self.language_masks[key]
+            self.prefetched = {}
 
-        results = []
-        
-        # logger.info('Calculating similarity for data splits')
-        for start_id, end_id in delimiters:
+    def set_candidates(self, documents: List[str], ids: List[int], parent: Any = None):
+        """
+        Restrict the retrieval to the candidate `ids` selected by a previous retriever. The candidates are scored as a row subset
+        of the document matrix built for the `parent` knowledge base, so the embeddings are calculated only once per parent and
+        every chained query costs only the scoring of its candidates. Without `parent`, the candidates become a new knowledge
+        base. `None` ids remove the restriction.
+        """
+        if ids is None:
+            self.candidate_positions = None
+            self.prefetched = {}
+            return
+
+        if parent is None:
+            super().set_candidates(documents, ids)
+            return
+
+        if self.knowledge_base is not parent or not self._has_embeddings():
+            self.set_knowledge_base(parent)
+
+        id_to_position = self._id_to_position()
+        self.candidate_positions = torch.tensor([id_to_position[doc_id] for doc_id in ids], dtype=torch.long)
+        self.prefetched = {}
+
+    def add_documents(self, documents: Dict[int, str], **metadata: Any):
+        """
+        Add new documents (id -> text) to the knowledge base and append their embeddings to the document matrix, the quantized
+        matrix and the approximate index. Documents with existing ids replace the old versions. The cost is proportional to the
+        number of new documents. New documents are not part of the current document or language filter. `metadata` is passed to
+        the knowledge base, see `Retriever.add_documents`.
+        """
+        if not self._has_embeddings():
+            self.knowledge_base.add_documents(documents, **metadata)
+            return
+        if self.document_ids is None:
+            # Positions of a knowledge base without ids cannot be updated by id, the retriever is rebuilt
+            super().add_documents(documents, **metadata)
+            return
+
+        id_to_position = self._id_to_position()
+        replaced = [id_to_position[doc_id] for doc_id in documents if doc_id in id_to_position]
+        self.knowledge_base.add_documents(documents, **metadata)
+
+        texts = list(documents.values())
+        positions = torch.arange(self.num_documents, self.num_documents + len(texts))
+
+        new_texts = texts
+        if self.position_rows is not None:
+            # Only texts that are not in the document matrix yet get a new row
+            new_texts, rows = [], []
+            for text in texts:
+                if text not in self.text_to_row:
+                    self.text_to_row[text] = self.num_rows + len(new_texts)
+                    new_texts.append(text)
+                rows.append(self.text_to_row[text])
+            self.position_rows = torch.cat([self.position_rows, torch.tensor(rows, dtype=torch.long)])
+        elif self.passage_segments is not None:
+            new_texts, segments = self.knowledge_base.split_passages(texts)
+            segments = torch.tensor(segments, dtype=torch.long) + self.num_documents
+
+        if new_texts:
+            vectors = self._project(self.vectorizer_document.vectorize(new_texts, save_if_missing=self.save_if_missing, normalize=True))
+            if self.quantized is not None:
+                self.quantized.append(vectors)
+            elif self.sharded is not None:
+                self.sharded.append(vectors)
+            else:
+                self.document_rows = append_rows(self.document_rows, self.num_rows, vectors)
+            if self.ann_index is not None:
+                self.ann_index.add(vectors.float(), positions)
+            self.num_rows += len(new_texts)
+
+        self.document_texts.extend(texts)
+        self.document_ids = np.concatenate([self.document_ids, np.array(list(documents.keys()))])
+        for position, doc_id in zip(positions.tolist(), documents.keys()):
+            id_to_position[doc_id] = position
+        self.num_documents += len(texts)
+        if self.passage_segments is not None:
+            self._set_passage_segments(torch.cat([self.passage_segments, segments]))
+        if self.document_rows is not None and self.quantized is None and self.sharded is None:
+            self.document_embeddings = self.document_rows[:self.num_rows].transpose(0, 1)
+
+        # Masks are extended, the new documents are outside of the filters until they are set again
+        pad = torch.zeros(len(texts), dtype=torch.bool)
+        if self.removed is not None or replaced:
+            removed = self.removed if self.removed is not None else torch.zeros(self.num_documents - len(texts), dtype=torch.bool)
+            self.removed = torch.cat([removed, pad])
+            self.removed[replaced] = True
+        if self.document_mask is not None:
+            self.document_mask = torch.cat([self.document_mask, pad])
+        self.language_masks = {}
+        self.date_index = None
+        self.prefetched = {}
+
+    def remove_documents(self, ids: Iterable[int]):
+        """
+        Remove documents with `ids` from the knowledge base. Their rows are only masked out, so the positions of the other
+        documents do not change.
+        """
+        ids = list(ids)
+        self.knowledge_base.remove_documents(ids)
+        if not self._has_embeddings():
+            return
 
+        id_to_position = self._id_to_position()
+        positions = [id_to_position.pop(doc_id) for doc_id in ids if doc_id in id_to_position]
+        if self.removed is None:
+            self.removed = torch.zeros(self.num_documents, dtype=torch.bool)
+        self.removed[positions] = True
+        self.prefetched = {}
+
+    def _id_to_position(self) -> Dict[int, int]:
+        """
+        Map from document ids to their current positions. Replaced documents map to their newest position.
+        """
+        if self.id_to_position is None:
+            self.id_to_position = {
+                doc_id: position
+                for position, doc_id in enumerate(self.document_ids.tolist())
+            }
+        return self.id_to_position
+
+    def _mask(self) -> torch.tensor:
+        """
+        Combined mask of the `document_mask` filter and the removed documents, `None` if all the documents can be retrieved.
+        """
+        if self.removed is None:
+            return self.document_mask
+        if self.document_mask is None:
+            return ~self.removed
+        return self.document_mask & ~self.removed
+
+    def _get_date_index(self) -> DateIndex:
+        if self.date_index is None:
+            id_to_date = getattr(self.knowledge_base, 'id_to_date', {})
+            dates = [id_to_date.get(doc_id) for doc_id in self.document_ids.tolist()]
+            self.date_index = DateIndex(np.array([np.nan if date is None else date for date in dates], dtype=np.float64))
+        return self.date_index
+
+    def _date_windows(self, query_dates: List[float]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Start and end of the time window of each query. Queries without a date get an unbounded window.
+        """
+        day = 24 * 60 * 60
+        starts = np.full(len(query_dates), -np.inf)
+        ends = np.full(len(query_dates), np.inf)
+        for i, date in enumerate(query_dates):
+            if date is None:
+                continue
+            if self.window_days_before is not None:
+                starts[i] = date - self.window_days_before * day
+            if self.window_days_after is not None:
+                ends[i] = date + self.window_days_after * day
+        return starts, ends
+
+    def _scored_positions(self, windows: List[torch.tensor] = None) -> torch.tensor:
+        """
+        Positions of the documents scored for a batch of queries: the `candidate_positions` restricted to the union of the
+        date `windows` of the queries. `None` means all the documents.
+        """
+        if windows is None:
+            return self.candidate_positions
+
+        # Queries with the same window share it, the union is as large as the window
+        positions = torch.unique(torch.cat(windows))
+        if self.candidate_positions is None:
+            return positions
+        return self.candidate_positions[torch.isin(self.candidate_positions, positions)]
+
+    def _limit(self, scored_positions: torch.tensor = None) -> int:
+        """
+        Number of documents that can be retrieved with the current filter among the `scored_positions` (all if `None`).
+        """
+        mask = self._mask()
+        if scored_positions is not None:
+            if mask is not None:
+                return int(mask[scored_positions].sum())
+            return len(scored_positions)
+        if mask is not None:
+            return int(mask.sum())
+        return self.num_documents
+
+    def _score(self, query_embeddings: torch.tensor, scored_positions: torch.tensor = None) -> torch.tensor:
+        """
+        Calculate similarities (`Q x N`) of the `query_embeddings` with all the documents, or (`Q x C`) with the
+        `scored_positions` if set, see `_scored_positions`. Documents outside of the `document_mask` get `-inf`.
+        """
+        query_embeddings = self._project(query_embeddings)
+        rows = scored_positions
+        fan_out = None
+        passage_segments = None
+        if self.position_rows is not None:
+            # Unique texts are scored once and their similarities are copied to all their documents
+            if rows is None:
+                fan_out = self.position_rows
+            else:
+                rows = self.position_rows[rows]
+        elif self.passage_segments is not None:
+            if rows is None:
+                passage_segments = self.passage_segments
+            else:
+                rows, passage_segments = self._passage_rows(rows)
+
+        if self.quantized is not None:
+            sims = self.quantized.score(query_embeddings, rows)
+        elif self.sharded is not None:
+            sims = self.sharded.score(query_embeddings, rows)
+        else:
+            document_embeddings = self.document_embeddings
+            if rows is not None:
+                document_embeddings = document_embeddings.index_select(1, rows.to(document_embeddings.device))
             sims = torch.mm(
-                query_embeddings[start_id:end_id].to(
-                    device=self.device, dtype=self.dtype),
-                self.document_embeddings
+                query_embeddings.to(device=self.device, dtype=self.dtype),
+                document_embeddings
             )
+        if fan_out is not None:
+            sims = sims.index_select(1, fan_out.to(sims.device))
+        if passage_segments is not None:
+            # Passages of a document are contiguous, so they are pooled with one segment reduction over the columns
+            sims = pool_windows(sims.transpose(0, 1), passage_segments, self.passage_pooling).transpose(0, 1)
 
-            if self.sliding_window:
-                segments = segment_array[start_id:end_id]
-                segments -= int(segments[0])
-
-                sims = scatter(
-                    src=sims,
-                    index=segments,
-                    dim=0,
-                    reduce=self.sliding_window_pooling,
-                )
-            results.extend(sims.tolist()[0])
-            
-        return results
+        mask = self._mask()
+        if mask is not None:
+            mask = mask if scored_positions is None else mask[scored_positions]
+            sims = sims.masked_fill(~mask.to(sims.device), float('-inf'))
 
-    def retrieve(self, query: str) -> Any:
-        if self.document_embeddings is None:
-            self.calculate_embeddings()
+        return sims
+
+    def _apply_windows(self, sims: torch.tensor, scored_positions: torch.tensor, windows: List[torch.tensor]) -> torch.tensor:
+        """
+        Set similarities (`Q x C`) of the `scored_positions` outside of the `windows` (positions of the documents, one tensor per
+        query) to `-inf`, in place and one row at a time. Rows whose window covers all the scored positions are kept.
+        """
+        for row, window in enumerate(windows):
+            columns = torch.isin(scored_positions, window)
+            if not columns.all():
+                sims[row].masked_fill_(~columns.to(sims.device), float('-inf'))
+        return sims
 
+    def _to_positions(self, columns: torch.tensor, scored_positions: torch.tensor = None) -> torch.tensor:
+        """
+        Map columns of the similarity matrix returned by `_score` to positions in the knowledge base.
+        """
+        if scored_positions is None:
+            return columns
+        return scored_positions[columns.cpu()]
+
+    def _pool(self, sims: torch.tensor, segments: torch.tensor) -> torch.tensor:
+        """
+        Aggregate similarities of query windows belonging to the same `segments`.
+        """
+        return pool_windows(sims, segments, self.sliding_window_pooling)
+
+    def _encode_queries(self, queries: List[str]) -> Tuple[torch.tensor, torch.tensor, List[Tuple[int, int]]]:
+        """
+        Encode `queries` with one vectorizer call. With sliding windows, the queries are split into windows first and `segments`
+        maps each window to its query. Return the embeddings, the segments (`None` without sliding windows) and the ranges of
+        embeddings that should be scored together.
+        """
         if self.sliding_window:
-            # logger.info('Splitting query into windows.')
-            window = slice_text(
-                query,
+            windows, segments = split_windows(
+                queries,
                 self.sliding_window_type,
                 self.sliding_window_size,
                 self.sliding_window_stride
             )
+            window_counts = torch.bincount(segments, minlength=len(queries)).tolist()
+            delimiters = list(gen_sliding_window_delimiters(window_counts, self.query_split_size))
+        else:
+            windows, segments = queries, None
+            delimiters = [
+                (start_id, min(start_id + self.query_batch_size, len(queries)))
+                for start_id in range(0, len(queries), self.query_batch_size)
+            ]
 
-            # logger.info('Calculating embeddings for the windows')
-            query_embeddings = self.vectorizer_query.vectorize(
-                list(window),
-                save_if_missing=self.save_if_missing,
-                normalize=True
-            )
+        query_embeddings = self.vectorizer_query.vectorize(
+            list(windows),
+            save_if_missing=self.save_if_missing,
+            normalize=True
+        )
+        return query_embeddings, segments, delimiters
 
-            query_lengths = [len(post) for post in list(window)]
-            segment_array = torch.tensor([
-                i
-                for i, num_windows in enumerate(query_lengths)
-                for _ in range(num_windows)
-            ])
+    def _rescore(self, query_embeddings: torch.tensor, candidates: torch.tensor, segments: torch.tensor = None, valid: torch.tensor = None) -> Tuple[torch.tensor, torch.tensor]:
+        """
+        Reorder `candidates` (`Q x C` positions from the quantized matrix or the projected space) by their full precision similarities with the
+        `query_embeddings`. The full precision vectors are read from the vectorizer cache. If `segments` is set, the query
+        embeddings are sliding windows and their similarities are pooled into one row per query. Candidates with `False` in the
+        boolean `valid` (`Q x C`) keep `-inf`. Return the reordered positions and their similarities.
+        """
+        positions = candidates.cpu()
+        if not positions.shape[1]:
+            # Nothing passed the filter
+            return positions, torch.zeros(positions.shape, dtype=torch.float32)
 
-            delimiters = list(gen_sliding_window_delimiters(
-                query_lengths, self.query_split_size))
+        unique, inverse = torch.unique(positions, return_inverse=True)
+        vectors = self.vectorizer_document.vectorize(
+            [self.document_texts[i] for i in unique.tolist()],
+            save_if_missing=self.save_if_missing,
+            normalize=True
+        ).float()
+
+        query_embeddings = query_embeddings.float().cpu()
+        if segments is not None:
+            # Every window is scored against the candidates of its query
+            sims = self._pool(torch.bmm(vectors[inverse[segments]], query_embeddings.unsqueeze(2)).squeeze(2), segments)
         else:
-            # logger.info('Calculating embeddings for query')
-            query_embeddings = self.vectorizer_query.vectorize(
-                [query],
-                save_if_missing=self.save_if_missing,
-                normalize=True
-            )
-            delimiters = [(0, 1)]
+            sims = torch.bmm(vectors[inverse], query_embeddings.unsqueeze(2)).squeeze(2)
+        if valid is not None:
+            sims = sims.masked_fill(~valid.cpu(), float('-inf'))
 
-        results = []
+        scores, order = torch.sort(sims, descending=True, dim=1)
+        return torch.gather(positions, 1, order), scores
+
+    def _search_ann(self, query_embeddings: torch.tensor, segments: torch.tensor = None) -> List[Tuple[torch.tensor, torch.tensor]]:
+        """
+        Find the `top_k` documents for each query among the candidates of the approximate index. Sliding windows of one query
+        share the candidates of all its windows. With a projected matrix, the best candidates are rescored in full precision as
+        in the exact search. Return a list of (positions, scores) tuples.
+        """
+        rescore = self._uses_rescore()
+        k = self.top_k * self.rescore_factor if rescore else self.top_k
+        projected = self._project(query_embeddings)
+        if segments is None:
+            results = [
+                (positions, scores)
+                for scores, positions in self.ann_index.search(projected.float(), k, mask=self._mask())
+            ]
+        else:
+            results = []
+            for segment in range(int(segments[-1]) + 1):
+                windows = projected[segments == segment].float()
+                candidate_ids, candidate_embeddings = self.ann_index.candidates(windows)
+                mask = self._mask()
+                if mask is not None:
+                    valid = mask[candidate_ids]
+                    candidate_ids, candidate_embeddings = candidate_ids[valid], candidate_embeddings[valid]
+
+                sims = self._pool(torch.mm(windows, candidate_embeddings.transpose(0, 1)), torch.zeros(len(windows), dtype=torch.long))[0]
+                scores, order = torch.topk(sims, k=min(k, len(sims)))
+                results.append((candidate_ids[order], scores))
+
+        if not rescore or not any(len(positions) for positions, _ in results):
+            return results
+
+        # Queries have different numbers of candidates, shorter rows are padded with invalid candidates that keep `-inf`
+        width = max(len(positions) for positions, _ in results)
+        candidates = torch.zeros((len(results), width), dtype=torch.long)
+        valid = torch.zeros((len(results), width), dtype=torch.bool)
+        for row, (positions, _) in enumerate(results):
+            candidates[row, :len(positions)] = positions.cpu()
+            valid[row, :len(positions)] = True
+
+        positions, scores = self._rescore(query_embeddings, candidates, segments, valid)
+        positions, scores = positions[:, :self.top_k], scores[:, :self.top_k]
+        return [(row_positions[torch.isfinite(row_scores)], row_scores[torch.isfinite(row_scores)]) for row_positions, row_scores in zip(positions, scores)]
+
+    def _search_exact(
+            self,
+            query_embeddings: torch.tensor,
+            segments: torch.tensor = None,
+            scored_positions: torch.tensor = None,
+            query_windows: List[torch.tensor] = None
+    ) -> List[Tuple[torch.tensor, torch.tensor]]:
+        """
+        Score the queries against the whole document matrix (or the rows of `scored_positions`) and select the `top_k` documents for each of
+        them, or all the documents allowed by the filter if `top_k` is `None`. `query_windows` (positions of the documents, one tensor per
+        query) restrict the documents of every query separately. Return a list of (positions, scores) tuples.
+        """
+        limit = self._limit(scored_positions)
+        if not limit:
+            # Nothing passed the filter, there is nothing to score or rescore
+            num_queries = len(query_embeddings) if segments is None else int(segments[-1]) + 1
+            return [(torch.zeros(0, dtype=torch.long), torch.zeros(0)) for _ in range(num_queries)]
+
+        rescore = self._uses_rescore()
+        if self.sharded is not None and self.top_k is not None and scored_positions is None:
+            # Blocked scoring with a running top-k, the full similarity matrix is never materialized
+            k = min(self.top_k * self.rescore_factor if rescore else self.top_k, limit)
+            pool = (lambda sims: self._pool(sims, segments)) if segments is not None else None
+            scores, positions = self.sharded.topk(self._project(query_embeddings), k, mask=self._mask(), pool=pool)
+            if rescore:
+                positions, scores = self._rescore(query_embeddings, positions, segments)
+                positions, scores = positions[:, :self.top_k], scores[:, :self.top_k]
+            return list(zip(positions, scores))
+
+        sims = self._score(query_embeddings, scored_positions)
+        if segments is not None:
+            sims = self._pool(sims, segments)
+        if query_windows is not None:
+            sims = self._apply_windows(sims, scored_positions, query_windows)
 
-        # logger.info('Calculating similarity for data splits')
+        if self.top_k is None:
+            scores, positions = torch.sort(sims, descending=True, dim=1)
+            positions, scores = self._to_positions(positions[:, :limit], scored_positions), scores[:, :limit]
+        elif rescore:
+            candidates = torch.topk(sims, k=min(self.top_k * self.rescore_factor, limit), dim=1)
+            # The limit does not account for the query windows, candidates outside of them must not get finite scores
+            valid = torch.isfinite(candidates.values) if query_windows is not None else None
+            positions, scores = self._rescore(query_embeddings, self._to_positions(candidates.indices, scored_positions), segments, valid)
+            positions, scores = positions[:, :self.top_k], scores[:, :self.top_k]
+        else:
+            scores, positions = torch.topk(sims, k=min(self.top_k, limit), dim=1)
+            positions = self._to_positions(positions, scored_positions)
+
+        if query_windows is not None:
+            # Queries with fewer documents in their window than the limit get `-inf` tails
+            return [(row_positions[torch.isfinite(row_scores)], row_scores[torch.isfinite(row_scores)]) for row_positions, row_scores in zip(positions, scores)]
+        return list(zip(positions, scores))
+
+    def search(self, queries: List[str], ranked: bool = True, query_dates: List[float] = None) -> List[RetrievalResult]:
+        """
+        Scoring core shared by all the retrieval methods. All the queries (or their sliding windows) are encoded at once and
+        scored in batches of `query_batch_size` queries or `query_split_size` windows. Window similarities are pooled with one
+        segment reduction per batch.
+
+        If `ranked` is `True`, return the `top_k` documents of each query ordered by their similarity, using the approximate index
+        or the quantized matrix if enabled. Otherwise, return similarities with all the documents (or candidates) in the knowledge
+        base order, with `-inf` for documents outside of the filter.
+
+        If `query_dates` (Unix timestamps) are set and a time window is configured, only the documents in the window of each query
+        are retrieved. The queries are batched in the order of their dates and every batch scores only the union of the windows of its
+        queries (slices of the date index), a single query only its own window. Queries with a narrower window than the union are
+        masked row by row.
+        """
+        self._maybe_calculate_embeddings()
+
+        query_windows = None
+        order = None
+        if query_dates is not None and (self.window_days_before is not None or self.window_days_after is not None):
+            starts, ends = self._date_windows(query_dates)
+            if len(queries) > 1:
+                # Queries with close dates are scored together, so that the union of the windows of a batch stays small
+                order = np.lexsort((ends, starts))
+                queries = [queries[i] for i in order]
+                starts, ends = starts[order], ends[order]
+            date_index = self._get_date_index()
+            query_windows = [date_index.window(start, end) for start, end in zip(starts, ends)]
+
+        query_embeddings, segments, delimiters = self._encode_queries(queries)
+
+        results = []
         for start_id, end_id in delimiters:
+            batch = query_embeddings[start_id:end_id]
+            batch_segments = None
+            if segments is not None:
+                batch_segments = segments[start_id:end_id]
+                batch_segments = batch_segments - batch_segments[0]
 
-            sims = torch.mm(
-                query_embeddings[start_id:end_id].to(
-                    device=self.device, dtype=self.dtype),
-                self.document_embeddings
+            batch_windows = None
+            if query_windows is not None:
+                first, last = (start_id, end_id) if segments is None else (int(segments[start_id]), int(segments[end_id - 1]) + 1)
+                batch_windows = query_windows[first:last]
+            scored_positions = self._scored_positions(batch_windows)
+
+            if not ranked:
+                sims = self._score(batch, scored_positions)
+                if batch_segments is not None:
+                    sims = self._pool(sims, batch_segments)
+                if batch_windows is not None:
+                    sims = self._apply_windows(sims, scored_positions, batch_windows)
+                positions = self._to_positions(torch.arange(sims.shape[1]), scored_positions)
+                results.extend((positions, scores) for scores in sims)
+            elif self.ann_index is not None and self.top_k is not None and scored_positions is None:
+                results.extend(self._search_ann(batch, batch_segments))
+            else:
+                results.extend(self._search_exact(batch, batch_segments, scored_positions, batch_windows))
+
+        if order is not None:
+            results = [result for _, result in sorted(zip(order.tolist(), results), key=lambda item: item[0])]
+
+        return [
+            RetrievalResult(
+                positions.cpu().numpy(),
+                scores.float().cpu().numpy(),
+                self.knowledge_base,
+                self.document_ids
             )
+            for positions, scores in results
+        ]
 
-            if self.sliding_window:
-                segments = segment_array[start_id:end_id]
-                segments -= int(segments[0])
+    def set_knowledge_base(self, knowledge_base: Any):
+        super().set_knowledge_base(knowledge_base)
+        self.calculate_embeddings()
 
-                sims = scatter(
-                    src=sims,
-                    index=segments,
-                    dim=0,
-                    reduce=self.sliding_window_pooling,
-                )
+    def close(self):
+        for vectorizer in {id(v): v for v in (self.vectorizer_document, self.vectorizer_query) if v is not None}.values():
+            vectorizer.close()
 
-            sorted_ids = torch.argsort(sims, descending=True, dim=1)
-            if self.top_k is None:
-                top_k = sorted_ids[0, :].tolist()
-            else:
-                top_k = sorted_ids[0, :self.top_k].tolist()
-            top_k = self.knowledge_base.map_topK(top_k)
+    def retrieve_sims(self, query: str) -> np.ndarray:
+        """
+        Return similarities of the `query` with all the documents in the knowledge base order.
+        """
+        return self.search([query], ranked=False)[0].scores
+
+    def retrieve(self, query: str, query_date: float = None) -> Any:
+        return self.search([query], query_dates=None if query_date is None else [query_date])[0].to_output()
 
-            results.append([
-                self.knowledge_base.get_document(int(fc_id))
-                for fc_id in top_k
-            ])
+    def retrieve_batch(self, queries: List[str], query_dates: List[float] = None) -> List[Any]:
+        """
+        Retrieve documents for multiple queries with one call of `search`. Texts of the documents are fetched only when they are read.
+        """
+        return [result.to_output() for result in self.search(queries, query_dates=query_dates)]
 
-        results = [item for sublist in results for item in sublist]
-        return results, top_k
+    def retrieve_scored(self, queries: List[str]) -> List[Tuple[List[int], np.ndarray]]:
+        return [(result.ids, result.scores) for result in self.search(queries)]
@@ -0,0 +1,136 @@
+import logging
+from typing import Any, Dict, Iterable, List, Tuple, Union
+
+import numpy as np
+import torch
+
+from src.retrievers.embedding import Embedding
+from src.retrievers.retrieval_result import RetrievalResult
+from src.retrievers.retriever import Retriever
+from src.retrievers.vectorizers.vectorizer import Vectorizer
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingCascade(Retriever):
+    """
+    A two-tier dense retriever. A small `candidate` retriever (e.g. `multilingual-e5-small`) scores the whole knowledge base
+    and its `top_k` documents become the candidates of each query. Only the candidates are rescored with a large model (e.g.
+    `multilingual-e5-large`): each query is encoded once with the large model and the document vectors are read from its
+    vectorizer cache. The large model never scores the whole knowledge base and its document matrix is never loaded.
+
+    Filters, time windows, the index and the storage options of the `candidate` retriever apply to the candidate generation.
+
+    Attributes:
+        candidate (Embedding): The first tier, retrieves the candidates with the small model, `candidate_top_k` in the config.
+        vectorizer_query (Vectorizer): The large model used to encode the queries.
+        vectorizer_document (Vectorizer): The large model with the cached vectors of the documents.
+        save_if_missing (bool): Save the vectors calculated by the large model into its vectorizer cache.
+        top_k (int): Number of rescored documents to return. `None` returns all the candidates.
+    """
+    supports_dates = True
+
+    def __init__(
+            self,
+            name: str = 'embedding_cascade',
+            top_k: int = 5,
+            candidate: Embedding = None,
+            vectorizer_document: Vectorizer = None,
+            vectorizer_query: Vectorizer = None,
+            save_if_missing: bool = False,
+            knowledge_base: Any = None,
+            **kwargs: Any
+    ):
+        super().__init__(name, top_k, knowledge_base=knowledge_base)
+        self.candidate = candidate
+        self.vectorizer_document = vectorizer_document
+        self.vectorizer_query = vectorizer_query
+        self.save_if_missing = save_if_missing
+
+    def set_knowledge_base(self, knowledge_base: Any):
+        super().set_knowledge_base(knowledge_base)
+        self.candidate.set_knowledge_base(knowledge_base)
+
+    def close(self):
+        self.candidate.close()
+        for vectorizer in {id(v): v for v in (self.vectorizer_document, self.vectorizer_query) if v is not None}.values():
+            vectorizer.close()
+
+    def add_documents(self, documents: Dict[int, str], **metadata: Any):
+        # The large model vectors are calculated now, so that the first queries after the update do not wait for them
+        self.candidate.add_documents(documents, **metadata)
+        self.vectorizer_document.vectorize(list(documents.values()), save_if_missing=self.save_if_missing)
+        self.prefetched = {}
+
+    def remove_documents(self, ids: Iterable[int]):
+        self.candidate.remove_documents(ids)
+        self.prefetched = {}
+
+    def set_document_filter(self, ids: Iterable[int] = None):
+        self.candidate.set_document_filter(ids)
+        self.prefetched = {}
+
+    def set_language_filter(self, languages: Union[str, List[str]] = None):
+        self.candidate.set_language_filter(languages)
+        self.prefetched = {}
+
+    def set_candidates(self, documents: List[str], ids: List[int], parent: Any = None):
+        self.candidate.set_candidates(documents, ids, parent=parent)
+        self.knowledge_base = self.candidate.knowledge_base
+        self.prefetched = {}
+
+    def rerank(self, queries: List[str], candidates: List[RetrievalResult]) -> List[RetrievalResult]:
+        """
+        Reorder the `candidates` of each query by their similarities in the space of the large model. All the queries are
+        encoded with one vectorizer call and the vectors of the candidates shared by several queries are read only once.
+        """
+        positions = np.concatenate([result.positions for result in candidates])
+        if not len(positions):
+            return candidates
+
+        query_embeddings = self.vectorizer_query.vectorize(
+            queries,
+            save_if_missing=self.save_if_missing,
+            normalize=True
+        ).float()
+        unique, inverse = np.unique(positions, return_inverse=True)
+        document_embeddings = self.vectorizer_document.vectorize(
+            [self.candidate.document_texts[i] for i in unique.tolist()],
+            save_if_missing=self.save_if_missing,
+            normalize=True
+        ).float()
+
+        # Similarities of all the (query, candidate) pairs at once, split into the candidates of each query afterwards
+        segments = torch.repeat_interleave(torch.tensor([len(result) for result in candidates], dtype=torch.long))
+        sims = (document_embeddings[torch.from_numpy(inverse)] * query_embeddings[segments]).sum(dim=1)
+
+        results = []
+        start = 0
+        for result in candidates:
+            scores, order = torch.sort(sims[start:start + len(result)], descending=True)
+            start += len(result)
+            if self.top_k is not None:
+                scores, order = scores[:self.top_k], order[:self.top_k]
+            results.append(RetrievalResult(
+                result.positions[order.numpy()],
+                scores.numpy(),
+                result.knowledge_base,
+                result.document_ids
+            ))
+        return results
+
+    def search(self, queries: List[str], query_dates: List[float] = None) -> List[RetrievalResult]:
+        """
+        Select the candidates of all the `queries` with the small model and rescore them with the large model.
+        """
+        return self.rerank(queries, self.candidate.search(queries, query_dates=query_dates))
+
+    def retrieve(self, query: str, query_date: float = None) -> Any:
+        return self.search([query], query_dates=None if query_date is None else [query_date])[0].to_output()
+
+    def retrieve_batch(self, queries: List[str], query_dates: List[float] = None) -> List[Any]:
+        return [result.to_output() for result in self.search(queries, query_dates=query_dates)]
+
+    def retrieve_scored(self, queries: List[str]) -> List[Tuple[List[int], np.ndarray]]:
+        return [(result.ids, result.scores) for result in self.search(queries)]
@@ -0,0 +1,128 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Tuple
+
+import numpy as np
+
+from src.retrievers.retrieval_result import LazyDocuments
+from src.retrievers.retriever import Retriever
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class Hybrid(Retriever):
+    """
+    A retriever that fuses the results of a sparse (`BM25`) and a dense (`Embedding`) retriever over the same knowledge base.
+    Both branches run concurrently in two threads -- PyTerrier and torch release the GIL for most of their work.
+
+    Attributes:
+        sparse (Retriever): The sparse branch, retrieves `sparse_top_k` documents.
+        dense (Retriever): The dense branch, retrieves `dense_top_k` documents.
+        fusion (str): `rrf` for reciprocal rank fusion or `score` for the weighted sum of min-max normalized scores.
+        sparse_weight (float): Weight of the sparse branch in the fusion.
+        dense_weight (float): Weight of the dense branch in the fusion.
+        rrf_k (int): Constant of the reciprocal rank fusion, `1 / (rrf_k + rank)`.
+        top_k (int): Number of fused documents to return.
+    """
+    def __init__(
+            self,
+            name: str = 'hybrid',
+            top_k: int = 10,
+            sparse: Retriever = None,
+            dense: Retriever = None,
+            fusion: str = 'rrf',
+            sparse_weight: float = 1.0,
+            dense_weight: float = 1.0,
+            rrf_k: int = 60,
+            knowledge_base: Any = None,
+            **kwargs: Any
+    ):
+        super().__init__(name, top_k, knowledge_base=knowledge_base)
+        assert fusion in ('rrf', 'score')
+        self.sparse = sparse
+        self.dense = dense
+        self.fusion = fusion
+        self.sparse_weight = sparse_weight
+        self.dense_weight = dense_weight
+        self.rrf_k = rrf_k
+        self.executor = ThreadPoolExecutor(max_workers=2)
+
+    def set_knowledge_base(self, knowledge_base: Any):
+        super().set_knowledge_base(knowledge_base)
+        self.sparse.set_knowledge_base(knowledge_base)
+        self.dense.set_knowledge_base(knowledge_base)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.sparse.close()
+        self.dense.close()
+
+    def __del__(self):
+        # Retrievers that are only dropped without `close` still stop the idle threads of the executor
+        if hasattr(self, 'executor'):
+            self.executor.shutdown(wait=False)
+
+    def add_documents(self, documents: Dict[int, str], **metadata: Any):
+        # Both branches share the knowledge base, updating it twice has no further effect. The sparse branch goes first, it
+        # finds the replaced documents in the knowledge base, while the dense branch keeps its own positions of the ids.
+        self.sparse.add_documents(documents, **metadata)
+        self.dense.add_documents(documents, **metadata)
+        self.prefetched = {}
+
+    def remove_documents(self, ids: Iterable[int]):
+        ids = list(ids)
+        self.sparse.remove_documents(ids)
+        self.dense.remove_documents(ids)
+        self.prefetched = {}
+
+    def _branch_scores(self, ids: List[int], scores: np.ndarray) -> Dict[int, float]:
+        """
+        Convert ranked `ids` of one branch into their contributions to the fused score.
+        """
+        if self.fusion == 'rrf':
+            return {
+                doc_id: 1 / (self.rrf_k + rank)
+                for rank, doc_id in enumerate(ids, start=1)
+            }
+
+        scores = np.asarray(scores, dtype=np.float64)
+        if len(scores) == 0:
+            return {}
+        low, high = scores.min(), scores.max()
+        normalized = (scores - low) / (high - low) if high > low else np.ones_like(scores)
+        return dict(zip(ids, normalized.tolist()))
+
+    def fuse(self, sparse: Tuple[List[int], np.ndarray], dense: Tuple[List[int], np.ndarray]) -> Tuple[List[int], List[float]]:
+        """
+        Fuse the ranked (ids, scores) of both branches for one query. Documents missing in a branch get no contribution from it.
+        Return the `top_k` fused ids and their fused scores.
+        """
+        fused = {}
+        for weight, (ids, scores) in ((self.sparse_weight, sparse), (self.dense_weight, dense)):
+            for doc_id, score in self._branch_scores(ids, scores).items():
+                fused[doc_id] = fused.get(doc_id, 0.0) + weight * score
+
+        ranked = sorted(fused.items(), key=lambda item: item[1], reverse=True)
+        if self.top_k is not None:
+            ranked = ranked[:self.top_k]
+        return [doc_id for doc_id, _ in ranked], [score for _, score in ranked]
+
+    def retrieve_scored(self, queries: List[str]) -> List[Tuple[List[int], np.ndarray]]:
+        sparse = self.executor.submit(self.sparse.retrieve_scored, queries)
+        dense = self.executor.submit(self.dense.retrieve_scored, queries)
+
+        results = []
+        for sparse_result, dense_result in zip(sparse.result(), dense.result()):
+            ids, scores = self.fuse(sparse_result, dense_result)
+            results.append((ids, np.array(scores)))
+        return results
+
+    def retrieve_batch(self, queries: List[str]) -> List[Any]:
+        return [
+            (LazyDocuments(self.knowledge_base, ids), ids)
+            for ids, _ in self.retrieve_scored(queries)
+        ]
+
+    def retrieve(self, query: str) -> Any:
+        return self.retrieve_batch([query])[0]
@@ -0,0 +1,33 @@
+import numpy as np
+import torch
+
+
+class DateIndex:
+    """
+    Index of the publication dates of the documents. Positions of the dated documents are sorted by their dates, so a time
+    window is a contiguous slice of them found with a binary search. Documents without a date are selected by every window.
+
+    Attributes:
+        dates: np.ndarray  Unix timestamps of the documents in the knowledge base order, `nan` for undated documents.
+        order: torch.tensor  Positions of the dated documents sorted by their dates.
+        sorted_dates: np.ndarray  Dates of the documents in `order`.
+        undated: torch.tensor  Positions of the documents without a date.
+    """
+
+    def __init__(self, dates: np.ndarray):
+        self.dates = np.asarray(dates, dtype=np.float64)
+        dated = ~np.isnan(self.dates)
+        positions = np.flatnonzero(dated)
+        order = np.argsort(self.dates[positions], kind='stable')
+
+        self.order = torch.from_numpy(positions[order])
+        self.sorted_dates = self.dates[positions][order]
+        self.undated = torch.from_numpy(np.flatnonzero(~dated))
+
+    def window(self, start: float = -np.inf, end: float = np.inf) -> torch.tensor:
+        """
+        Positions of the documents published between `start` and `end` (inclusive) and of the undated documents.
+        """
+        low = np.searchsorted(self.sorted_dates, start, side='left')
+        high = np.searchsorted(self.sorted_dates, end, side='right')
+        return torch.cat([self.order[low:high], self.undated])
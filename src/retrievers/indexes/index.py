@@ -0,0 +1,98 @@
+import logging
+from typing import List, Tuple
+
+import torch
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class Index:
+    """
+    An abstract class for nearest-neighbour indexes over document embeddings. Indexes are used by the `Embedding` retriever
+    to avoid scoring every query against the whole knowledge base.
+
+    Currently supported:
+            `IVFIndex` - Inverted file index with spherical k-means clusters.
+
+    Indexes work with L2-normalized vectors in `N x D` layout, where the row number is the position of the document in the
+    knowledge base. `search` returns these positions, so they can be mapped to the document ids with `Dataset.map_topK`.
+    """
+
+    def build(self, vectors: torch.tensor):
+        """
+        Build the index for `vectors` (`N x D`).
+        """
+        raise NotImplementedError
+
+    def add(self, vectors: torch.tensor, positions: torch.tensor):
+        """
+        Add new `vectors` (`M x D`) of documents with `positions` to an already built index.
+        """
+        raise NotImplementedError
+
+    def candidates(self, queries: torch.tensor) -> Tuple[torch.tensor, torch.tensor]:
+        """
+        Select candidate documents for all the `queries` (`Q x D`). Return their positions and their vectors (`C x D`).
+        """
+        raise NotImplementedError
+
+    def search(self, queries: torch.tensor, top_k: int, mask: torch.tensor = None) -> List[Tuple[torch.tensor, torch.tensor]]:
+        """
+        Find `top_k` most similar documents for each of the `queries`. Return a list of (scores, positions) tuples.
+        If a boolean `mask` over all the documents is set, only the documents with `True` are returned.
+        """
+        results = []
+        for query in queries:
+            query = query.unsqueeze(0)
+            positions, vectors = self.candidates(query)
+            if mask is not None:
+                valid = mask[positions]
+                positions, vectors = positions[valid], vectors[valid]
+            sims = torch.mm(query, vectors.transpose(0, 1))[0]
+            scores, order = torch.topk(sims, k=min(top_k, len(sims)))
+            results.append((scores, positions[order]))
+        return results
+
+    @staticmethod
+    def exact_topk(queries: torch.tensor, vectors: torch.tensor, top_k: int, block_size: int = 65536) -> torch.tensor:
+        """
+        Find positions (`Q x top_k`) of the `top_k` most similar `vectors` (`N x D`) for `queries` (`Q x D`) by the exact search.
+        Vectors are scored in blocks with a running top-k, so only `Q x block_size` similarities are materialized at once.
+        """
+        queries = queries.float()
+        scores, positions = None, None
+        for start in range(0, len(vectors), block_size):
+            sims = torch.mm(queries, vectors[start:start + block_size].float().transpose(0, 1))
+            block_scores, block_positions = torch.topk(sims, k=min(top_k, sims.shape[1]), dim=1)
+            block_positions += start
+            if scores is not None:
+                block_scores = torch.cat([scores, block_scores], dim=1)
+                block_positions = torch.cat([positions, block_positions], dim=1)
+            scores, order = torch.topk(block_scores, k=min(top_k, block_scores.shape[1]), dim=1)
+            positions = torch.gather(block_positions, 1, order)
+        return positions
+
+    def recall(self, queries: torch.tensor, vectors: torch.tensor, top_k: int) -> float:
+        """
+        Calculate recall@`top_k` of the index against the exact search over `vectors` (`N x D`) for `queries` (`Q x D`).
+        """
+        top_k = min(top_k, len(vectors))
+        exact = self.exact_topk(queries, vectors, top_k)
+
+        hits = 0
+        for (_, approximate), expected in zip(self.search(queries, top_k), exact):
+            hits += len(set(approximate.tolist()) & set(expected.tolist()))
+
+        return hits / (len(queries) * top_k)
+
+    def save(self, path: str):
+        raise NotImplementedError
+
+    def load(self, path: str, vectors: torch.tensor):
+        """
+        Load the index from `path`. Indexes do not store the vectors themselves, so the same `vectors` that were used
+        during `build` have to be provided.
+        """
+        raise NotImplementedError
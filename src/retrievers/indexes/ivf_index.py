@@ -0,0 +1,165 @@
+import logging
+import math
+import os
+from typing import Callable
+
+import torch
+
+from src.retrievers.indexes.index import Index
+from src.retrievers.utils import append_rows
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class IVFIndex(Index):
+    """
+    Inverted file index. Documents are clustered with spherical k-means and each query is scored only against the documents
+    from the `nprobe` closest clusters. Larger `nprobe` means better recall and slower search.
+
+    Documents added after the index is built are kept in a pending list that is scanned for every query. When the pending list
+    grows over `rebuild_fraction` of the indexed documents, it is merged into the inverted lists with the existing centroids.
+
+    The index keeps only the positions of the documents sorted by their clusters. Vectors of the probed lists are gathered with
+    `get_vectors` from the matrix that is already in memory, e.g. the document matrix of `Embedding`, so no second copy is kept.
+
+    Attributes:
+        get_vectors: Callable  Function returning float vectors (`C x D`) of the documents at the given positions.
+        nlist: int  Number of clusters. `None` means square root of the number of documents.
+        nprobe: int  Number of clusters probed for each query.
+        n_iter: int  Number of k-means iterations.
+        max_train_points: int  Maximum number of vectors sampled for k-means training per cluster.
+        seed: int  Random seed for the k-means initialization.
+        rebuild_fraction: float  Size of the pending list, relative to the indexed documents, that triggers the merge.
+    """
+
+    def __init__(
+        self,
+        get_vectors: Callable[[torch.tensor], torch.tensor],
+        nlist: int = None,
+        nprobe: int = 8,
+        n_iter: int = 10,
+        max_train_points: int = 256,
+        seed: int = 1,
+        rebuild_fraction: float = 0.1,
+    ):
+        self.get_vectors = get_vectors
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.n_iter = n_iter
+        self.max_train_points = max_train_points
+        self.seed = seed
+        self.rebuild_fraction = rebuild_fraction
+
+        self.centroids = None
+        self.offsets = None
+        self.list_ids = None
+        self._reset_pending()
+
+    def _reset_pending(self):
+        self.pending_size = 0
+        self.pending_ids = torch.zeros(0, dtype=torch.long)
+
+    @staticmethod
+    def _assign(vectors: torch.tensor, centroids: torch.tensor, block_size: int = 65536) -> torch.tensor:
+        """
+        Assign each vector to its closest centroid. Vectors are processed in blocks to limit the size of the similarity matrix.
+        """
+        return torch.cat([
+            torch.argmax(torch.mm(vectors[i:i+block_size], centroids.transpose(0, 1)), dim=1)
+            for i in range(0, len(vectors), block_size)
+        ])
+
+    def _train(self, vectors: torch.tensor, nlist: int) -> torch.tensor:
+        generator = torch.Generator().manual_seed(self.seed)
+
+        sample_size = min(len(vectors), nlist * self.max_train_points)
+        sample = vectors[torch.randperm(len(vectors), generator=generator)[:sample_size]]
+        centroids = sample[torch.randperm(len(sample), generator=generator)[:nlist]].clone()
+
+        for _ in range(self.n_iter):
+            assignments = self._assign(sample, centroids)
+            sums = torch.zeros_like(centroids).index_add_(0, assignments, sample)
+            counts = torch.bincount(assignments, minlength=nlist)
+
+            # Empty clusters keep their previous centroid
+            empty = counts == 0
+            sums[empty] = centroids[empty]
+            centroids = torch.nn.functional.normalize(sums, p=2, dim=1)
+
+        return centroids
+
+    def build(self, vectors: torch.tensor):
+        vectors = vectors.float().contiguous()
+        nlist = min(self.nlist or max(1, int(math.sqrt(len(vectors)))), len(vectors))
+
+        logger.info(f'Training IVF index with {nlist} clusters over {len(vectors)} documents.')
+        self.centroids = self._train(vectors, nlist)
+        self._fill(self._assign(vectors, self.centroids))
+
+    def _fill(self, assignments: torch.tensor):
+        """
+        Sort document positions by their clusters so that each inverted list is a contiguous block of `list_ids`.
+        """
+        self.list_ids = torch.argsort(assignments, stable=True)
+        counts = torch.bincount(assignments, minlength=len(self.centroids))[:len(self.centroids)]
+        self.offsets = torch.zeros(len(self.centroids) + 1, dtype=torch.long)
+        self.offsets[1:] = torch.cumsum(counts, dim=0)
+        self.list_ids = self.list_ids[:self.offsets[-1]]
+        self._reset_pending()
+
+    def add(self, vectors, positions):
+        # The vectors themselves are gathered from the document matrix, which has to contain the new documents already
+        self.pending_ids = append_rows(self.pending_ids, self.pending_size, positions.long())
+        self.pending_size += len(positions)
+
+        if self.pending_size > self.rebuild_fraction * len(self.list_ids):
+            self._merge_pending()
+
+    def _merge_pending(self):
+        """
+        Assign the pending documents to the closest existing centroids and rebuild the inverted lists.
+        """
+        counts = self.offsets[1:] - self.offsets[:-1]
+        assignments = torch.repeat_interleave(torch.arange(len(self.centroids)), counts)
+        pending_ids = self.pending_ids[:self.pending_size]
+
+        size = int(torch.max(torch.cat([self.list_ids, pending_ids]))) + 1
+        # Positions that are in neither list (should not happen) are put after all the clusters and never probed
+        all_assignments = torch.full((size, ), len(self.centroids), dtype=torch.long)
+        all_assignments[self.list_ids] = assignments
+        all_assignments[pending_ids] = self._assign(self.get_vectors(pending_ids), self.centroids)
+
+        logger.info(f'Merging {self.pending_size} pending documents into the IVF index.')
+        self._fill(all_assignments)
+
+    def candidates(self, queries):
+        nprobe = min(self.nprobe, len(self.centroids))
+        probed = torch.topk(torch.mm(queries.float(), self.centroids.transpose(0, 1)), k=nprobe, dim=1).indices
+        probed = torch.unique(probed).tolist()
+
+        rows = torch.cat([
+            torch.arange(self.offsets[cluster], self.offsets[cluster + 1])
+            for cluster in probed
+        ])
+        positions = self.list_ids[rows]
+        if self.pending_size:
+            positions = torch.cat([positions, self.pending_ids[:self.pending_size]])
+        return positions, self.get_vectors(positions)
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        torch.save({
+            'centroids': self.centroids,
+            'list_ids': self.list_ids,
+            'offsets': self.offsets,
+        }, path)
+
+    def load(self, path, vectors):
+        state = torch.load(path)
+        assert int(state['offsets'][-1]) == len(vectors)
+
+        self.centroids = state['centroids']
+        self.list_ids = state['list_ids']
+        self.offsets = state['offsets']
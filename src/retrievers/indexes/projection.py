@@ -0,0 +1,84 @@
+import logging
+import os
+
+import torch
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class Projection:
+    """
+    Linear projection of the embeddings into a lower dimensional space. Documents and queries are projected with the same
+    transformation and L2-normalized again, so the cosine similarity is calculated in the reduced space.
+
+    Supported modes:
+        `pca` - Projection onto the `dim` principal components of the document embeddings. The components are fitted on the
+            knowledge base and can be persisted with `save`.
+        `truncate` - The first `dim` dimensions of the embeddings. Meaningful only for models trained with nested (Matryoshka)
+            representations, nothing has to be fitted.
+
+    Attributes:
+        mode: str  Projection mode.
+        dim: int  Number of dimensions after the projection.
+        max_train_points: int  Maximum number of vectors sampled for fitting the PCA.
+        seed: int  Random seed of the sampling.
+    """
+
+    modes = ('pca', 'truncate')
+
+    def __init__(self, mode: str = 'pca', dim: int = 256, max_train_points: int = 100000, seed: int = 1):
+        assert mode in self.modes
+        self.mode = mode
+        self.dim = dim
+        self.max_train_points = max_train_points
+        self.seed = seed
+
+        self.mean = None
+        self.components = None
+
+    def fit(self, vectors: torch.tensor):
+        """
+        Fit the projection on the document `vectors` (`N x D`).
+        """
+        assert self.dim <= vectors.shape[1], f'Projection to {self.dim} dimensions of {vectors.shape[1]}-dimensional vectors.'
+        if self.mode == 'truncate':
+            return
+
+        generator = torch.Generator().manual_seed(self.seed)
+        sample = vectors[torch.randperm(len(vectors), generator=generator)[:self.max_train_points]].float()
+        self.mean = sample.mean(dim=0)
+
+        # Right singular vectors of the centered sample are the principal components, ordered by the explained variance
+        _, singular_values, vh = torch.linalg.svd(sample - self.mean, full_matrices=False)
+        self.components = vh[:self.dim].transpose(0, 1).contiguous()
+
+        variance = singular_values ** 2
+        logger.info(
+            f'PCA fitted on {len(sample)} vectors, {self.dim} components explain '
+            f'{(variance[:self.dim].sum() / variance.sum()).item():.4f} of the variance.')
+
+    def transform(self, vectors: torch.tensor) -> torch.tensor:
+        """
+        Project `vectors` (`N x D`) into `N x dim` and normalize them.
+        """
+        if self.mode == 'truncate':
+            projected = vectors[:, :self.dim].float()
+        else:
+            projected = torch.mm(vectors.float() - self.mean.to(vectors.device), self.components.to(vectors.device))
+        return torch.nn.functional.normalize(projected, p=2, dim=1)
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        torch.save({
+            'mean': self.mean,
+            'components': self.components,
+        }, path)
+
+    def load(self, path: str):
+        state = torch.load(path)
+        assert state['components'].shape[1] == self.dim
+
+        self.mean = state['mean']
+        self.components = state['components']
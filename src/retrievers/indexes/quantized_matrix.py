@@ -0,0 +1,85 @@
+import torch
+
+from src.retrievers.utils import append_rows
+
+
+class QuantizedMatrix:
+    """
+    Document embedding matrix stored in a compact dtype. Queries are scored against the compact matrix block by block, so
+    the full precision matrix never has to be materialized.
+
+    Supported modes:
+        `int8` - Symmetric quantization with one scale per dimension. Scores are calculated as `(query * scales) @ codes`.
+        `fp16`, `bf16` - Half precision copies of the vectors.
+
+    Attributes:
+        mode: str  Quantization mode.
+        block_size: int  Number of documents converted to float32 at once during scoring.
+    """
+
+    dtypes = {
+        'int8': torch.int8,
+        'fp16': torch.float16,
+        'bf16': torch.bfloat16,
+    }
+
+    def __init__(self, vectors: torch.tensor, mode: str = 'int8', block_size: int = 65536):
+        """
+        Attributes:
+            vectors: torch.tensor  Float document embeddings in `N x D` layout.
+        """
+        assert mode in self.dtypes
+        self.mode = mode
+        self.block_size = block_size
+        self.full_nbytes = vectors.numel() * 4
+
+        vectors = vectors.float()
+        self.scales = (vectors.abs().amax(dim=0) / 127).clamp_min(1e-12) if mode == 'int8' else None
+        self.storage = self._quantize(vectors).contiguous()
+        self.size = len(vectors)
+
+    def _quantize(self, vectors: torch.tensor) -> torch.tensor:
+        vectors = vectors.float().to(self.scales.device if self.scales is not None else vectors.device)
+        if self.mode == 'int8':
+            return torch.round(vectors / self.scales).clamp(-127, 127).to(torch.int8)
+        return vectors.to(self.dtypes[self.mode])
+
+    @property
+    def codes(self) -> torch.tensor:
+        return self.storage[:self.size]
+
+    def __len__(self) -> int:
+        return self.size
+
+    def append(self, vectors: torch.tensor):
+        """
+        Add new documents. `int8` codes of the new `vectors` use the existing scales, values out of their range are clipped.
+        """
+        self.full_nbytes += vectors.numel() * 4
+        self.storage = append_rows(self.storage, self.size, self._quantize(vectors))
+        self.size += len(vectors)
+
+    @property
+    def nbytes(self) -> int:
+        scales = self.scales.numel() * 4 if self.scales is not None else 0
+        return self.codes.numel() * self.codes.element_size() + scales
+
+    def to(self, device: str) -> 'QuantizedMatrix':
+        self.storage = self.storage.to(device)
+        if self.scales is not None:
+            self.scales = self.scales.to(device)
+        return self
+
+    def score(self, queries: torch.tensor, rows: torch.tensor = None) -> torch.tensor:
+        """
+        Calculate approximate similarities (`Q x N`) of float `queries` (`Q x D`) with all the documents, or only with `rows` if set.
+        """
+        queries = queries.to(device=self.codes.device, dtype=torch.float32)
+        if self.scales is not None:
+            queries = queries * self.scales
+
+        codes = self.codes if rows is None else self.codes[rows.to(self.codes.device)]
+        return torch.cat([
+            torch.mm(queries, codes[i:i+self.block_size].float().transpose(0, 1))
+            for i in range(0, max(len(codes), 1), self.block_size)
+        ], dim=1)
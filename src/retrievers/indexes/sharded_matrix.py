@@ -0,0 +1,178 @@
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Tuple
+
+import numpy as np
+import torch
+
+from src.retrievers.utils import cow_memmap, publish_directory
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class ShardedMatrix:
+    """
+    Document embedding matrix stored on disk as memory-mapped shards. Queries are scored block by block with a running top-k
+    merge, so only `block_size` rows of every shard are materialized at once and the whole matrix never has to fit into memory.
+    Shards are scored in parallel by `num_threads` threads, torch releases the GIL during the matrix multiplications.
+
+    The data are stored in `dir_path`. Each shard is a `.vectors` file with raw float32 rows in the knowledge base order, `meta.json`
+    with the dimension and the sizes of the shards is written last, a directory without it is considered incomplete. The files
+    are written once by `build` and never modified.
+
+    Attributes:
+        dir_path: str  Path to the directory with the shards.
+        block_size: int  Number of rows scored at once by one thread.
+        num_threads: int  Number of shards scored in parallel.
+    """
+
+    dtype = np.float32
+
+    def __init__(self, dir_path: str, block_size: int = 65536, num_threads: int = 4):
+        self.dir_path = dir_path
+        self.block_size = block_size
+        self.num_threads = num_threads
+
+        self.dim = None
+        self.shards = []
+        self.offsets = np.zeros(1, dtype=np.int64)
+
+    def __len__(self) -> int:
+        return int(self.offsets[-1])
+
+    @property
+    def nbytes(self) -> int:
+        return len(self) * (self.dim or 0) * 4
+
+    def _shard_path(self, dir_path: str, shard_id: int) -> str:
+        return os.path.join(dir_path, f'{shard_id:06d}.vectors')
+
+    def _write_meta(self, dir_path: str, sizes: list):
+        with open(os.path.join(dir_path, 'meta.json') + '.tmp', 'w', encoding='utf8') as f:
+            json.dump({'dim': self.dim, 'sizes': sizes}, f)
+        os.replace(os.path.join(dir_path, 'meta.json') + '.tmp', os.path.join(dir_path, 'meta.json'))
+
+    def build(self, chunks: Iterable[torch.tensor]):
+        """
+        Write the `chunks` of document vectors (`N_i x D`) as shards, one shard per chunk, and open them. The shards are written
+        into a temporary directory which is then renamed, so readers never see a partially written matrix.
+        """
+        tmp_path = f'{self.dir_path}.tmp-{os.getpid()}'
+        os.makedirs(tmp_path, exist_ok=True)
+
+        sizes = []
+        for shard_id, vectors in enumerate(chunks):
+            vectors = vectors.float().cpu().numpy()
+            self.dim = vectors.shape[1]
+            vectors.tofile(self._shard_path(tmp_path, shard_id))
+            sizes.append(len(vectors))
+        self._write_meta(tmp_path, sizes)
+        publish_directory(tmp_path, self.dir_path)
+        self.open()
+
+    def open(self) -> bool:
+        """
+        Memory-map all the shards. Return `False` if there is no complete matrix in `dir_path` yet.
+        """
+        meta_path = os.path.join(self.dir_path, 'meta.json')
+        if not os.path.isfile(meta_path):
+            return False
+
+        with open(meta_path, 'r', encoding='utf8') as f:
+            meta = json.load(f)
+
+        self.dim = meta['dim']
+        self.shards = [
+            cow_memmap(self._shard_path(self.dir_path, shard_id), self.dtype, (size, self.dim))
+            for shard_id, size in enumerate(meta['sizes'])
+        ]
+        self.offsets = np.concatenate([[0], np.cumsum(meta['sizes'])]).astype(np.int64)
+        return True
+
+    def append(self, vectors: torch.tensor):
+        """
+        Add new documents as a new in-memory shard. The files are never modified, so the stored matrix stays valid for the
+        original knowledge base.
+        """
+        vectors = vectors.float().cpu().numpy()
+        self.shards.append(vectors)
+        self.offsets = np.append(self.offsets, self.offsets[-1] + len(vectors))
+
+    def _blocks(self, shard_id: int):
+        """
+        Iterate over (start position, `B x D` tensor) blocks of a shard.
+        """
+        shard = self.shards[shard_id]
+        for start in range(0, len(shard), self.block_size):
+            yield int(self.offsets[shard_id]) + start, torch.from_numpy(shard[start:start + self.block_size])
+
+    def _score_block(self, queries: torch.tensor, start: int, block: torch.tensor, mask: torch.tensor, pool: Callable) -> torch.tensor:
+        sims = torch.mm(queries, block.transpose(0, 1))
+        if mask is not None:
+            sims = sims.masked_fill(~mask[start:start + len(block)], float('-inf'))
+        if pool is not None:
+            sims = pool(sims)
+        return sims
+
+    def _topk_shard(self, shard_id: int, queries: torch.tensor, k: int, mask: torch.tensor, pool: Callable) -> Tuple[torch.tensor, torch.tensor]:
+        scores, positions = None, None
+        for start, block in self._blocks(shard_id):
+            sims = self._score_block(queries, start, block, mask, pool)
+            block_scores, block_positions = torch.topk(sims, k=min(k, sims.shape[1]), dim=1)
+            block_positions += start
+
+            if scores is None:
+                scores, positions = block_scores, block_positions
+            else:
+                scores, order = torch.topk(torch.cat([scores, block_scores], dim=1), k=min(k, scores.shape[1] + block_scores.shape[1]), dim=1)
+                positions = torch.gather(torch.cat([positions, block_positions], dim=1), 1, order)
+        return scores, positions
+
+    def topk(self, queries: torch.tensor, k: int, mask: torch.tensor = None, pool: Callable = None) -> Tuple[torch.tensor, torch.tensor]:
+        """
+        Find the `k` most similar documents for float `queries` (`Q x D`). Return their scores and positions (`Q x k`), best first.
+        Documents with `False` in the boolean `mask` get `-inf`. `pool` aggregates the similarities of a block (`Q x B`), e.g. of
+        sliding windows into one row per query, before the top-k selection.
+        """
+        queries = queries.float().cpu()
+        mask = mask.cpu() if mask is not None else None
+        shard_ids = [shard_id for shard_id, shard in enumerate(self.shards) if len(shard)]
+
+        with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+            results = list(executor.map(lambda shard_id: self._topk_shard(shard_id, queries, k, mask, pool), shard_ids))
+
+        scores = torch.cat([scores for scores, _ in results], dim=1)
+        positions = torch.cat([positions for _, positions in results], dim=1)
+        scores, order = torch.topk(scores, k=min(k, scores.shape[1]), dim=1)
+        return scores, torch.gather(positions, 1, order)
+
+    def score(self, queries: torch.tensor, rows: torch.tensor = None) -> torch.tensor:
+        """
+        Calculate similarities (`Q x N`) of float `queries` (`Q x D`) with all the documents, or only with `rows` if set.
+        """
+        queries = queries.float().cpu()
+        if rows is not None:
+            return torch.mm(queries, self.get(rows.cpu().numpy()).transpose(0, 1))
+
+        return torch.cat([
+            torch.mm(queries, block.transpose(0, 1))
+            for shard_id in range(len(self.shards))
+            for _, block in self._blocks(shard_id)
+        ], dim=1)
+
+    def get(self, rows: np.ndarray) -> torch.tensor:
+        """
+        Read vectors of the documents at `rows`.
+        """
+        vectors = np.empty((len(rows), self.dim), dtype=self.dtype)
+        shard_ids = np.searchsorted(self.offsets, rows, side='right') - 1
+
+        for shard_id in np.unique(shard_ids):
+            selected = shard_ids == shard_id
+            vectors[selected] = self.shards[shard_id][rows[selected] - self.offsets[shard_id]]
+
+        return torch.from_numpy(vectors)
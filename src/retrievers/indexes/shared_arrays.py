@@ -0,0 +1,65 @@
+import json
+import logging
+import os
+from typing import Dict
+
+import numpy as np
+
+from src.retrievers.utils import cow_memmap, publish_directory
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class SharedArrays:
+    """
+    Named arrays published by one process into memory-mapped files, so that other processes on the same host can attach to
+    them without loading or copying the data. All the attached processes share the same pages of the page cache, so a new
+    process needs no extra resident memory for the arrays. A directory on a RAM-backed file system, e.g. `/dev/shm`, keeps
+    the pages in memory even under memory pressure.
+
+    The arrays are stored in `dir_path` as raw `.data` files, `meta.json` with their dtypes and shapes is written last and the
+    directory is renamed into place, so a process never attaches to partially written arrays.
+
+    Attributes:
+        dir_path: str  Path to the directory with the arrays.
+    """
+
+    def __init__(self, dir_path: str):
+        self.dir_path = dir_path
+
+    def _data_path(self, dir_path: str, name: str) -> str:
+        return os.path.join(dir_path, f'{name}.data')
+
+    def publish(self, arrays: Dict[str, np.ndarray]):
+        """
+        Write the `arrays`. If another process has published the same arrays in the meantime, its files are kept.
+        """
+        tmp_path = f'{self.dir_path}.tmp-{os.getpid()}'
+        os.makedirs(tmp_path, exist_ok=True)
+
+        meta = {}
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            array.tofile(self._data_path(tmp_path, name))
+            meta[name] = {'dtype': array.dtype.str, 'shape': list(array.shape)}
+        with open(os.path.join(tmp_path, 'meta.json'), 'w', encoding='utf8') as f:
+            json.dump(meta, f)
+        publish_directory(tmp_path, self.dir_path)
+
+    def attach(self) -> Dict[str, np.ndarray]:
+        """
+        Memory-map the published arrays. Return `None` if nothing has been published in `dir_path` yet.
+        """
+        meta_path = os.path.join(self.dir_path, 'meta.json')
+        if not os.path.isfile(meta_path):
+            return None
+
+        with open(meta_path, 'r', encoding='utf8') as f:
+            meta = json.load(f)
+
+        return {
+            name: cow_memmap(self._data_path(self.dir_path, name), np.dtype(info['dtype']), tuple(info['shape']))
+            for name, info in meta.items()
+        }
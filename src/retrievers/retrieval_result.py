@@ -0,0 +1,86 @@
+from collections.abc import Sequence
+from typing import Any, List, Tuple
+
+import numpy as np
+
+
+class LazyDocuments(Sequence):
+    """
+    Read-only list of document texts that are fetched from the knowledge base only when accessed. Fetched texts are kept,
+    so every document is looked up at most once.
+
+    Attributes:
+        knowledge_base: Dataset  Dataset the documents belong to.
+        ids: List[int]  Ids of the documents.
+    """
+
+    def __init__(self, knowledge_base: Any, ids: List[int]):
+        self.knowledge_base = knowledge_base
+        self.ids = ids
+        self.texts = {}
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def _get(self, idx: int) -> str:
+        if idx not in self.texts:
+            self.texts[idx] = self.knowledge_base.get_document(int(self.ids[idx]))
+        return self.texts[idx]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self._get(i) for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError('LazyDocuments index out of range')
+        return self._get(idx)
+
+    def __repr__(self) -> str:
+        return f'LazyDocuments({len(self)} documents)'
+
+
+class RetrievalResult:
+    """
+    Compact result of a retrieval for one query. Positions and scores are kept as numpy arrays, document ids are mapped and
+    texts are fetched from the knowledge base only when they are read.
+
+    Attributes:
+        positions: np.ndarray  Positions of the retrieved documents in the knowledge base, best first.
+        scores: np.ndarray  Similarities of the retrieved documents.
+        knowledge_base: Dataset  Dataset the positions refer to.
+        document_ids: np.ndarray  Optional ids of all the documents in the knowledge base, in the order of positions. Shared by
+            the results of one retriever to avoid `Dataset.map_topK` rebuilding the id list for every result.
+    """
+
+    def __init__(self, positions: np.ndarray, scores: np.ndarray, knowledge_base: Any, document_ids: np.ndarray = None):
+        self.positions = positions
+        self.scores = scores
+        self.knowledge_base = knowledge_base
+        self.document_ids = document_ids
+        self._ids = None
+        self._texts = None
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    @property
+    def ids(self) -> List[int]:
+        if self._ids is None:
+            if self.document_ids is not None:
+                self._ids = self.document_ids[self.positions].tolist()
+            else:
+                self._ids = self.knowledge_base.map_topK(self.positions.tolist())
+        return self._ids
+
+    @property
+    def texts(self) -> LazyDocuments:
+        if self._texts is None:
+            self._texts = LazyDocuments(self.knowledge_base, self.ids)
+        return self._texts
+
+    def to_output(self) -> Tuple[LazyDocuments, List[int]]:
+        """
+        Convert the result into the `(documents, ids)` output of `Retriever.retrieve`.
+        """
+        return self.texts, self.ids
@@ -1,4 +1,8 @@
-from typing import Any
+from typing import Any, Dict, Iterable, List, Tuple
+
+import numpy as np
+
+from src.datasets.retrieved_documents import RetrievedDocuments
 from src.module import Module
 
 
@@ -10,23 +14,136 @@ class Retriever(Module):
         name (str): The name of the retriever.
         top_k (int): The number of documents to retrieve.
         knowledge_base (Any): The knowledge base to use for retrieval.
+
+    Retrievers with `supports_dates` accept the publication time of the query as `query_date` in `retrieve` and
+    `query_dates` in `retrieve_batch`. Other retrievers ignore the dates.
     """
+    supports_dates = False
+
     def __init__(self, name: str = 'bm25', top_k: int = 5, knowledge_base: Any = None, **kwargs):
         self.name = name
         self.top_k = top_k
 
         self.knowledge_base = knowledge_base
+        self.prefetched = {}
 
     def retrieve(self, query: str) -> Any:
         raise NotImplementedError
+
+    def retrieve_batch(self, queries: List[str]) -> List[Any]:
+        """
+        Retrieve documents for multiple queries at once. Subclasses should override this method if they can process
+        the queries more efficiently together.
+        
+        Args:
+            queries (List[str]): The queries to retrieve documents for.
+            
+        Returns:
+            List[Any]: The output of `retrieve` for each query.
+        """
+        return [self.retrieve(query) for query in queries]
+
+    def retrieve_scored(self, queries: List[str]) -> List[Tuple[List[int], np.ndarray]]:
+        """
+        Retrieve the ids of the top-k documents together with their scores for multiple queries. Used to fuse the results
+        of several retrievers, see `Hybrid`.
+        
+        Args:
+            queries (List[str]): The queries to retrieve documents for.
+            
+        Returns:
+            List[Tuple[List[int], np.ndarray]]: Ids of the documents, best first, and their scores for each query.
+        """
+        raise NotImplementedError
+
+    def prefetch(self, queries: List[str], query_dates: List[float] = None) -> None:
+        """
+        Retrieve documents for all the `queries` with `retrieve_batch` and keep the results. Subsequent calls of the
+        retriever with one of these queries reuse the results instead of running the retrieval again.
+        
+        Args:
+            queries (List[str]): The queries that will be processed next.
+            query_dates (List[float]): Publication times of the queries, see `supports_dates`.
+        """
+        if query_dates is None or not self.supports_dates:
+            queries = list(dict.fromkeys(queries))
+            self.prefetched = dict(zip(queries, self.retrieve_batch(queries)))
+            return
+
+        keys = list(dict.fromkeys(zip(queries, query_dates)))
+        outputs = self.retrieve_batch([query for query, _ in keys], query_dates=[date for _, date in keys])
+        self.prefetched = {
+            self._prefetch_key(query, date): output
+            for (query, date), output in zip(keys, outputs)
+        }
+
+    def _prefetch_key(self, query: str, query_date: float = None) -> Any:
+        return (query, query_date) if self.supports_dates and query_date is not None else query
     
     def __call__(self, **kwargs: Any) -> Any:
-        output = self.retrieve(**kwargs)
         query = kwargs['query']
+        query_date = kwargs.pop('query_date', None)
+        if query_date is not None and self.supports_dates:
+            kwargs['query_date'] = query_date
+        key = self._prefetch_key(query, query_date)
+
+        if set(kwargs) <= {'query', 'query_date'} and key in self.prefetched:
+            output = self.prefetched[key]
+        else:
+            output = self.retrieve(**kwargs)
         return self.convert_to_dict(query, output)
 
     def set_knowledge_base(self, knowledge_base: Any):
         self.knowledge_base = knowledge_base
+        self.prefetched = {}
+
+    def add_documents(self, documents: Dict[int, str], **metadata: Any):
+        """
+        Add new documents to the knowledge base, or replace the texts of existing ids. Retrievers with indexes that can be
+        updated incrementally should override this method, the default implementation rebuilds the retriever for the whole
+        knowledge base.
+        
+        Args:
+            documents (Dict[int, str]): Ids and texts of the new documents.
+            metadata (Any): Metadata of the new documents passed to the knowledge base, e.g. `language_distributions` and
+                `dates` of `MultiClaimDataset`, so that the new documents are matched by the language and date filters.
+        """
+        self.knowledge_base.add_documents(documents, **metadata)
+        self.set_knowledge_base(self.knowledge_base)
+
+    def remove_documents(self, ids: Iterable[int]):
+        """
+        Remove documents with `ids` from the knowledge base. See `add_documents`.
+        
+        Args:
+            ids (Iterable[int]): Ids of the removed documents.
+        """
+        self.knowledge_base.remove_documents(ids)
+        self.set_knowledge_base(self.knowledge_base)
+
+    def close(self):
+        """
+        Release the resources held by the retriever, e.g. background threads of its vectorizers. Retrievers without such
+        resources do not need to override this method.
+        """
+        pass
+
+    def set_candidates(self, documents: List[str], ids: List[int], parent: Any = None):
+        """
+        Restrict the retrieval to the documents returned by a previous retriever in a chain. By default, the candidates
+        become a new knowledge base. Subclasses with an index over the whole `parent` knowledge base should override this
+        method and score only the candidate rows of that index.
+        
+        Args:
+            documents (List[str]): Texts of the candidate documents.
+            ids (List[int]): Ids of the candidate documents.
+            parent (Any): Knowledge base of the previous retriever the ids belong to.
+        """
+        self.set_knowledge_base(RetrievedDocuments(
+            name='retrieved_documents',
+            documents=documents,
+            ids=ids
+        ))
     
     def convert_to_dict(self, query, output):
         return {
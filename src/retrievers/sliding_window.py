@@ -0,0 +1,116 @@
+"""
+Sliding window scoring for long queries. Queries are split into windows, all the windows are encoded and scored together and
+their similarities are pooled back into one row per query.
+"""
+import logging
+from functools import lru_cache
+from typing import Generator, List, Tuple
+
+import nltk
+from nltk.tokenize import sent_tokenize
+import torch
+
+from src.datasets.cleaning import replace_stops, replace_whitespaces
+
+nltk.download('punkt')
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=100000)
+def split_sentences(text: str) -> Tuple[str, ...]:
+    """
+    Cached sentence segmentation of a whitespace-normalized `text`. Posts are often scored repeatedly, e.g. for different
+    languages or knowledge bases, so the NLTK tokenizer runs only once per post.
+    """
+    return tuple(sent_tokenize(replace_stops(text)))
+
+
+def slice_text(text, window_type, window_size, window_stride=None) -> List[str]:
+    """
+    Split a `text` into parts using a sliding window. The windows slides either across characters or sentences, based on the value of `window_tyoe`.
+
+    Attributes:
+        text: str  Text that is to be splitted into windows.
+        window_type: str  Either `sentence` or `character`. The basic unit of the windows.
+        window_size: int  How many units are in a window.
+        window_stride: int  How many units are skipped each time the window moves.
+    """
+
+    text = replace_whitespaces(text)
+
+    if window_stride is None:
+        window_stride = window_size
+
+    if window_size < window_stride:
+        logger.warning(
+            f'Window size ({window_size}) is smaller than stride length ({window_stride}). This will result in missing chunks of text.')
+
+    if window_type == 'sentence':
+        sentences = split_sentences(text)
+        return [
+            ' '.join(sentences[i:i+window_size])
+            for i in range(0, len(sentences), window_stride)
+        ]
+
+    elif window_type == 'character':
+        return [
+            text[i:i+window_size]
+            for i in range(0, len(text), window_stride)
+        ]
+
+
+def gen_sliding_window_delimiters(post_lengths: List[int], max_size: int) -> Generator[Tuple[int, int], None, None]:
+    """
+    Calculate where to split the sequence of `post_lenghts` so that the individual batches do not exceed `max_size`. A post
+    longer than `max_size` gets a batch of its own.
+    """
+    range_length = start = cur_sum = 0
+
+    for post_length in post_lengths:
+        if (range_length + post_length) > max_size and range_length > 0:  # exceeds memory
+            yield (start, start + range_length)
+            start = cur_sum
+            range_length = post_length
+        else:  # memory still avail in current split
+            range_length += post_length
+        cur_sum += post_length
+
+    if range_length > 0:
+        yield (start, start + range_length)
+
+
+def split_windows(texts: List[str], window_type: str, window_size: int, window_stride: int = None) -> Tuple[List[str], torch.tensor]:
+    """
+    Split all the `texts` into windows. Return the flat list of windows and a `segments` tensor with the index of the text for
+    each window. Texts without any window are represented by themselves.
+    """
+    windows = []
+    counts = []
+    for text in texts:
+        text_windows = slice_text(text, window_type, window_size, window_stride) or [text]
+        windows.extend(text_windows)
+        counts.append(len(text_windows))
+
+    segments = torch.repeat_interleave(torch.arange(len(texts)), torch.tensor(counts, dtype=torch.long))
+    return windows, segments
+
+
+POOLING = {
+    'max': 'amax',
+    'min': 'amin',
+    'mean': 'mean',
+    'sum': 'sum',
+}
+
+
+def pool_windows(sims: torch.tensor, segments: torch.tensor, pooling: str = 'max') -> torch.tensor:
+    """
+    Aggregate similarities of windows (`W x N`) into one row per segment with a native `scatter_reduce`. `segments` has to start
+    at 0 and windows of the same segment have to be contiguous.
+    """
+    num_segments = int(segments[-1]) + 1 if len(segments) else 0
+    index = segments.to(sims.device).unsqueeze(1).expand_as(sims)
+    return torch.zeros((num_segments, sims.shape[1]), device=sims.device, dtype=sims.dtype).scatter_reduce_(
+        0, index, sims, reduce=POOLING[pooling], include_self=False)
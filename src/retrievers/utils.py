@@ -0,0 +1,91 @@
+import hashlib
+import os
+import shutil
+import string
+from functools import lru_cache
+from typing import Any, Iterable, Tuple
+
+import numpy as np
+import torch
+from unidecode import unidecode
+
+
+def fingerprint(texts: Iterable[str], *params: Any) -> str:
+    """
+    Calculate a short fingerprint of a collection of `texts` and additional `params`. It is used to key cached
+    indexes so that they are reused only for exactly the same knowledge base and settings.
+
+    Attributes:
+        texts: Iterable[str]  Texts of the knowledge base in their original order.
+        params: Any  Additional settings that influence the index, e.g. number of clusters.
+    """
+    digest = hashlib.sha1()
+    for param in params:
+        digest.update(repr(param).encode('utf8'))
+        digest.update(b'\x00')
+    for text in texts:
+        digest.update(text.encode('utf8'))
+        digest.update(b'\x00')
+    return digest.hexdigest()[:16]
+
+
+def append_rows(storage: torch.tensor, size: int, rows: torch.tensor) -> torch.tensor:
+    """
+    Write `rows` after the first `size` rows of a preallocated `storage` tensor. When the storage is full, its capacity is doubled,
+    so appending costs time proportional to the number of new rows on average. Return the storage, which might be a new tensor.
+    """
+    if len(storage) < size + len(rows):
+        capacity = max(len(storage), 1)
+        while capacity < size + len(rows):
+            capacity *= 2
+        grown = storage.new_empty((capacity, *storage.shape[1:]))
+        grown[:size] = storage[:size]
+        storage = grown
+
+    storage[size:size + len(rows)] = rows.to(device=storage.device, dtype=storage.dtype)
+    return storage
+
+
+def publish_directory(tmp_path: str, path: str):
+    """
+    Atomically rename a completely written `tmp_path` directory to `path`, so readers never see partially written files. If
+    another process has published the same data into `path` in the meantime, its files are kept and `tmp_path` is removed.
+    """
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        shutil.rmtree(tmp_path)
+
+
+def cow_memmap(path: str, dtype: Any, shape: Tuple[int, ...]) -> np.memmap:
+    """
+    Memory-map a raw array file in copy-on-write mode. The pages are shared with other processes mapping the same file and the
+    torch tensors created from the mapping are writable, but writes never reach the file.
+    """
+    return np.memmap(path, dtype=dtype, mode='c', shape=shape)
+
+
+# Compiled once, `str.translate` removes all the punctuation in a single pass
+PUNCTUATION_TABLE = str.maketrans('', '', string.punctuation)
+
+
+@lru_cache(maxsize=100000)
+def cached_unidecode(text: str) -> str:
+    """
+    `unidecode` with a cache. The same posts are queried repeatedly, e.g. for every language of the knowledge base.
+    """
+    return unidecode(text)
+
+
+def normalize_query(query: str, use_unidecode: bool = True) -> str:
+    """
+    Normalize the query for the Terrier parser: transliterate it into ascii, remove punctuation and replace an empty query
+    with `unk`.
+    """
+    if use_unidecode:
+        query = cached_unidecode(query)
+
+    query = query.translate(PUNCTUATION_TABLE).strip()
+
+    # Hand empty text cases
+    return query or 'unk'
@@ -0,0 +1,69 @@
+import time
+from typing import Any, Callable, Dict, List
+
+import numpy as np
+import torch
+
+
+def token_budget_batches(lengths: np.ndarray, max_tokens: int, max_batch_size: int = None) -> List[np.ndarray]:
+    """
+    Group texts with token `lengths` into batches of similar lengths. Texts are sorted from the longest one and a batch is closed when
+    its padded size (number of texts times the longest length) would exceed `max_tokens` or it has `max_batch_size` texts. A text longer
+    than `max_tokens` gets a batch of its own. Return the indices of the texts in each batch.
+    """
+    order = np.argsort(-np.asarray(lengths), kind='stable')
+
+    batches, batch = [], []
+    for index in order:
+        # The first text of a batch is the longest one, so it determines the padded length
+        if batch and ((len(batch) + 1) * lengths[batch[0]] > max_tokens or (max_batch_size and len(batch) >= max_batch_size)):
+            batches.append(np.array(batch))
+            batch = []
+        batch.append(index)
+    if batch:
+        batches.append(np.array(batch))
+    return batches
+
+
+def encode_bucketed(
+    texts: List[str],
+    tokenizer: Any,
+    forward: Callable[[Dict[str, torch.tensor]], torch.tensor],
+    max_tokens: int,
+    max_length: int = 512,
+    max_batch_size: int = None,
+    stats: Dict[str, float] = None,
+) -> torch.tensor:
+    """
+    Encode `texts` in batches formed by `token_budget_batches`. The texts are tokenized only once, each batch is padded to its own longest
+    text and passed to `forward`. The embeddings are returned in the original order of the `texts`. If `stats` is set, the number of
+    texts, batches, real and padded tokens and the elapsed time are added to it.
+    """
+    start = time.perf_counter()
+    encodings = tokenizer(texts, truncation=True, max_length=max_length)
+    lengths = np.array([len(input_ids) for input_ids in encodings['input_ids']])
+
+    embeddings = None
+    batches = token_budget_batches(lengths, max_tokens, max_batch_size)
+    for batch in batches:
+        features = tokenizer.pad(
+            {key: [encodings[key][i] for i in batch] for key in encodings.keys()},
+            return_tensors='pt'
+        )
+        batch_embeddings = forward(features)
+        if embeddings is None:
+            embeddings = torch.empty(
+                (len(texts), batch_embeddings.shape[1]),
+                dtype=batch_embeddings.dtype,
+                device=batch_embeddings.device
+            )
+        embeddings[torch.from_numpy(batch).to(embeddings.device)] = batch_embeddings
+
+    if stats is not None:
+        stats['texts'] += len(texts)
+        stats['batches'] += len(batches)
+        stats['tokens'] += int(lengths.sum())
+        stats['padded_tokens'] += int(sum(len(batch) * lengths[batch].max() for batch in batches))
+        stats['seconds'] += time.perf_counter() - start
+
+    return embeddings
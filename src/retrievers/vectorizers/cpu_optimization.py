@@ -0,0 +1,61 @@
+import contextlib
+import logging
+
+import torch
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+CPU_OPTIMIZATIONS = (None, 'int8', 'bf16')
+
+
+def bf16_supported() -> bool:
+    """
+    Check whether the CPU has native bf16 kernels (AVX512-BF16 or AMX). Without them, bf16 is emulated and slower than float32.
+    """
+    try:
+        return torch.backends.mkldnn.is_available() and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def optimize_for_cpu(model: torch.nn.Module, optimization: str = None, num_threads: int = None) -> torch.nn.Module:
+    """
+    Prepare a `model` for CPU inference. `int8` replaces the linear layers with dynamically quantized ones (weights are stored in int8,
+    activations are quantized on the fly), `bf16` is applied during inference with `cpu_autocast`. `num_threads` sets the number of intra-op
+    threads of torch for the whole process.
+    """
+    assert optimization in CPU_OPTIMIZATIONS
+
+    if num_threads:
+        torch.set_num_threads(num_threads)
+
+    if optimization == 'int8':
+        model = torch.ao.quantization.quantize_dynamic(model.cpu().eval(), {torch.nn.Linear}, dtype=torch.qint8)
+        logger.info('Linear layers quantized to int8')
+
+    return model
+
+
+def cpu_autocast(optimization: str):
+    """
+    Context for the inference of a model prepared by `optimize_for_cpu`. With `bf16`, the matrix multiplications run in bf16 if the CPU supports it.
+    """
+    if optimization == 'bf16':
+        if bf16_supported():
+            return torch.autocast(device_type='cpu', dtype=torch.bfloat16)
+        logger.warning('bf16 is not supported by this CPU, float32 is used instead')
+    return contextlib.nullcontext()
+
+
+def compile_model(model: torch.nn.Module) -> torch.nn.Module:
+    """
+    Compile the `model` into an optimized graph with `torch.compile`. The first batches of every new shape are slower because of the
+    compilation, so it pays off only for long-running encoding.
+    """
+    if not hasattr(torch, 'compile'):
+        logger.warning('torch.compile is not available, the model runs in eager mode')
+        return model
+    return torch.compile(model, dynamic=True)
@@ -1,7 +1,10 @@
-from typing import List
+import time
+from typing import Any, Dict, List
 
 import torch
 
+from src.retrievers.vectorizers.batching import encode_bucketed
+from src.retrievers.vectorizers.cpu_optimization import bf16_supported, compile_model, optimize_for_cpu
 from src.retrievers.vectorizers.vectorizer import Vectorizer
 
 
@@ -18,21 +21,35 @@ class PytorchVectorizer(Vectorizer):
         tokenizer = None,
         batch_size: int = 32,
         dtype: torch.dtype = torch.float32,
-        port_embeddings_to_cpu: bool = True
+        port_embeddings_to_cpu: bool = True,
+        max_tokens: int = None,
+        cpu_optimization: str = None,
+        num_threads: int = None,
+        compile_graph: bool = False,
+        **kwargs
     ):
         """
         Attributes:
-            dir_path: str  Path to cached vectors and vocab files.
+            dir_path: str  Path to cached vectors and vocab files. With `cpu_optimization`, the vectors are cached in its subdirectory
+                (e.g. `dir_path/int8`), so that the approximated vectors are never mixed with the float32 ones.
             model_handle: str  Name of the model, either a HuggingFace repository handle or path to a local model.
             model: SentenceTransformer  A loaded model -- this option can be used during fine-tuning.
             tokenizer: AutoTokenizer  A tokenizer for the model.
             batch_size: int  Batch size for inference
             dtype: torch.dtype  Inference dtype
             port_embeddings_to_cpu: bool  Whether to move the embeddings to CPU after inference.
+            max_tokens: int  Token budget of a batch. If set, texts are tokenized once, sorted by their length and batched so that every
+                padded batch has at most `max_tokens` tokens, with at most `batch_size` texts. See `get_batching_stats` for the share of padding.
+            cpu_optimization: str  Opt-in CPU fast path, `int8` for dynamically quantized linear layers or `bf16` for bf16 autocast (overrides `dtype`). See
+                `optimize_for_cpu` and `scripts/benchmark_cpu_encoding.py` for the drift and speed against the float32 path.
+            num_threads: int  Number of intra-op torch threads. `None` keeps the torch default.
+            compile_graph: bool  Compile the encoder with `torch.compile`.
+            kwargs: Any  Caching options of `Vectorizer`, e.g. `write_behind`.
         """
         
-        super().__init__(dir_path)
+        super().__init__(dir_path, cache_variant=cpu_optimization, **kwargs)
         
+        self.model_handle = model_handle
         if model_handle:
             self.model = torch.load(model_handle)
             self.model.eval()        
@@ -46,27 +63,61 @@ class PytorchVectorizer(Vectorizer):
         self.batch_size = batch_size
         self.dtype = dtype
         self.port_embeddings_to_cpu = port_embeddings_to_cpu
+        self.max_tokens = max_tokens
+
+        self.cpu_optimization = cpu_optimization
+        self.num_threads = num_threads
+        self.compile_graph = compile_graph
+        if cpu_optimization:
+            assert self.device == 'cpu', 'CPU optimizations require a model on CPU.'
+        if cpu_optimization == 'bf16' and bf16_supported():
+            self.dtype = torch.bfloat16
+        self.model = optimize_for_cpu(self.model, cpu_optimization, num_threads)
+        if compile_graph:
+            self.model = compile_model(self.model)
 
         
+    def worker_config(self) -> Dict[str, Any]:
+        if not self.model_handle:
+            return None
+        return {
+            'model_handle': self.model_handle,
+            'tokenizer': self.tokenizer,
+            'batch_size': self.batch_size,
+            'dtype': self.dtype,
+            'max_tokens': self.max_tokens,
+            'cpu_optimization': self.cpu_optimization,
+            'compile_graph': self.compile_graph,
+        }
+
     def _calculate_vectors(self, texts: List[str]) -> torch.tensor:
 
         @torch.autocast(device_type=self.device.split(':')[0], dtype=self.dtype)
         @torch.no_grad()
-        def embedding_pipeline(text: List[str], tokenizer, model, device, max_length = 512):
-            tokenized = tokenizer(text, padding=True, truncation=True, max_length=max_length, return_tensors='pt').to(device)
-            embeddings = model(**tokenized)
+        def forward(tokenized):
+            embeddings = self.model(**tokenized.to(self.device))
             return embeddings.cpu() if self.port_embeddings_to_cpu else embeddings
 
-        return torch.vstack(
-                [
-                    embedding_pipeline(
-                        texts[i:i+self.batch_size], 
-                        self.tokenizer, 
-                        self.model, 
-                        device=self.device, 
-                        max_length=512
-                    ) 
-                    for i in range(0, len(texts), self.batch_size)
-                ]
+        if self.max_tokens:
+            return encode_bucketed(
+                texts,
+                self.tokenizer,
+                forward,
+                self.max_tokens,
+                max_length=512,
+                max_batch_size=self.batch_size,
+                stats=self.batching_stats
             )
-            
\ No newline at end of file
+
+        start = time.perf_counter()
+        embeddings = []
+        for i in range(0, len(texts), self.batch_size):
+            tokenized = self.tokenizer(texts[i:i+self.batch_size], padding=True, truncation=True, max_length=512, return_tensors='pt')
+            self.batching_stats['tokens'] += int(tokenized['attention_mask'].sum())
+            self.batching_stats['padded_tokens'] += tokenized['attention_mask'].numel()
+            embeddings.append(forward(tokenized))
+
+        self.batching_stats['texts'] += len(texts)
+        self.batching_stats['batches'] += len(embeddings)
+        self.batching_stats['seconds'] += time.perf_counter() - start
+        return torch.vstack(embeddings)
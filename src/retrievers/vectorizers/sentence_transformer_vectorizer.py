@@ -1,8 +1,11 @@
-from typing import List
+import time
+from typing import Any, Dict, List
 
 from sentence_transformers import SentenceTransformer
 import torch
 
+from src.retrievers.vectorizers.batching import encode_bucketed
+from src.retrievers.vectorizers.cpu_optimization import compile_model, cpu_autocast, optimize_for_cpu
 from src.retrievers.vectorizers.vectorizer import Vectorizer
 
 
@@ -16,31 +19,99 @@ class SentenceTransformerVectorizer(Vectorizer):
         dir_path: str,
         model_handle: str = None,
         model: SentenceTransformer = None,
-        batch_size: int = 32
+        batch_size: int = 32,
+        max_tokens: int = None,
+        cpu_optimization: str = None,
+        num_threads: int = None,
+        compile_graph: bool = False,
+        **kwargs
     ):
         """
         Attributes:
-            dir_path: str  Path to cached vectors and vocab files.
+            dir_path: str  Path to cached vectors and vocab files. With `cpu_optimization`, the vectors are cached in its subdirectory
+                (e.g. `dir_path/int8`), so that the approximated vectors are never mixed with the float32 ones.
             model_handle: str  Name of the model, either a HuggingFace repository handle or path to a local model.
             model: SentenceTransformer  A loaded model -- this option can be used during fine-tuning.
+            batch_size: int  Batch size for inference. With `max_tokens`, the maximum number of texts in a batch.
+            max_tokens: int  Token budget of a batch. If set, texts are tokenized once, sorted by their length and batched so that every
+                padded batch has at most `max_tokens` tokens. See `get_batching_stats` for the share of padding.
+            cpu_optimization: str  Opt-in CPU fast path, `int8` for dynamically quantized linear layers or `bf16` for bf16 autocast. See
+                `optimize_for_cpu` and `scripts/benchmark_cpu_encoding.py` for the drift and speed against the float32 path.
+            num_threads: int  Number of intra-op torch threads. `None` keeps the torch default.
+            compile_graph: bool  Compile the encoder with `torch.compile`.
+            kwargs: Any  Caching options of `Vectorizer`, e.g. `write_behind`.
         """
         
-        super().__init__(dir_path)
+        super().__init__(dir_path, cache_variant=cpu_optimization, **kwargs)
         
+        self.model_handle = model_handle
         if model_handle:
             self.model = SentenceTransformer(model_handle)
         else:
             self.model = model
             
         self.batch_size = batch_size
+        self.max_tokens = max_tokens
             
         assert self.model
+
+        self.cpu_optimization = cpu_optimization
+        self.num_threads = num_threads
+        self.compile_graph = compile_graph
+        self.model = optimize_for_cpu(self.model, cpu_optimization, num_threads)
+        if compile_graph:
+            self.model[0].auto_model = compile_model(self.model[0].auto_model)
         
         
+    def worker_config(self) -> Dict[str, Any]:
+        if not self.model_handle:
+            return None
+        return {
+            'model_handle': self.model_handle,
+            'batch_size': self.batch_size,
+            'max_tokens': self.max_tokens,
+            'cpu_optimization': self.cpu_optimization,
+            'compile_graph': self.compile_graph,
+        }
+
+    def _forward(self, features: Dict[str, torch.tensor]) -> torch.tensor:
+        with torch.no_grad():
+            features = {key: value.to(self.model.device) for key, value in features.items()}
+            return self.model(features)['sentence_embedding']
+
     def _calculate_vectors(self, texts: List[str]) -> torch.tensor:
-        
-        return self.model.encode(
+        with cpu_autocast(self.cpu_optimization):
+            return self._encode(texts)
+
+    def _preprocess(self, texts: List[str]) -> List[str]:
+        """
+        Prepare the texts the same way as `SentenceTransformer.tokenize` before they are passed to the tokenizer directly: strip the
+        whitespace and lowercase them if the model is uncased.
+        """
+        texts = [str(text).strip() for text in texts]
+        if getattr(self.model[0], 'do_lower_case', False):
+            texts = [text.lower() for text in texts]
+        return texts
+
+    def _encode(self, texts: List[str]) -> torch.tensor:
+        if self.max_tokens:
+            return encode_bucketed(
+                self._preprocess(texts),
+                self.model.tokenizer,
+                self._forward,
+                self.max_tokens,
+                max_length=self.model.max_seq_length,
+                max_batch_size=self.batch_size,
+                stats=self.batching_stats
+            )
+
+        start = time.perf_counter()
+        vectors = self.model.encode(
             texts,
             batch_size=self.batch_size,
             convert_to_numpy=False,
-        )
\ No newline at end of file
+        )
+        self.batching_stats['texts'] += len(texts)
+        self.batching_stats['batches'] += (len(texts) + self.batch_size - 1) // self.batch_size
+        self.batching_stats['seconds'] += time.perf_counter() - start
+        return vectors
\ No newline at end of file
@@ -0,0 +1,389 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+from typing import List, Tuple
+
+import numpy as np
+import torch
+
+from src.retrievers.utils import cow_memmap
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def hash_texts(texts: List[str]) -> np.ndarray:
+    """
+    Calculate int64 content hashes for `texts`.
+    """
+    return np.array([
+        int.from_bytes(hashlib.blake2b(text.encode('utf8'), digest_size=8).digest(), 'little', signed=True)
+        for text in texts
+    ], dtype=np.int64)
+
+
+def normalize_vectors(vectors: torch.tensor) -> Tuple[torch.tensor, torch.tensor]:
+    """
+    L2-normalize float32 `vectors` and return them together with their original norms.
+    """
+    vectors = vectors.detach().cpu().to(torch.float32)
+    norms = torch.linalg.vector_norm(vectors, ord=2, dim=1)
+    return vectors / norms.clamp_min(1e-12).unsqueeze(1), norms
+
+
+class HashIndex:
+    """
+    Compact index from int64 hashes to rows. Hashes are kept in a sorted numpy array and looked up with binary search, so
+    the cost of a lookup depends only on the number of queried hashes.
+    """
+
+    def __init__(self):
+        self.sorted_keys = np.zeros(0, dtype=np.int64)
+        self.order = np.zeros(0, dtype=np.int64)
+
+    def __len__(self) -> int:
+        return len(self.sorted_keys)
+
+    def add(self, hashes: np.ndarray, rows: np.ndarray):
+        """
+        Merge new `hashes` pointing to `rows` into the index.
+        """
+        order = np.argsort(hashes, kind='stable')
+        positions = np.searchsorted(self.sorted_keys, hashes[order])
+        self.sorted_keys = np.insert(self.sorted_keys, positions, hashes[order])
+        self.order = np.insert(self.order, positions, rows[order])
+
+    def lookup(self, hashes: np.ndarray) -> np.ndarray:
+        """
+        Find rows for `hashes`. Missing hashes get `-1`.
+        """
+        rows = np.full(len(hashes), -1, dtype=np.int64)
+        if len(self.sorted_keys) == 0:
+            return rows
+
+        positions = np.searchsorted(self.sorted_keys, hashes)
+        positions = np.minimum(positions, len(self.sorted_keys) - 1)
+        found = self.sorted_keys[positions] == hashes
+        rows[found] = self.order[positions[found]]
+        return rows
+
+
+class VectorArena:
+    """
+    In-memory storage of vectors in one growable contiguous matrix. Vectors are stored L2-normalized together with their
+    original norms, so normalized vectors can be gathered without any further computation.
+
+    Attributes:
+        capacity: int  Initial number of rows. The matrix doubles its size when it is full.
+    """
+
+    def __init__(self, capacity: int = 1024):
+        self.capacity = capacity
+        self.size = 0
+        self.vectors = None
+        self.norms = None
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.index = HashIndex()
+
+    def __len__(self) -> int:
+        return self.size
+
+    def lookup(self, hashes: np.ndarray) -> np.ndarray:
+        return self.index.lookup(hashes)
+
+    def get(self, rows: np.ndarray) -> Tuple[torch.tensor, torch.tensor]:
+        rows = torch.from_numpy(rows)
+        return self.vectors.index_select(0, rows), self.norms.index_select(0, rows)
+
+    def _grow(self, size: int, dim: int):
+        capacity = max(self.capacity, 1)
+        while capacity < size:
+            capacity *= 2
+
+        vectors = torch.empty((capacity, dim), dtype=torch.float32)
+        norms = torch.empty(capacity, dtype=torch.float32)
+        if self.vectors is not None:
+            vectors[:self.size] = self.vectors[:self.size]
+            norms[:self.size] = self.norms[:self.size]
+
+        self.vectors, self.norms, self.capacity = vectors, norms, capacity
+
+    def append(self, hashes: np.ndarray, vectors: torch.tensor):
+        """
+        Add `vectors` for `hashes`. The caller is responsible for not adding hashes that are already present.
+        """
+        vectors, norms = normalize_vectors(vectors)
+        if self.vectors is None or self.size + len(vectors) > self.capacity:
+            self._grow(self.size + len(vectors), vectors.shape[1])
+
+        rows = np.arange(self.size, self.size + len(vectors), dtype=np.int64)
+        self.vectors[self.size:self.size + len(vectors)] = vectors
+        self.norms[self.size:self.size + len(vectors)] = norms
+        self.keys = np.concatenate([self.keys, hashes])
+        self.index.add(hashes, rows)
+        self.size += len(vectors)
+
+    def data(self) -> Tuple[np.ndarray, torch.tensor, torch.tensor]:
+        """
+        Return hashes, normalized vectors and norms of all the stored rows.
+        """
+        return self.keys, self.vectors[:self.size], self.norms[:self.size]
+
+
+class VectorStore:
+    """
+    Append-only on-disk storage of vectors used by `Vectorizer` as its cache. Vectors are keyed by 64-bit content hashes
+    of their texts, so the texts themselves are never stored or parsed.
+
+    The data are stored in `dir_path/segments`. Each segment consists of a `.vectors` file with raw float32 L2-normalized rows,
+    a `.norms` file with the original norms of the rows and a `.keys` file with int64 hashes of the corresponding texts. The `.keys`
+    file is written last, a segment without it is considered incomplete and is ignored. Segment ids are claimed by creating the
+    `.vectors` file exclusively, so several processes can append to one store. Vectors are memory-mapped when the store
+    is opened, so only the hashes are read into memory. New vectors are always written into a new segment and the existing segments
+    are never rewritten. When the store is opened with more than `max_segments` segments, its small segments are merged into one,
+    see `compact`.
+
+    Attributes:
+        dir_path: str  Path to the directory with the store.
+        dim: int  Dimension of the stored vectors. Known after the first segment is written.
+        max_segments: int  Number of segments above which the small segments are merged when the store is opened.
+        small_segment_size: int  Segments with fewer rows are merged by the compaction.
+    """
+
+    dtype = np.float32
+
+    def __init__(self, dir_path: str, max_segments: int = 32, small_segment_size: int = 65536):
+        self.dir_path = dir_path
+        self.segments_path = os.path.join(dir_path, 'segments')
+        self.meta_path = os.path.join(dir_path, 'meta.json')
+        self.lock_path = os.path.join(dir_path, 'compaction.lock')
+        self.max_segments = max_segments
+        self.small_segment_size = small_segment_size
+
+        self.dim = None
+        self.next_segment_id = 0
+        self.segments = []
+        self.segment_norms = []
+        self.segment_offsets = np.zeros(1, dtype=np.int64)
+        self.index = HashIndex()
+
+    def __len__(self) -> int:
+        return int(self.segment_offsets[-1])
+
+    @staticmethod
+    def hash_texts(texts: List[str]) -> np.ndarray:
+        return hash_texts(texts)
+
+    def _segment_path(self, segment_id: int, suffix: str) -> str:
+        return os.path.join(self.segments_path, f'{segment_id:06d}.{suffix}')
+
+    def _open_segment(self, segment_id: int) -> np.ndarray:
+        """
+        Memory-map a segment and return its keys. The keys are not added to the index.
+        """
+        keys = np.fromfile(self._segment_path(segment_id, 'keys'), dtype=np.int64)
+        vectors = cow_memmap(self._segment_path(segment_id, 'vectors'), self.dtype, (len(keys), self.dim))
+        norms = np.fromfile(self._segment_path(segment_id, 'norms'), dtype=self.dtype)
+
+        start = self.segment_offsets[-1]
+        self.segments.append(vectors)
+        self.segment_norms.append(norms)
+        self.segment_offsets = np.append(self.segment_offsets, start + len(keys))
+        return keys
+
+    def _complete_segments(self) -> List[int]:
+        return sorted(
+            int(file_name.split('.')[0])
+            for file_name in os.listdir(self.segments_path)
+            if file_name.endswith('.keys')
+        )
+
+    def open(self) -> bool:
+        """
+        Memory-map all complete segments. Return `False` if there is no store in `dir_path` yet.
+        """
+        if not os.path.isfile(self.meta_path):
+            return False
+
+        with open(self.meta_path, 'r', encoding='utf8') as f:
+            self.dim = json.load(f)['dim']
+
+        segment_ids = self._complete_segments()
+        self.next_segment_id = segment_ids[-1] + 1 if segment_ids else 0
+        if len(segment_ids) > self.max_segments:
+            self.compact(segment_ids)
+
+        while True:
+            segment_ids = self._complete_segments()
+            self.next_segment_id = max(self.next_segment_id, segment_ids[-1] + 1 if segment_ids else 0)
+            self.segments = []
+            self.segment_norms = []
+            self.segment_offsets = np.zeros(1, dtype=np.int64)
+            self.index = HashIndex()
+            try:
+                keys = [self._open_segment(segment_id) for segment_id in segment_ids]
+                break
+            except FileNotFoundError:
+                # Another process has merged some of the listed segments in the meantime, the merged segment is already complete
+                continue
+
+        if keys:
+            keys = np.concatenate(keys)
+            self.index.add(keys, np.arange(len(keys), dtype=np.int64))
+        return True
+
+    def compact(self, segment_ids: List[int]) -> int:
+        """
+        Merge the complete segments with `segment_ids` that have fewer than `small_segment_size` rows into a new segment, dropping
+        duplicate hashes written by concurrent processes. The merged segment is complete before the old `.keys` files are removed,
+        so a concurrent reader always finds every vector in one of the segments, at worst in both. Processes that have the old
+        segments memory-mapped keep their mappings. Only one process compacts a store at a time, others skip the compaction.
+        Return the id of the merged segment or `None` if nothing was merged.
+        """
+        sizes = [os.path.getsize(self._segment_path(segment_id, 'keys')) // 8 for segment_id in segment_ids]
+        small = [segment_id for segment_id, size in zip(segment_ids, sizes) if size < self.small_segment_size]
+        if len(small) < 2:
+            return None
+
+        lock = open(self.lock_path, 'w')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # Another process is compacting the store
+            lock.close()
+            return None
+
+        try:
+            try:
+                keys = [np.fromfile(self._segment_path(segment_id, 'keys'), dtype=np.int64) for segment_id in small]
+            except FileNotFoundError:
+                # The segments have been merged by a process that has finished in the meantime
+                return None
+            _, first = np.unique(np.concatenate(keys), return_index=True)
+            selected = np.zeros(sum(len(segment_keys) for segment_keys in keys), dtype=bool)
+            selected[first] = True
+
+            segment_id, fd = self._claim_segment()
+            hashes, norms = [], []
+            start = 0
+            with os.fdopen(fd, 'wb') as f:
+                for old_id, segment_keys in zip(small, keys):
+                    rows = selected[start:start + len(segment_keys)]
+                    start += len(segment_keys)
+                    vectors = cow_memmap(self._segment_path(old_id, 'vectors'), self.dtype, (len(segment_keys), self.dim))
+                    np.ascontiguousarray(vectors[rows]).tofile(f)
+                    norms.append(np.fromfile(self._segment_path(old_id, 'norms'), dtype=self.dtype)[rows])
+                    hashes.append(segment_keys[rows])
+            self._finish_segment(segment_id, np.concatenate(norms), np.concatenate(hashes))
+
+            for old_id in small:
+                for suffix in ('keys', 'norms', 'vectors'):
+                    try:
+                        os.remove(self._segment_path(old_id, suffix))
+                    except FileNotFoundError:
+                        pass
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+
+        logger.info(f'Merged {len(small)} segments of {self.dir_path} into segment {segment_id}')
+        return segment_id
+
+    def lookup(self, hashes: np.ndarray) -> np.ndarray:
+        """
+        Find rows for `hashes`. Missing hashes get `-1`.
+        """
+        return self.index.lookup(hashes)
+
+    def get(self, rows: np.ndarray) -> Tuple[torch.tensor, torch.tensor]:
+        """
+        Read normalized vectors and their norms for `rows` from the memory-mapped segments.
+        """
+        vectors = np.empty((len(rows), self.dim), dtype=self.dtype)
+        norms = np.empty(len(rows), dtype=self.dtype)
+        segment_ids = np.searchsorted(self.segment_offsets, rows, side='right') - 1
+
+        for segment_id in np.unique(segment_ids):
+            selected = segment_ids == segment_id
+            local_rows = rows[selected] - self.segment_offsets[segment_id]
+            vectors[selected] = self.segments[segment_id][local_rows]
+            norms[selected] = self.segment_norms[segment_id][local_rows]
+
+        return torch.from_numpy(vectors), torch.from_numpy(norms)
+
+    def write_segment(self, hashes: np.ndarray, vectors: torch.tensor, norms: torch.tensor) -> int:
+        """
+        Write normalized `vectors` and their `norms` for `hashes` into a new segment file without registering it. Hashes that are
+        already stored are skipped. Files are written under temporary names and atomically renamed, so a crash never leaves a partially
+        written segment. Return the id of the new segment or `None` if there was nothing to write.
+        """
+        new = self.lookup(hashes) == -1
+        _, first = np.unique(hashes, return_index=True)
+        unique = np.zeros(len(hashes), dtype=bool)
+        unique[first] = True
+        selected = new & unique
+
+        if not selected.any():
+            return None
+
+        hashes = hashes[selected]
+        vectors = vectors.numpy()[selected]
+        norms = norms.numpy()[selected]
+
+        os.makedirs(self.segments_path, exist_ok=True)
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+            tmp_path = f'{self.meta_path}.tmp-{os.getpid()}'
+            with open(tmp_path, 'w', encoding='utf8') as f:
+                json.dump({'dim': self.dim, 'dtype': 'float32'}, f)
+            os.replace(tmp_path, self.meta_path)
+        assert vectors.shape[1] == self.dim
+
+        segment_id, fd = self._claim_segment()
+        with os.fdopen(fd, 'wb') as f:
+            vectors.tofile(f)
+        self._finish_segment(segment_id, norms, hashes)
+
+        return segment_id
+
+    def _finish_segment(self, segment_id: int, norms: np.ndarray, hashes: np.ndarray):
+        """
+        Write the `.norms` and, last, the `.keys` file of a segment whose vectors are already written, which makes it complete.
+        """
+        for suffix, data in (('norms', norms), ('keys', hashes)):
+            path = self._segment_path(segment_id, suffix)
+            data.tofile(path + '.tmp')
+            os.replace(path + '.tmp', path)
+
+    def _claim_segment(self) -> Tuple[int, int]:
+        """
+        Find the next free segment id and claim it by exclusively creating its `.vectors` file. Processes writing into the same
+        store never get the same id, so their files are never mixed. Return the id and the descriptor of the open file.
+        """
+        while True:
+            segment_id = self.next_segment_id
+            self.next_segment_id += 1
+            try:
+                fd = os.open(self._segment_path(segment_id, 'vectors'), os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+                return segment_id, fd
+            except FileExistsError:
+                continue
+
+    def add_segment(self, segment_id: int):
+        """
+        Memory-map a segment written by `write_segment` and add its keys to the index.
+        """
+        start = len(self)
+        keys = self._open_segment(segment_id)
+        self.index.add(keys, np.arange(start, start + len(keys), dtype=np.int64))
+
+    def append(self, hashes: np.ndarray, vectors: torch.tensor, norms: torch.tensor):
+        """
+        Write normalized `vectors` and their `norms` for `hashes` into a new segment and register it.
+        """
+        segment_id = self.write_segment(hashes, vectors, norms)
+        if segment_id is not None:
+            self.add_segment(segment_id)
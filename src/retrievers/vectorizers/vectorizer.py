@@ -1,10 +1,17 @@
+import atexit
 import json
 import logging
+import multiprocessing
 import os
-from typing import List
+import threading
+import time
+from typing import Any, Dict, List, Tuple
 
+import numpy as np
 import torch
 
+from src.retrievers.vectorizers.vector_store import VectorArena, VectorStore, hash_texts, normalize_vectors
+
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -19,57 +26,177 @@ class Vectorizer:
             `SentenceTransformerVectorizer` - Used for models using `sentence_transformers` library.
             `PytorchVectorizer` - Used for pytorch models (nn.Module).
             
-    The main call for `Vectorizer` is `vectorize`. This will calculate the appropriate vectors and store them in the `dict` attribute. The class also
-    supports `save` and `load`. `dir_path` is used as path to a folder where there is a `vocab.json` stored with the collection of texts and `vectors.py`
-    with a torch tensor of vectors for the texts.
+    The main call for `Vectorizer` is `vectorize`. This will calculate the appropriate vectors and store them in the `arena` attribute -- one
+    contiguous matrix of L2-normalized vectors indexed by the hashes of the texts -- until they are saved. The class also supports `save` and `load`.
+    `dir_path` is used as path to a folder with a `VectorStore` -- an append-only collection of memory-mapped segments with vectors keyed by the
+    hashes of the texts. Caches in the older format (`vocab.json` with the collection of texts and `vectors.pt` with a torch tensor of vectors
+    for the texts) are migrated into the store when they are loaded.
+
+    With `write_behind`, `vectorize(..., save_if_missing=True)` does not save the new vectors immediately. They are buffered in `arena` and
+    a background thread saves them when there are at least `flush_size` of them, after `flush_interval` seconds, and when the process exits.
+    Statistics about the saves are available in `flush_stats`.
+
+    Large corpora should be encoded with `encode_corpus`. It calculates the missing vectors in chunks, optionally in a pool of worker processes,
+    and saves every finished chunk as a new segment of the store, so an interrupted run continues with the chunks that were not saved yet.
     """
     
-    def __init__(self, dir_path: str):
-        self.dict = {}
+    def __init__(self, dir_path: str, write_behind: bool = False, flush_size: int = 10000, flush_interval: float = 60.0, cache_variant: str = None):
+        """
+        Attributes:
+            dir_path: str  Path to the vector store.
+            write_behind: bool  Save new vectors in a background thread instead of saving them during `vectorize`.
+            flush_size: int  Number of buffered vectors that triggers a background save.
+            flush_interval: float  Maximum number of seconds between background saves.
+            cache_variant: str  Variant of the model whose vectors differ from the original ones, e.g. a CPU optimization. Its vectors are
+                stored in a subdirectory of `dir_path`, so that they are never mixed with the vectors of the original model.
+        """
+        if dir_path and cache_variant:
+            dir_path = os.path.join(dir_path, cache_variant)
+
+        self.arena = VectorArena()
+        self.flushing = VectorArena()
+        self.store = None
+
+        self.write_behind = write_behind
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.flush_stats = {
+            'flushes': 0,
+            'vectors': 0,
+            'total_seconds': 0.0,
+            'max_seconds': 0.0,
+        }
+        self.lock = threading.RLock()
+        self.flush_lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.flush_thread = None
+        self.closed = False
+        self.batching_stats = {
+            'texts': 0,
+            'batches': 0,
+            'tokens': 0,
+            'padded_tokens': 0,
+            'seconds': 0.0,
+        }
         
         self.dir_path = dir_path
         if dir_path:
             self.vectors_path = os.path.join(dir_path, 'vectors.pt')
             self.vocab_path = os.path.join(dir_path, 'vocab.json')
+            self.store = VectorStore(dir_path)
         
             try:
                 self.load()
-                logger.info(f'Vector database with {len(self.dict)} records loaded')
+                logger.info(f'Vector database with {len(self)} records loaded')
             except FileNotFoundError:
                 pass
                 logger.info(f'No previous database found')
 
+        if self.write_behind:
+            atexit.register(self.close)
+
+    def __len__(self) -> int:
+        return len(self.arena) + len(self.flushing) + (len(self.store) if self.store else 0)
+
+    def _tiers(self) -> list:
+        return [tier for tier in (self.store, self.arena, self.flushing) if tier is not None]
+
+    def lookup(self, hashes: np.ndarray) -> tuple:
+        """
+        Locate `hashes` in the vector store and in the in-memory arenas. Return the index of the storage tier for each hash (`-1` if missing)
+        and the row in that tier. Rows are only valid until the next save, so this method should be called under `self.lock`.
+        """
+        tiers = np.full(len(hashes), -1, dtype=np.int64)
+        rows = np.full(len(hashes), -1, dtype=np.int64)
+        for tier_id, tier in enumerate(self._tiers()):
+            missing = tiers == -1
+            if not missing.any():
+                break
+            if not len(tier):
+                continue
+            tier_rows = tier.lookup(hashes[missing])
+            found = tier_rows != -1
+            tiers[np.flatnonzero(missing)[found]] = tier_id
+            rows[np.flatnonzero(missing)[found]] = tier_rows[found]
+        return tiers, rows
+
+    def _dim(self) -> int:
+        """
+        Dimension of the stored vectors, `0` if nothing is stored yet.
+        """
+        if self.store is not None and self.store.dim is not None:
+            return self.store.dim
+        for arena in (self.arena, self.flushing):
+            if arena.vectors is not None:
+                return arena.vectors.shape[1]
+        return 0
+
+    def gather(self, tiers: np.ndarray, rows: np.ndarray) -> tuple:
+        """
+        Gather normalized vectors and their norms located by `lookup`.
+        """
+        if not len(rows):
+            return torch.zeros((0, self._dim()), dtype=torch.float32), torch.zeros(0, dtype=torch.float32)
+
+        vectors, norms = None, None
+        for tier_id, tier in enumerate(self._tiers()):
+            selected = tiers == tier_id
+            if not selected.any():
+                continue
+            tier_vectors, tier_norms = tier.get(rows[selected])
+            if selected.all():
+                return tier_vectors, tier_norms
+            if vectors is None:
+                vectors = torch.empty((len(rows), tier_vectors.shape[1]), dtype=torch.float32)
+                norms = torch.empty(len(rows), dtype=torch.float32)
+            selected = torch.from_numpy(selected)
+            vectors[selected] = tier_vectors
+            norms[selected] = tier_norms
+        return vectors, norms
         
     def vectorize(self, texts: List[str], save_if_missing: bool = False, normalize: bool = False) -> torch.tensor:
         """
         The main API point for the users. Try to find the vectors in the existing database. For the missing texts, the vectors will be calculated
-        and saved in the `self.dict`. 
+        and saved in the `self.arena`. The cost of the lookup depends on the number of `texts`, not on the size of the database.
         
         Attributes:
-            save_if_missing: bool  Should the vectors in `dict` be saved after new vectors are calculated? This makes sense for models that will
-                be used more than once.
-            normalize: bool  Should the vectors be normalized. Useful for cosine similarity calculations.
+            save_if_missing: bool  Should the vectors in `arena` be saved after new vectors are calculated? This makes sense for models that will
+                be used more than once. With `write_behind`, the save is only scheduled.
+            normalize: bool  Should the vectors be normalized. Useful for cosine similarity calculations. The vectors are stored normalized,
+                so this is free.
         """
         
-        missing_texts = list(set(texts) - set(self.dict.keys()))
-        
-        if missing_texts:
+        hashes = hash_texts(texts)
+
+        with self.lock:
+            tiers, _ = self.lookup(hashes)
+
+        missing = np.flatnonzero(tiers == -1)
+        if len(missing):
+            missing_hashes, first = np.unique(hashes[missing], return_index=True)
+            missing_texts = [texts[i] for i in missing[first]]
             
             # logger.info(f'Calculating {len(missing_texts)} vectors.')
             missing_vectors = self._calculate_vectors(missing_texts)
-            for text, vector in zip(missing_texts, missing_vectors):
-                self.dict[text] = vector
+            if isinstance(missing_vectors, list):
+                missing_vectors = torch.stack(missing_vectors)
+            missing_vectors = missing_vectors.cpu()
+            with self.lock:
+                # Another thread might have added some of the vectors in the meantime
+                new = self.lookup(missing_hashes)[0] == -1
+                self.arena.append(missing_hashes[new], missing_vectors[torch.from_numpy(new)])
             
-            if save_if_missing:
-                self.save()
-            
-        vectors = torch.vstack([
-            self.dict[text]
-            for text in texts
-        ])
+            if save_if_missing and self.store is not None:
+                if self.write_behind:
+                    self._schedule_save()
+                else:
+                    self.save()
+
+        with self.lock:
+            vectors, norms = self.gather(*self.lookup(hashes))
         
-        if normalize:
-            vectors = torch.nn.functional.normalize(vectors, p=2, dim=1)
+        if not normalize:
+            vectors = vectors * norms.unsqueeze(1)
             
         return vectors
 
@@ -80,11 +207,88 @@ class Vectorizer:
         """
         raise NotImplementedError
 
+    def worker_config(self) -> Dict[str, Any]:
+        """
+        Constructor arguments used to create a copy of this vectorizer in a worker process of `encode_corpus`. The copy has no cache.
+        Subclasses that can load their model in another process should override this method, `None` means that multiple workers are
+        not supported.
+        """
+        return None
+
+    def encode_corpus(self, texts: List[str], chunk_size: int = 10000, num_workers: int = 1, threads_per_worker: int = None) -> int:
+        """
+        Calculate and store vectors for a large corpus of `texts`. Only the texts missing in the store are encoded. They are split into chunks
+        of `chunk_size` texts and every finished chunk is immediately saved as a new segment of the store. When the encoding is interrupted,
+        the next run skips all the saved chunks and resumes with the rest. Return the number of newly calculated vectors.
+
+        Attributes:
+            chunk_size: int  Number of texts encoded and saved together.
+            num_workers: int  Number of worker processes. Each worker loads its own copy of the model, see `worker_config`.
+            threads_per_worker: int  Number of torch threads in each worker. `None` divides the CPU cores between the workers.
+        """
+        assert self.store is not None, 'Corpus encoding requires `dir_path`.'
+
+        self.save()
+        hashes = hash_texts(texts)
+        with self.lock:
+            tiers, _ = self.lookup(hashes)
+        missing = np.flatnonzero(tiers == -1)
+        missing_hashes, first = np.unique(hashes[missing], return_index=True)
+        # Keep the corpus order, so that the chunks are the same in every run
+        order = np.argsort(missing[first], kind='stable')
+        missing_hashes, missing = missing_hashes[order], missing[first][order]
+
+        chunks = [
+            (missing_hashes[i:i+chunk_size], [texts[j] for j in missing[i:i+chunk_size]])
+            for i in range(0, len(missing), chunk_size)
+        ]
+        logger.info(f'Encoding {len(missing)} of {len(texts)} texts in {len(chunks)} chunks')
+        if not chunks:
+            return 0
+
+        config = self.worker_config()
+        if num_workers > 1 and config is None:
+            logger.warning(f'{type(self).__name__} does not support worker processes, encoding in the main process')
+            num_workers = 1
+
+        start = time.perf_counter()
+        encoded = 0
+        if num_workers <= 1:
+            for chunk_hashes, chunk_texts in chunks:
+                encoded += self._checkpoint(chunk_hashes, self._calculate_vectors(chunk_texts))
+                logger.info(f'Encoded {encoded}/{len(missing)} texts in {time.perf_counter() - start:.1f}s')
+            return encoded
+
+        threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // num_workers)
+        # Workers are spawned, so that they do not inherit the model or CUDA state of the main process
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(num_workers, initializer=_init_worker, initargs=(type(self), config, threads_per_worker)) as pool:
+            for chunk_hashes, vectors in pool.imap_unordered(_encode_chunk, chunks):
+                encoded += self._checkpoint(chunk_hashes, torch.from_numpy(vectors))
+                logger.info(f'Encoded {encoded}/{len(missing)} texts in {time.perf_counter() - start:.1f}s')
+        return encoded
+
+    def _checkpoint(self, hashes: np.ndarray, vectors: torch.tensor) -> int:
+        """
+        Save a finished chunk of `encode_corpus` as a new segment of the store.
+        """
+        if isinstance(vectors, list):
+            vectors = torch.stack(vectors)
+        with self.flush_lock:
+            segment_id = self.store.write_segment(hashes, *normalize_vectors(vectors))
+            with self.lock:
+                if segment_id is not None:
+                    self.store.add_segment(segment_id)
+        return len(hashes)
+
             
     def load(self):
         """
-        Load vocab and vectors from appropriate files
+        Open the vector store. Caches in the older `vocab.json` + `vectors.pt` format are migrated into the store once.
         """
+        if self.store.open():
+            return
+
         with open(self.vocab_path, 'r', encoding='utf8') as f:
             vocab = json.load(f)
         
@@ -92,22 +296,125 @@ class Vectorizer:
         
         assert len(vocab) == len(vectors)
 
-        self.dict = {
-            text: vector
-            for text, vector in zip(vocab, vectors)
-        }
+        logger.info(f'Migrating {len(vocab)} vectors from {self.vocab_path} into the vector store')
+        self.store.append(hash_texts(vocab), *normalize_vectors(vectors))
         
         
     def save(self):
         """
-        Save vocab and vectors to appropriate files
+        Append vectors that are not stored yet to the vector store. The buffered vectors remain readable while they are being written.
         """
-        os.makedirs(self.dir_path, exist_ok=True)
-            
-        vocab = list(self.dict.keys())        
-        with open(self.vocab_path, 'w', encoding='utf8') as f:
-            json.dump(vocab, f)
-            
-        vectors = torch.vstack(list(self.dict.values()))
-        torch.save(vectors, self.vectors_path)
-            
\ No newline at end of file
+        with self.flush_lock:
+            with self.lock:
+                if self.store is None or not len(self.arena):
+                    return
+                self.flushing, self.arena = self.arena, VectorArena()
+
+            start = time.perf_counter()
+            try:
+                segment_id = self.store.write_segment(*self.flushing.data())
+            except Exception:
+                # Return the vectors into the arena so that the next save can retry
+                with self.lock:
+                    keys, vectors, norms = self.flushing.data()
+                    self.arena.append(keys, vectors * norms.unsqueeze(1))
+                    self.flushing = VectorArena()
+                raise
+
+            count = len(self.flushing)
+            with self.lock:
+                if segment_id is not None:
+                    self.store.add_segment(segment_id)
+                self.flushing = VectorArena()
+
+            elapsed = time.perf_counter() - start
+            self.flush_stats['flushes'] += 1
+            self.flush_stats['vectors'] += count
+            self.flush_stats['total_seconds'] += elapsed
+            self.flush_stats['max_seconds'] = max(self.flush_stats['max_seconds'], elapsed)
+
+    def _schedule_save(self):
+        """
+        Start the background saving thread if necessary and wake it up if enough vectors are buffered.
+        """
+        with self.condition:
+            if self.flush_thread is None and not self.closed:
+                self.flush_thread = threading.Thread(target=self._flush_loop, daemon=True)
+                self.flush_thread.start()
+            if len(self.arena) >= self.flush_size:
+                self.condition.notify()
+
+    def _flush_loop(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(
+                    lambda: self.closed or len(self.arena) >= self.flush_size,
+                    timeout=self.flush_interval
+                )
+                closed = self.closed
+
+            try:
+                self.save()
+            except Exception:
+                logger.exception('Saving of the vectors failed')
+
+            if closed:
+                return
+
+    def close(self):
+        """
+        Stop the background saving thread and save all the buffered vectors. Afterwards, nothing but the caller keeps a reference
+        to the vectorizer, so its model can be freed.
+        """
+        atexit.unregister(self.close)
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+        if self.flush_thread is not None:
+            self.flush_thread.join()
+            self.flush_thread = None
+
+        self.save()
+        if self.write_behind and self.flush_stats['flushes']:
+            logger.info(f'Vector saves: {self.flush_stats}')
+
+    def get_batching_stats(self) -> Dict[str, float]:
+        """
+        Return the number of encoded texts, batches, real and padded tokens, the share of padding in the padded tokens and the throughput
+        of `_calculate_vectors` in texts and tokens per second. Token counts are available only for vectorizers that tokenize the texts
+        themselves, e.g. with `max_tokens`.
+        """
+        stats = dict(self.batching_stats)
+        stats['padded_ratio'] = 1 - stats['tokens'] / stats['padded_tokens'] if stats['padded_tokens'] else 0.0
+        stats['texts_per_second'] = stats['texts'] / stats['seconds'] if stats['seconds'] else 0.0
+        stats['tokens_per_second'] = stats['tokens'] / stats['seconds'] if stats['seconds'] else 0.0
+        return stats
+
+    def get_flush_stats(self) -> Dict[str, float]:
+        """
+        Return the number of saves, the number of saved vectors and the total, average and maximum save latency in seconds.
+        """
+        stats = dict(self.flush_stats)
+        stats['avg_seconds'] = stats['total_seconds'] / stats['flushes'] if stats['flushes'] else 0.0
+        return stats
+
+
+_worker_vectorizer = None
+
+
+def _init_worker(vectorizer_class: type, config: Dict[str, Any], threads: int):
+    """
+    Load a copy of the vectorizer without cache in a worker process of `Vectorizer.encode_corpus`.
+    """
+    global _worker_vectorizer
+    torch.set_num_threads(threads)
+    _worker_vectorizer = vectorizer_class(dir_path=None, **config)
+
+
+def _encode_chunk(chunk: Tuple[np.ndarray, List[str]]) -> Tuple[np.ndarray, np.ndarray]:
+    hashes, texts = chunk
+    vectors = _worker_vectorizer._calculate_vectors(texts)
+    if isinstance(vectors, list):
+        vectors = torch.stack(vectors)
+    return hashes, vectors.detach().cpu().to(torch.float32).numpy()